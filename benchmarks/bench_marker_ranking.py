@@ -0,0 +1,43 @@
+#######################################################################################################################
+# ------ Benchmark: marker to camera candidate ranking (metashape_markers.rank_marker_cameras) ------------------------
+# ------ 100 markers on synthetic nadir grid flights, KD-tree and numpy nearest camera search --------------------------
+#######################################################################################################################
+# run with:  python benchmarks/bench_marker_ranking.py
+
+import os
+import sys
+import time
+
+import numpy as np
+
+import fake_metashape
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metashape_markers
+from metashape_markers import rank_marker_cameras
+
+
+def main():
+    print("{:>8} {:>8} {:>12} {:>12} {:>14}".format("cameras", "markers", "kdtree (s)", "numpy (s)", "mean ranked"))
+    for n in (1000, 10000):
+        chunk = fake_metashape.synthetic_chunk(n, 0, n_markers=100)
+        for marker in chunk.markers:
+            marker.position = fake_metashape.Vector(marker.reference.location)
+
+        start = time.perf_counter()
+        ranking = rank_marker_cameras(chunk, 10)
+        t_tree = time.perf_counter() - start
+
+        tree, metashape_markers.cKDTree = metashape_markers.cKDTree, None
+        start = time.perf_counter()
+        brute = rank_marker_cameras(chunk, 10)
+        t_numpy = time.perf_counter() - start
+        metashape_markers.cKDTree = tree
+        assert [[c[0].key for c in v] for v in ranking.values()] == [[c[0].key for c in v] for v in brute.values()]
+
+        print("{:>8} {:>8} {:>12.3f} {:>12.3f} {:>14.1f}".format(n, len(chunk.markers), t_tree, t_numpy,
+                                                                np.mean([len(v) for v in ranking.values()])))
+
+
+if __name__ == '__main__':
+    main()
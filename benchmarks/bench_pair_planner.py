@@ -0,0 +1,50 @@
+#######################################################################################################################
+# ------ Benchmark: matchPhotos pair planning (metashape_pairs.plan_pairs) -----------------------------------------------
+# ------ Planning time and pairs kept on synthetic lawnmower grid flights, KD-tree and numpy grid search ---------------
+#######################################################################################################################
+# run with:  python benchmarks/bench_pair_planner.py
+
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metashape_pairs
+from metashape_pairs import plan_pairs, grid_radius_pairs, unique_pairs
+
+
+def grid_flight(n_cameras, height=100., along=15., across=35., seed=0):
+    # camera positions of a lawnmower survey: lines `across` m apart, a photo every `along` m, 2 m GPS noise
+    rng = np.random.default_rng(seed)
+    per_line = int(math.ceil(math.sqrt(n_cameras * across / along)))
+    i = np.arange(n_cameras)
+    line, step = i // per_line, i % per_line
+    step = np.where(line % 2 == 0, step, per_line - 1 - step)  # alternate flight direction
+    xy = np.column_stack((step * along, line * across)) + rng.normal(0, 2., (n_cameras, 2))
+    return xy
+
+
+def main():
+    footprint = 100. * metashape_pairs.DEFAULT_FOOTPRINT_RATIO
+    print("{:>8} {:>14} {:>12} {:>8} {:>12} {:>12}".format("cameras", "exhaustive", "kept", "%", "kdtree (s)",
+                                                          "grid (s)"))
+    for n in (1000, 10000, 50000):
+        xy = grid_flight(n)
+        plan = plan_pairs(xy, footprint, k=10)
+
+        start = time.perf_counter()
+        grid = unique_pairs(grid_radius_pairs(xy, footprint))
+        t_grid = time.perf_counter() - start
+        assert metashape_pairs.cKDTree is None or \
+            np.array_equal(grid, unique_pairs(metashape_pairs.radius_pairs(xy, footprint)))
+
+        print("{:>8} {:>14} {:>12} {:>8.3f} {:>12.3f} {:>12.3f}".format(n, plan.exhaustive(), len(plan.pairs),
+                                                                      len(plan.pairs) / plan.exhaustive() * 100,
+                                                                      plan.seconds, t_grid))
+
+
+if __name__ == '__main__':
+    main()
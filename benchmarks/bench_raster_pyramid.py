@@ -0,0 +1,118 @@
+#######################################################################################################################
+# ------ Benchmark: low resolution rasters from the high resolution export (metashape_pyramid.derive_raster) ----------
+# ------ synthetic float32 DSM and RGBA orthomosaic GeoTIFFs, time and peak memory per resampling method ---------------
+#######################################################################################################################
+# Before timing, check_average resamples a small DSM with nodata pixels and compares the output with area-weighted
+# means computed pixel by pixel, and checks the nodata value and the scaled georeferencing of the output file.
+# run with:  python benchmarks/bench_raster_pyramid.py [--size 8000]
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metashape_instrument import peak_rss_mb, reset_peak_rss
+from metashape_pyramid import GeoTiff, TiffWriter, derive_raster
+
+GEO_KEYS = [1, 1, 0, 3, 1024, 0, 1, 1, 1025, 0, 1, 1, 3072, 0, 1, 32630]  # projected, PixelIsArea, UTM 30N
+
+
+def write_raster(path, size, samples, dtype, nodata=None):  # size x size raster, written strip by strip
+    tags = {33550: [0.02, 0.02, 0.], 33922: [0, 0, 0, 500000., 5600000., 0], 34735: GEO_KEYS}
+    if nodata is not None:
+        tags[42113] = str(nodata)
+    writer = TiffWriter(path, size, size, samples, dtype, 256, tags, alpha=samples == 4)
+    rng = np.random.default_rng(0)
+    for r in range(0, size, 256):
+        n = min(256, size - r)
+        if dtype == np.uint8:
+            writer.write(rng.integers(0, 256, (n, size, samples), dtype=np.uint8))
+        else:
+            writer.write(rng.normal(100., 5., (n, size, samples)).astype(dtype))
+    writer.close()
+
+
+def block_means(values, f, nodata):  # area-weighted mean of the unit pixels under each f x f output pixel, slowly
+    n = int(np.ceil(len(values) / f - 1e-9))
+    out = np.zeros((n, n))
+    for j in range(n):
+        for i in range(n):
+            total, weight = 0., 0.
+            for r in range(len(values)):
+                for c in range(len(values)):
+                    h = max(0., min(r + 1, (j + 1) * f) - max(r, j * f))  # overlap of the row and of the column
+                    w = h * max(0., min(c + 1, (i + 1) * f) - max(c, i * f))
+                    if w > 0 and values[r, c] != nodata:
+                        total, weight = total + w * values[r, c], weight + w
+            out[j, i] = total / weight if weight > 0 else nodata
+    return out
+
+
+def check_average(folder):
+    values = np.arange(64, dtype=np.float32).reshape(8, 8)
+    values[0, 0] = values[1, 2] = -9999.  # two nodata pixels in the first 4 x 4 block
+    values[4:, 4:] = -9999.  # the last 4 x 4 block has no data at all
+    src, dst = os.path.join(folder, "hand.tif"), os.path.join(folder, "hand_lr.tif")
+    # pixel (2, 3) is at (500000.04, 5599999.94): the top-left corner of the raster is at (500000, 5600000)
+    tags = {33550: [0.02, 0.02, 0.], 33922: [2, 3, 0, 500000.04, 5599999.94, 0], 34735: GEO_KEYS, 42113: "-9999"}
+    writer = TiffWriter(src, 8, 8, 1, np.float32, 3, tags)
+    for r in range(0, 8, 3):
+        writer.write(values[r:r + 3, :, None])
+    writer.close()
+
+    first = (6 + 38 + 70 + 102 - 0 - 10) / 14.  # rows 0-3 of the first block sum to 6, 38, 70, 102; 0 and 10 are nodata
+    for resolution, factor in ((0.08, 4), (0.05, 2.5)):
+        derive_raster(src, dst, resolution, "average")
+        out = GeoTiff(dst)
+        try:
+            result = out.rows(0, out.height)[:, :, 0]
+            expected = block_means(values, factor, -9999.)
+            if factor == 4:
+                expected_by_hand = [[first, np.mean(values[:4, 4:])], [np.mean(values[4:, :4]), -9999.]]
+                if not np.allclose(expected, expected_by_hand):
+                    raise SystemExit("block_means does not match the hand-computed means")
+            ok = result.shape == expected.shape and np.allclose(result, expected, rtol=0, atol=1e-4)
+            ok = ok and out.nodata == -9999. and np.allclose(out.tags[33550][:2], [resolution, resolution])
+            ok = ok and np.allclose(out.tags[33922], [0, 0, 0, 500000., 5600000., 0], rtol=0, atol=1e-6)
+        finally:
+            out.close()
+        print("average at factor " + str(factor) + " against hand-computed block means: " + ("ok" if ok else "FAILED"))
+        if not ok:
+            raise SystemExit("average resampling or georeferencing does not match the expected values:\n" +
+                             str(result) + "\n" + str(expected))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=8000)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        check_average(folder)
+        dsm = os.path.join(folder, "dsm.tif")
+        ortho = os.path.join(folder, "ortho.tif")
+        write_raster(dsm, args.size, 1, np.float32, -32767)
+        write_raster(ortho, args.size, 4, np.uint8)
+        print("{:<8} {:<8} {:>10} {:>8} {:>10} {:>12}".format("raster", "method", "factor", "MB in", "time (s)",
+                                                             "peak MB"))
+        for name, path, method, resolution in (("ortho", ortho, "average", 0.2), ("dsm", dsm, "average", 1.0),
+                                               ("dsm", dsm, "average", 0.07), ("dsm", dsm, "nearest", 1.0),
+                                               ("dsm", dsm, "max", 1.0)):
+            reset_peak_rss()
+            start = time.perf_counter()
+            derive_raster(path, os.path.join(folder, "lr.tif"), resolution, method, max_block_mb=64)
+            seconds = time.perf_counter() - start
+            print("{:<8} {:<8} {:>10.1f} {:>8.0f} {:>10.2f} {:>12}".format(
+                name, method, resolution / 0.02, os.path.getsize(path) / 2 ** 20, seconds, peak_rss_mb()))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#######################################################################################################################
+# ------ Benchmark: region outlier count in build_DPC (metashape_tiepoints.outside_box) --------------------------------
+# ------ Compares the original per-point Vector loop with the batched numpy classifier --------------------------------
+#######################################################################################################################
+# run with:  python benchmarks/bench_region_outliers.py
+
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from fake_metashape import Vector, Matrix
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metashape_tiepoints import outside_box
+
+
+def legacy_outside(coords, valid, R, C, size):  # original loop from metashape_part2_DPC.build_DPC
+    outside = 0
+    for coord, is_valid in zip(coords, valid):
+        if is_valid:
+            v = Vector(coord)
+            v_c = v - C
+            v_r = R.t() * v_c
+            if abs(v_r.x) > abs(size.x / 2.):
+                outside += 1
+            elif abs(v_r.z) > abs(size.z / 2.):
+                outside += 1
+            elif abs(v_r.y) > abs(size.y / 2.):
+                outside += 1
+    return outside
+
+
+def rotation(yaw):
+    c, s = math.cos(yaw), math.sin(yaw)
+    return np.array([[c, -s, 0.], [s, c, 0.], [0., 0., 1.]])
+
+
+def main():
+    rng = np.random.default_rng(0)
+    center = np.array([10., -5., 2.])
+    rot = rotation(0.4)
+    size = np.array([200., 150., 40.])
+
+    print("{:>9} {:>12} {:>12} {:>9} {:>10}".format("points", "numpy (s)", "loop (s)", "speedup", "outside"))
+    for npoints in (100000, 1000000, 5000000):
+        coords = rng.normal(0., 1., (npoints, 3)) * np.array([80., 60., 15.]) + center
+        valid = rng.random(npoints) > 0.02
+
+        start = time.perf_counter()
+        outside = valid & outside_box(coords, center, rot, size)
+        t_numpy = time.perf_counter() - start
+
+        coord_list = coords.tolist()  # the loop reads python floats, as Metashape points do
+        start = time.perf_counter()
+        n_legacy = legacy_outside(coord_list, valid.tolist(), Matrix(rot), Vector(center), Vector(size))
+        t_loop = time.perf_counter() - start
+
+        assert n_legacy == np.count_nonzero(outside)
+        print("{:>9} {:>12.3f} {:>12.2f} {:>8.0f}x {:>10}".format(npoints, t_numpy, t_loop, t_loop / t_numpy,
+                                                                  n_legacy))
+
+
+if __name__ == '__main__':
+    main()
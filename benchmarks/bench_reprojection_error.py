@@ -0,0 +1,110 @@
+#######################################################################################################################
+# ------ Benchmark: reprojection error engine (metashape_tiepoints.reprojection_errors) --------------------------------
+# ------ Compares the original per-camera while loop with the array based engine on synthetic chunks ------------------
+#######################################################################################################################
+# run with:  python benchmarks/bench_reprojection_error.py
+
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+import fake_metashape
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metashape_tiepoints import reprojection_errors, project_frame, TiePointSnapshot
+
+# Hand-computed frame camera projections (Metashape User Manual, Appendix C) for a camera at (10, 20, -5) looking
+# along +z, with f 1000, 2000 x 1000 pix, cx 5, cy -3, b1 2, b2 1, k1-k4 0.1 / 0.01 / 0.001 / 0.0001, p1 0.001,
+# p2 -0.002. For the first point: x = 0.1, y = -0.05, r2 = 0.0125, radial = 1 + k1 r2 + k2 r2^2 + ... = 1.0012515645,
+#   x' = x radial + p1 (r2 + 2 x^2) + 2 p2 x y = 0.1001776564   y' = y radial + p2 (r2 + 2 y^2) + 2 p1 x y = -0.0501075782
+#   u = 1000 + 5 + 1000 x' + 2 x' + 1 y' = 1105.3279042    v = 500 - 3 + 1000 y' = 446.8924218
+# chunk point -> (u, v)
+HAND_PROJECTIONS = [((10.1, 19.95, -4.), (1105.327904180225, 446.89242177722167)),
+                    ((9.8, 20.15, -3.), (904.7839973591558, 572.0486208920181)),
+                    ((10., 20., 0.), (1005., 497.))]  # on the axis: the principal point
+
+
+def legacy_calc_reprojection_error(chunk, points, projections):  # original loop from metashape_part1_SPC.py
+    npoints = len(points)
+    photo_avg = []
+    for camera in chunk.cameras:
+        if not camera.transform:
+            continue
+        point_index = 0
+        photo_num = 0
+        photo_err = 0
+        for proj in projections[camera]:
+            track_id = proj.track_id
+            while point_index < npoints and points[point_index].track_id < track_id:
+                point_index += 1
+            if point_index < npoints and points[point_index].track_id == track_id:
+                if not points[point_index].valid:
+                    continue
+                dist = camera.error(points[point_index].coord, proj.coord).norm() ** 2
+                photo_num += 1
+                photo_err += dist
+        photo_avg.append(math.sqrt(photo_err / photo_num))
+    return photo_avg
+
+
+def check_camera_model():
+    # the engine and the stand-in's Camera.error share the projection formula, so the "max diff" column below only
+    # compares the engine with the original loop - the formula itself is checked against the hand-computed values
+    calib = fake_metashape.Calibration(2000, 1000, 1000.)
+    calib.cx, calib.cy, calib.b1, calib.b2 = 5., -3., 2., 1.
+    calib.k1, calib.k2, calib.k3, calib.k4 = 0.1, 0.01, 0.001, 0.0001
+    calib.p1, calib.p2, calib.p3, calib.p4 = 0.001, -0.002, 0., 0.
+    transform = np.eye(4)
+    transform[:3, 3] = (10., 20., -5.)
+    camera = fake_metashape.Camera(0, "hand", transform, fake_metashape.Sensor(calib))
+
+    points = [fake_metashape.Point(i, list(xyz) + [1.]) for i, (xyz, uv) in enumerate(HAND_PROJECTIONS)]
+    # measured 3 pix right and 4 pix up of the true projection: every projection is 5 pix off
+    projs = [fake_metashape.Projection(i, (uv[0] + 3., uv[1] - 4.)) for i, (xyz, uv) in enumerate(HAND_PROJECTIONS)]
+    chunk = fake_metashape.Chunk([camera], [], fake_metashape.PointCloud(points, {camera: projs}),
+                                 fake_metashape.Region((10., 20., 0.), (10., 10., 10.), np.eye(3)))
+
+    coords = np.array([list(xyz) + [1.] for xyz, uv in HAND_PROJECTIONS])
+    uv = project_frame(coords, np.linalg.inv(transform), calib)
+    diff = max(max(abs(uv[i, 0] - u), abs(uv[i, 1] - v)) for i, (xyz, (u, v)) in enumerate(HAND_PROJECTIONS))
+    rmse = reprojection_errors(chunk, TiePointSnapshot(chunk.point_cloud), chunk.point_cloud.projections).rmse_list()
+    legacy = legacy_calc_reprojection_error(chunk, points, chunk.point_cloud.projections)
+    print("camera model against hand-computed projections: max diff " + "{:.2e}".format(diff) + " pix, rmse " +
+          str(round(rmse[0], 9)) + " (engine) / " + str(round(legacy[0], 9)) + " (original loop), expected 5")
+    if diff > 1e-6 or abs(rmse[0] - 5.) > 1e-6 or abs(legacy[0] - 5.) > 1e-6:
+        raise SystemExit("projection does not match the hand-computed values")
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    sizes = [(25, 5000), (100, 20000), (400, 80000), (1600, 320000)]
+    legacy_limit = 20000  # the legacy loop is O(cameras x points); only run it on the small cases
+
+    check_camera_model()
+
+    print("{:>8} {:>9} {:>12} {:>12} {:>10}".format("cameras", "points", "engine (s)", "legacy (s)", "max diff"))
+    for n_cameras, n_points in sizes:
+        chunk = fake_metashape.synthetic_chunk(n_cameras, n_points)
+        points, projections = chunk.point_cloud.points, chunk.point_cloud.projections
+        snapshot, t_snapshot = timed(TiePointSnapshot, chunk.point_cloud)
+        errors, t_engine = timed(reprojection_errors, chunk, snapshot, projections)
+        t_engine += t_snapshot
+
+        if n_points <= legacy_limit:
+            legacy, t_legacy = timed(legacy_calc_reprojection_error, chunk, points, projections)
+            diff = max(abs(a - b) for a, b in zip(legacy, errors.rmse_list()))
+            print("{:>8} {:>9} {:>12.3f} {:>12.3f} {:>10.2e}".format(n_cameras, n_points, t_engine, t_legacy, diff))
+        else:
+            print("{:>8} {:>9} {:>12.3f} {:>12} {:>10}".format(n_cameras, n_points, t_engine, "-", "-"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,537 @@
+#######################################################################################################################
+# ------ Benchmarks: pure Python / numpy stand-in for the parts of the Metashape API used by the workflow -------------
+#######################################################################################################################
+# Only what the three workflow scripts and the metashape_*.py helpers touch is implemented: Vector, Matrix, Region,
+# Calibration/Sensor, Camera, Marker, PointCloud (points, projections, Filter), DenseCloud, Chunk, Document and app.
+# Processing calls (alignCameras, buildDepthMaps, buildDenseCloud, optimizeCameras...) do nothing, so timings measure
+# only the Python-side logic of the scripts.
+#
+# install() registers this module as "Metashape" so the workflow scripts can be imported without a licence:
+#   import fake_metashape
+#   fake_metashape.install()
+#   import metashape_part1_SPC as part1
+#
+# synthetic_chunk() builds a chunk of nadir frame cameras over a flat-ish surface with a configurable number of
+# cameras, tie points, projections per point and markers.
+
+import math
+import sys
+
+import numpy as np
+
+
+# ---- geometry -------------------------------------------------------------------------------------------------------
+
+class Vector:
+    def __init__(self, values):
+        self.values = [float(v) for v in values]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def __eq__(self, other):
+        return isinstance(other, Vector) and self.values == other.values
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Vector(" + repr(self.values) + ")"
+
+    def __add__(self, other):
+        return Vector(a + b for a, b in zip(self.values, other))
+
+    def __sub__(self, other):
+        return Vector(a - b for a, b in zip(self.values, other))
+
+    def __mul__(self, k):
+        return Vector(a * k for a in self.values)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, k):
+        return Vector(a / k for a in self.values)
+
+    x = property(lambda self: self.values[0])
+    y = property(lambda self: self.values[1])
+    z = property(lambda self: self.values[2])
+
+    def norm(self):
+        return math.sqrt(sum(v * v for v in self.values))
+
+    def norm2(self):
+        return sum(v * v for v in self.values)
+
+
+class Matrix:
+    def __init__(self, rows):
+        self.array = np.array([list(r) for r in rows], dtype=float)
+        self.size = self.array.shape
+
+    @staticmethod
+    def Diag(values):
+        return Matrix(np.diag(list(values)))
+
+    def row(self, i):
+        return Vector(self.array[i])
+
+    def col(self, i):
+        return Vector(self.array[:, i])
+
+    def t(self):
+        return Matrix(self.array.T)
+
+    def inv(self):
+        return Matrix(np.linalg.inv(self.array))
+
+    def mulp(self, v):  # transform a point (homogeneous, w = 1)
+        return Vector((self.array @ np.append(list(v), 1.))[:3])
+
+    def __mul__(self, other):
+        if isinstance(other, Matrix):
+            return Matrix(self.array @ other.array)
+        return Vector(self.array @ np.array(list(other), dtype=float))
+
+    def __repr__(self):
+        return "Matrix(" + repr(self.array.tolist()) + ")"
+
+
+class Region:
+    def __init__(self, center, size, rot):
+        self.center, self.size, self.rot = Vector(center), Vector(size), Matrix(rot)
+
+
+# ---- cameras and markers ----------------------------------------------------------------------------------------------
+
+class Calibration:
+    def __init__(self, width, height, f):
+        self.width, self.height, self.f = width, height, f
+        self.cx, self.cy, self.b1, self.b2 = 1.5, -2.0, 0.1, 0.05
+        self.k1, self.k2, self.k3, self.k4 = -0.05, 0.01, 0.0, 0.0
+        self.p1, self.p2, self.p3, self.p4 = 1e-4, -2e-4, 0.0, 0.0
+
+
+def project(coords, world_to_cam, calib):  # frame camera model (Metashape User Manual, Appendix C)
+    cam = coords @ world_to_cam.T
+    x = cam[:, 0] / cam[:, 2]
+    y = cam[:, 1] / cam[:, 2]
+    r2 = x * x + y * y
+    radial = 1 + r2 * (calib.k1 + r2 * (calib.k2 + r2 * (calib.k3 + r2 * calib.k4)))
+    tangential = 1 + r2 * (calib.p3 + r2 * calib.p4)
+    xd = x * radial + (calib.p1 * (r2 + 2 * x * x) + 2 * calib.p2 * x * y) * tangential
+    yd = y * radial + (calib.p2 * (r2 + 2 * y * y) + 2 * calib.p1 * x * y) * tangential
+    u = calib.width * 0.5 + calib.cx + xd * calib.f + xd * calib.b1 + yd * calib.b2
+    v = calib.height * 0.5 + calib.cy + yd * calib.f
+    return np.column_stack((u, v))
+
+
+class Sensor:
+    class Type:
+        Frame = "Frame"
+        Fisheye = "Fisheye"
+        Spherical = "Spherical"
+
+    def __init__(self, calibration, label="sensor"):
+        self.label = label
+        self.type = Sensor.Type.Frame
+        self.calibration = calibration
+        self.width, self.height = calibration.width, calibration.height
+        self.rolling_shutter = False
+
+
+class Reference:
+    def __init__(self, location=None, accuracy=None, enabled=True):
+        self.location = Vector(location) if location is not None else None
+        self.accuracy = Vector(accuracy) if accuracy is not None else None
+        self.enabled = enabled
+
+
+class Photo:
+    def __init__(self, path):
+        self.path = path
+        self.meta = {}
+
+
+class Camera:
+    def __init__(self, key, label, transform, sensor, reference=None):
+        self.key = key
+        self.label = label
+        self.transform = Matrix(transform) if transform is not None else None
+        self.sensor = sensor
+        self.enabled = True
+        self.selected = False
+        self.reference = reference or Reference()
+        self.photo = Photo(label + ".JPG")
+        self.meta = {}
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, matrix):
+        self._transform = matrix
+        self._world_to_cam = None
+
+    @property
+    def center(self):
+        return None if self.transform is None else Vector(self.transform.array[:3, 3])
+
+    def world_to_cam(self):  # cached, as Metashape keeps the camera pose ready for projection
+        if self._world_to_cam is None:
+            self._world_to_cam = np.linalg.inv(self.transform.array)
+        return self._world_to_cam
+
+    def project(self, point):
+        if self.transform is None:
+            return None
+        uv = project(np.array([list(point)[:3] + [1.]]), self.world_to_cam(), self.sensor.calibration)[0]
+        return Vector(uv)
+
+    def error(self, point, proj):  # projected minus measured position of one projection
+        uv = project(np.array([list(point)]), self.world_to_cam(), self.sensor.calibration)[0]
+        return Vector((uv[0] - proj.x, uv[1] - proj.y))
+
+
+class Marker:
+    def __init__(self, key, label, reference):
+        self.key = key
+        self.label = label
+        self.reference = reference
+        self.projections = {}  # camera -> Marker.Projection
+        self.position = None
+
+    class Projection:
+        def __init__(self, coord, pinned=True):
+            self.coord = Vector(coord)
+            self.pinned = pinned
+
+
+# ---- tie points and dense cloud ---------------------------------------------------------------------------------------
+
+class Point:
+    def __init__(self, track_id, coord, valid=True):
+        self.track_id = track_id
+        self.coord = Vector(coord)
+        self.valid = valid
+        self.selected = False
+
+
+class Projection:
+    def __init__(self, track_id, coord):
+        self.track_id = track_id
+        self.coord = Vector(coord)
+
+
+class PointCloud:
+    def __init__(self, points, projections):
+        self.points = points
+        self.projections = projections  # camera -> list of Projection, sorted by track id
+
+    class Filter:
+        ReprojectionError = "ReprojectionError"
+        ReconstructionUncertainty = "ReconstructionUncertainty"
+        ImageCount = "ImageCount"
+        ProjectionAccuracy = "ProjectionAccuracy"
+
+        def __init__(self):
+            self.point_cloud = None
+            self.values = []
+
+        def init(self, chunk, criterion):
+            # per point criterion value: maximum reprojection error (pix) for ReprojectionError, number of projections
+            # for ImageCount and a 0-1 spread for the others
+            self.point_cloud = chunk.point_cloud
+            points = self.point_cloud.points
+            track_ids = np.array([p.track_id for p in points], dtype=np.int64)
+            coords = np.array([list(p.coord) for p in points], dtype=float).reshape(-1, 4)
+            lookup = np.full(int(track_ids.max()) + 1 if len(track_ids) else 1, -1, dtype=np.int64)
+            lookup[track_ids] = np.arange(len(track_ids))
+
+            max_error = np.zeros(len(points))
+            count = np.zeros(len(points))
+            for camera in chunk.cameras:
+                projs = self.point_cloud.projections.get(camera, [])
+                if camera.transform is None or not projs:
+                    continue
+                ids = np.array([p.track_id for p in projs], dtype=np.int64)
+                uv = np.array([(p.coord.x, p.coord.y) for p in projs], dtype=float)
+                idx = lookup[ids]
+                keep = idx >= 0
+                idx, uv = idx[keep], uv[keep]
+                err = np.linalg.norm(project(coords[idx], camera.world_to_cam(), camera.sensor.calibration) - uv, axis=1)
+                np.maximum.at(max_error, idx, err)
+                np.add.at(count, idx, 1)
+
+            if criterion == self.ReprojectionError:
+                self.values = max_error.tolist()
+            elif criterion == self.ImageCount:
+                self.values = count.tolist()
+            else:
+                self.values = (np.arange(len(points)) % 997 / 997.).tolist()
+
+        def selectPoints(self, threshold):
+            for point, value in zip(self.point_cloud.points, self.values):
+                point.selected = point.valid and value > threshold
+
+        def removePoints(self, threshold):  # removed points stay in the list as invalid points
+            for point, value in zip(self.point_cloud.points, self.values):
+                if value > threshold:
+                    point.valid = False
+                    point.selected = False
+
+    def removeSelectedPoints(self):
+        for point in self.points:
+            if point.selected:
+                point.valid = False
+                point.selected = False
+
+
+class ChunkTransform:  # an unreferenced chunk: no matrix and no scale
+    def __init__(self, matrix=None, scale=None):
+        self.matrix, self.scale = matrix, scale
+
+
+class DenseCloud:
+    def __init__(self, point_count):
+        self.point_count = point_count
+
+
+# ---- chunk, document and application ----------------------------------------------------------------------------------
+
+class Chunk:
+    _next_key = 0
+
+    def __init__(self, cameras=None, markers=None, point_cloud=None, region=None, label="Chunk"):
+        Chunk._next_key += 1
+        self.key = Chunk._next_key
+        self.label = label
+        self.cameras = cameras or []
+        self.markers = markers or []
+        self.sensors = list(dict((id(c.sensor), c.sensor) for c in self.cameras).values())
+        self.point_cloud = point_cloud
+        self.region = region
+        self.dense_cloud = None
+        self.model = None
+        self.orthomosaic = None
+        self.elevation = None
+        self.crs = None
+        self.transform = ChunkTransform()
+        self.meta = {}
+        self.camera_location_accuracy = Vector([10, 10, 10])
+        self.marker_location_accuracy = Vector([0.005, 0.005, 0.005])
+        self.marker_projection_accuracy = 0.5
+        self.tiepoint_accuracy = 1.0
+        self.document = None
+
+    def copy(self):  # the copy shares the camera and tie point objects, and is added to the same document
+        region = Region(self.region.center, self.region.size, self.region.rot.array)
+        chunk = Chunk(list(self.cameras), list(self.markers), self.point_cloud, region, self.label + " Copy")
+        chunk.crs, chunk.transform, chunk.meta = self.crs, self.transform, dict(self.meta)
+        if self.document is not None:
+            self.document.append_chunk(chunk)
+        return chunk
+
+    def remove(self, items):
+        for item in items:
+            if item is self.dense_cloud:
+                self.dense_cloud = None
+            elif item in self.cameras:
+                self.cameras.remove(item)
+
+    def exportPoints(self, path, **kwargs):  # only the point count is written
+        with open(path, 'w') as f:
+            f.write(str(self.dense_cloud.point_count))
+
+    def importPoints(self, path, **kwargs):
+        with open(path, 'r') as f:
+            self.dense_cloud = DenseCloud(int(f.read()))
+
+    def resetRegion(self):
+        if self.point_cloud is None or not self.point_cloud.points:
+            return
+        coords = np.array([list(p.coord)[:3] for p in self.point_cloud.points if p.valid])
+        lo, hi = coords.min(axis=0), coords.max(axis=0)
+        self.region = Region((lo + hi) / 2., hi - lo, np.eye(3))
+
+    def optimizeCameras(self, **kwargs):
+        self.meta['optimize/fit_flags'] = " ".join(k[4:] for k, v in sorted(kwargs.items()) if v)
+
+    def buildDepthMaps(self, **kwargs):
+        pass
+
+    def buildDenseCloud(self, **kwargs):  # 100 dense points per valid tie point inside the region
+        points = [] if self.point_cloud is None else [list(p.coord)[:3] for p in self.point_cloud.points if p.valid]
+        coords = np.array(points, dtype=float).reshape(-1, 3)
+        local = (coords - np.array(list(self.region.center))) @ self.region.rot.array
+        inside = (np.abs(local) <= np.abs(list(self.region.size)) / 2.).all(axis=1)
+        self.dense_cloud = DenseCloud(int(inside.sum()) * 100)
+
+    def analyzePhotos(self, cameras=None, **kwargs):  # image quality drawn from a fixed distribution per camera
+        # one draw for the whole chunk, so a camera gets the same quality whether it is analysed alone or with all
+        quality = np.clip(np.random.default_rng(self.key).normal(0.75, 0.12, len(self.cameras)), 0.05, 1.2)
+        index = dict((id(c), i) for i, c in enumerate(self.cameras))
+        for camera in (self.cameras if cameras is None else cameras):
+            camera.meta["Image/Quality"] = str(round(float(quality[index[id(camera)]]), 6))
+
+    estimateImageQuality = analyzePhotos
+
+    def matchPhotos(self, **kwargs):
+        pass
+
+    def alignCameras(self, **kwargs):
+        pass
+
+
+class Document:
+    def __init__(self):
+        self.chunks = []
+        self.path = None
+        self.read_only = False
+
+        self.active = None
+
+    @property
+    def chunk(self):
+        if self.active in self.chunks:
+            return self.active
+        return self.chunks[0] if self.chunks else None
+
+    @chunk.setter
+    def chunk(self, chunk):
+        self.active = chunk
+
+    def append_chunk(self, chunk):
+        chunk.document = self
+        self.chunks.append(chunk)
+        return chunk
+
+    def addChunk(self):
+        return self.append_chunk(Chunk())
+
+    def remove(self, items):
+        for item in items:
+            if item in self.chunks:
+                self.chunks.remove(item)
+
+    def mergeChunks(self, chunks, merge_dense_clouds=False, **kwargs):
+        sources = [c for c in self.chunks if c.key in chunks]
+        merged = Chunk([cam for c in sources for cam in c.cameras], list(sources[0].markers), None,
+                       sources[0].region, "Merged Chunk")
+        if merge_dense_clouds:
+            merged.dense_cloud = DenseCloud(sum(c.dense_cloud.point_count for c in sources))
+        self.append_chunk(merged)
+
+    def open(self, path, read_only=False, **kwargs):
+        self.path, self.read_only = path, read_only
+
+    def save(self, path=None, chunks=None, **kwargs):
+        self.path = path or self.path
+
+
+class Settings:
+    def __init__(self):
+        self.values = {}
+
+    def setValue(self, key, value):
+        self.values[key] = value
+
+    def value(self, key):
+        return self.values.get(key)
+
+
+class Console:
+    def clear(self):
+        pass
+
+
+class Application:
+    def __init__(self):
+        self.document = Document()
+        self.settings = Settings()
+        self.console_pane = Console()
+        self.console = Console()
+        self.gpu_mask = 0
+        self.cpu_enable = True
+
+    def enumGPUDevices(self):
+        return []
+
+    def quit(self):
+        pass
+
+
+app = Application()
+
+# processing enums used as arguments by the scripts
+NoFiltering, MildFiltering, ModerateFiltering, AggressiveFiltering = range(4)
+DenseCloudData, PointsFormatPLY = "DenseCloudData", "PointsFormatPLY"
+
+
+def install():  # make "import Metashape" return this module
+    sys.modules["Metashape"] = sys.modules[__name__]
+    return sys.modules[__name__]
+
+
+# ---- synthetic chunks -------------------------------------------------------------------------------------------------
+
+def synthetic_chunk(n_cameras, n_points, proj_per_point=4, n_markers=0, unaligned=0.0, seed=0):
+    # n_cameras nadir cameras on a 20 m grid, 100 m above n_points tie points; each point is seen by up to
+    # proj_per_point random cameras (0.5 pix measurement noise, plus a few gross outliers); a fraction `unaligned`
+    # of the cameras has no transform
+    rng = np.random.default_rng(seed)
+    sensor = Sensor(Calibration(4000, 3000, 3500.0))
+
+    side = int(math.ceil(math.sqrt(n_cameras)))
+    cameras = []
+    for i in range(n_cameras):
+        transform = np.eye(4)
+        transform[:3, :3] = np.diag([1.0, -1.0, -1.0])  # camera looking down
+        transform[:3, 3] = (i % side * 20.0, i // side * 20.0, 100.0)
+        aligned = rng.random() >= unaligned
+        camera = Camera(i, "DJI_" + str(i).zfill(4), transform if aligned else None, sensor,
+                        Reference(transform[:3, 3] + rng.normal(0, 3, 3), [10, 10, 10]))
+        cameras.append(camera)
+
+    extent = side * 20.0
+    xyz = np.column_stack((rng.uniform(0, extent, n_points), rng.uniform(0, extent, n_points),
+                           rng.normal(0, 2, n_points), np.ones(n_points)))
+    track_ids = np.sort(rng.choice(n_points * 2, n_points, replace=False))  # sorted, with gaps, as in Metashape
+    valid = rng.random(n_points) > 0.05
+    points = [Point(int(t), c, bool(v)) for t, c, v in zip(track_ids, xyz, valid)]
+
+    per_camera = [[] for _ in cameras]
+    cam_idx = rng.integers(0, n_cameras, (n_points, proj_per_point))
+    for p in range(n_points):
+        for c in set(cam_idx[p].tolist()):
+            per_camera[c].append(p)
+
+    projections = {}
+    for c, camera in enumerate(cameras):
+        idx = np.array(per_camera[c], dtype=np.int64)
+        projections[camera] = []
+        if len(idx) == 0 or camera.transform is None:
+            continue
+        world_to_cam = np.linalg.inv(np.array(camera.transform.array))
+        uv = project(xyz[idx], world_to_cam, sensor.calibration) + rng.normal(0, 0.5, (len(idx), 2))
+        outliers = rng.random(len(idx)) < 0.01
+        uv[outliers] += rng.normal(0, 5, (int(outliers.sum()), 2))
+        projections[camera] = [Projection(int(track_ids[i]), coord) for i, coord in zip(idx, uv)]
+
+    markers = []
+    for m in range(n_markers):
+        location = (rng.uniform(0, extent), rng.uniform(0, extent), 0.)
+        marker = Marker(m, "GCP" + str(m + 1), Reference(location, [0.02, 0.02, 0.05], enabled=m % 4 != 3))
+        markers.append(marker)
+
+    center = (extent / 2., extent / 2., 0.)
+    region = Region(center, (extent * 0.8, extent * 0.8, 10.), np.eye(3))
+    return Chunk(cameras, markers, PointCloud(points, projections), region)
@@ -0,0 +1,195 @@
+#######################################################################################################################
+# ------ Benchmark suite: Python-side hot functions of the three workflow scripts on synthetic chunks -----------------
+#######################################################################################################################
+# The workflow scripts are imported with the fake_metashape stand-in installed as "Metashape", so the functions timed
+# are the ones the scripts really run. Each function is timed on every chunk size - the median over --batches batches
+# of the best of --repeat runs - and compared with the stored baseline (benchmarks/baseline.json); the suite exits
+# with status 1 if any function is slower than its baseline by more than --tolerance AND by more than --min-seconds.
+# The absolute floor keeps sub-10 ms cases, where a scheduler hiccup is a 2x "slowdown", from failing the suite; a
+# case over both limits is timed once more and only counts as a regression if the second timing agrees.
+#
+#   python benchmarks/run_benchmarks.py                       # compare with the baseline
+#   python benchmarks/run_benchmarks.py --update              # (re)write the baseline on this machine
+#   python benchmarks/run_benchmarks.py --sizes small --only calc_reprojection_error
+#
+# Baseline timings depend on the machine - write a new baseline (--update) before comparing on another computer.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import fake_metashape
+
+fake_metashape.install()
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+with contextlib.redirect_stdout(io.StringIO()):  # the scripts print their start time on import
+    import metashape_part1_SPC as part1
+    import metashape_part2_DPC as part2
+    import metashape_part3_Exp as part3
+from metashape_tiepoints import invalidate_snapshot
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+SIZES = {"small": (25, 5000), "medium": (100, 20000), "large": (400, 80000)}  # cameras, tie points
+
+
+# ---- cases: setup(chunk) returns the call to time; reset(chunk) restores the chunk between repeats -----------------
+
+def reset_points(chunk):
+    for point, valid in zip(chunk.point_cloud.points, chunk.original_valid):
+        point.valid = valid
+        point.selected = False
+    for camera in chunk.cameras:
+        camera.enabled = True
+    invalidate_snapshot(chunk)
+
+
+def case_preprocess(chunk, workdir):  # includes the stand-in analyzePhotos
+    return lambda: part1.preprocess("TRUE", 0.5, chunk, "NONE", "0.5,0.6,0.7,0.8,0.9", None)
+
+
+def case_calc_reprojection_error(chunk, workdir):
+    return lambda: part1.calc_reprojection_error(
+        part1.reprojection_errors(chunk, part1.tiepoint_snapshot(chunk), chunk.point_cloud.projections))
+
+
+def case_count_aligned(chunk, workdir):
+    return lambda: part1.count_aligned(chunk)
+
+
+def case_filter_reproj_err(chunk, workdir):  # includes the stand-in Filter.init, as Metashape's own filter would be
+    return lambda: part1.filter_reproj_err(chunk, 0.45)
+
+
+def case_build_DPC(chunk, workdir):  # depth maps and dense cloud are no-ops: this times the bounding box count
+    return lambda: part2.build_DPC(chunk, "LowestQuality", "FALSE", 80, "FALSE", 80)
+
+
+def case_check_markers(chunk, workdir):
+    return lambda: part2.check_markers(chunk)
+
+
+def case_create_settings_summary(chunk, workdir):
+    doc_title = "bench"
+    os.makedirs(os.path.join(workdir, doc_title + ".files"), exist_ok=True)
+    n_points = len(chunk.point_cloud.points)
+    s1 = [len(chunk.cameras), 2, 1.5, 0.61, 5, n_points, n_points // 10]
+    s2 = [n_points // 20, n_points // 2, n_points * 100, len(chunk.cameras) - 7]
+    for name, values in (("PhSc1", s1), ("PhSc2", s2)):
+        with open(os.path.join(workdir, doc_title + ".files", name + "_settings_TEMP.csv"), 'w') as f:
+            f.writelines("v" + str(i) + "," + str(v) + "\n" for i, v in enumerate(values))
+    return lambda: part3.create_settings_summary(chunk, workdir, doc_title, workdir, n_points * 90)
+
+
+CASES = [("preprocess", case_preprocess),
+         ("calc_reprojection_error", case_calc_reprojection_error),
+         ("count_aligned", case_count_aligned),
+         ("filter_reproj_err", case_filter_reproj_err),
+         ("build_DPC", case_build_DPC),
+         ("check_markers", case_check_markers),
+         ("create_settings_summary", case_create_settings_summary)]
+
+
+def make_chunk(size):
+    n_cameras, n_points = SIZES[size]
+    chunk = fake_metashape.synthetic_chunk(n_cameras, n_points, n_markers=8, unaligned=0.05)
+    chunk.original_valid = [p.valid for p in chunk.point_cloud.points]
+    return chunk
+
+
+def best_time(call, chunk, repeat):
+    times = []
+    for _ in range(repeat):
+        reset_points(chunk)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            call()
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def median_time(call, chunk, repeat, batches):  # median of the per-batch bests - one slow batch does not move it
+    times = sorted(best_time(call, chunk, repeat) for _ in range(batches))
+    return times[len(times) // 2]
+
+
+def is_regression(seconds, base, args):
+    return seconds > base * (1 + args.tolerance) and seconds - base > args.min_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the workflow scripts on synthetic chunks")
+    parser.add_argument("--update", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed slowdown as a fraction of the baseline (default 0.5 = 50%%)")
+    parser.add_argument("--min-seconds", type=float, default=0.02,
+                        help="slowdowns smaller than this are treated as timing noise (default 0.02)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per batch, the best one counts")
+    parser.add_argument("--batches", type=int, default=5, help="batches per case, the median one counts")
+    parser.add_argument("--sizes", default=",".join(SIZES))
+    parser.add_argument("--only", default=None, help="comma separated function names")
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(",")
+    only = args.only.split(",") if args.only else None
+
+    baseline = {"results": {}}
+    if os.path.isfile(BASELINE):
+        with open(BASELINE, 'r') as f:
+            baseline = json.load(f)
+
+    workdir = tempfile.mkdtemp(prefix="metashape_bench_")
+    results = {}
+    regressions = []
+    print("{:<26} {:>7} {:>11} {:>11} {:>8}".format("function", "size", "time (s)", "base (s)", "ratio"))
+    try:
+        for size in sizes:
+            chunk = make_chunk(size)
+            for name, case in CASES:
+                if only and name not in only:
+                    continue
+                key = name + "/" + size
+                call = case(chunk, workdir)
+                seconds = median_time(call, chunk, args.repeat, args.batches)
+
+                base = baseline["results"].get(key)
+                if base is not None and not args.update and is_regression(seconds, base, args):
+                    seconds = min(seconds, median_time(call, chunk, args.repeat, args.batches))  # confirm it
+                results[key] = round(seconds, 6)
+                if base is None:
+                    print("{:<26} {:>7} {:>11.4f} {:>11} {:>8}".format(name, size, seconds, "-", "-"))
+                    continue
+                ratio = seconds / base if base > 0 else float("inf")
+                flag = ""
+                if is_regression(seconds, base, args):
+                    regressions.append(key)
+                    flag = "  REGRESSION"
+                print("{:<26} {:>7} {:>11.4f} {:>11.4f} {:>7.2f}x{}".format(name, size, seconds, base, ratio, flag))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.update:
+        baseline["machine"] = platform.platform() + " / Python " + platform.python_version()
+        baseline["results"].update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print("baseline written: " + BASELINE)
+        return 0
+
+    if regressions:
+        print(str(len(regressions)) + " regression(s) against the baseline (" + baseline.get("machine", "?") + "): " +
+              ", ".join(regressions))
+        return 1
+    print("no regressions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+#######################################################################################################################
+# ------ Test: tiled dense cloud (part 2 Tiling) against the untiled build, through to the part 3 settings summary ----
+#######################################################################################################################
+# The same synthetic project is run through part 2 once with build_DPC and once with plan_tiles / build_tile /
+# merge_tiles (fake_metashape stand-in, no Metashape needed). The tiled run must leave the document as the untiled one
+# does - one chunk with its own cameras and reference settings and the whole dense cloud - so part 3's
+# create_settings_summary writes the same project summary.
+# run with:  python benchmarks/test_tiled_dense_cloud.py   (or python -m pytest benchmarks/test_tiled_dense_cloud.py)
+
+import contextlib
+import csv
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+import fake_metashape
+
+fake_metashape.install()
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+with contextlib.redirect_stdout(io.StringIO()):  # the scripts print their start time on import
+    import metashape_part2_DPC as part2
+    import metashape_part3_Exp as part3
+from metashape_batch import part_progress, part_stages
+from metashape_save import SaveManager
+from metashape_stages import StageRunner
+
+DOC_TITLE = "tiling_test"
+
+
+def project(home):  # a document with one aligned chunk, reference settings as part 1 leaves them, part 1 settings
+    doc = fake_metashape.Document()
+    chunk = doc.append_chunk(fake_metashape.synthetic_chunk(64, 8000, n_markers=4, seed=3))
+    chunk.label = "Chunk 1"
+    chunk.camera_location_accuracy = fake_metashape.Vector([20, 20, 50])
+    chunk.marker_location_accuracy = fake_metashape.Vector([0.02, 0.02, 0.05])
+    chunk.marker_projection_accuracy = 2
+    chunk.tiepoint_accuracy = 1.37
+    os.makedirs(home + "/" + DOC_TITLE + ".files")
+    with open(home + "/" + DOC_TITLE + ".files/PhSc1_settings_TEMP.csv", 'w', newline='') as f:
+        csv.writer(f).writerows([["n_cams", 64], ["n_removed_QF", 0], ["perc_removed_QF", 0], ["qual_thresh", 0.5],
+                                 ["n_not_aligned", 0], ["n_points_orig", 8000], ["n_points_REF", 400]])
+    return doc, chunk
+
+
+def run_part2(home, tiled):  # the part 2 dense cloud stages, then part 3's summary - returns (doc, chunk, summary rows)
+    doc, chunk = project(home)
+    n_cameras = len(chunk.cameras)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if tiled:
+            n_cams, n_spc, outside = part2.prepare_DPC(chunk, "FALSE", 80, "FALSE", 80)
+            tiles = part2.plan_tiles(doc, chunk, "LowestQuality", 16, "NONE", 5)
+            for label, n_tile_cameras in tiles:
+                part2.build_tile(doc, label, "LowestQuality")
+            n_dpc, tile_rows = part2.merge_tiles(doc, chunk, tiles, home + "/" + DOC_TITLE + ".files/merged.ply")
+            assert len(tiles) > 1
+        else:
+            n_cams, n_spc, n_dpc, outside = part2.build_DPC(chunk, "LowestQuality", "FALSE", 80, "FALSE", 80)
+            tile_rows = []
+        part2.export_settings(home, DOC_TITLE, outside, n_spc, n_dpc, n_cams, 0, tile_rows)
+        part3.create_settings_summary(doc.chunk, home, DOC_TITLE, home, doc.chunk.dense_cloud.point_count)
+    assert len(chunk.cameras) == n_cameras
+    with open(home + "/" + DOC_TITLE + "_project_settings.csv", 'r') as f:
+        return doc, chunk, list(csv.reader(f))
+
+
+def test_tiled_matches_untiled():
+    homes = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    try:
+        doc, chunk, untiled = run_part2(homes[0], False)
+        doc, chunk, tiled = run_part2(homes[1], True)
+        assert doc.chunks == [chunk] and doc.chunk is chunk  # no tile or merged chunks left, part 3 uses the source
+        assert not os.path.isfile(homes[1] + "/" + DOC_TITLE + ".files/merged.ply")
+        assert tiled == untiled, "\n".join(str(a) + " != " + str(b) for a, b in zip(tiled, untiled) if a != b)
+    finally:
+        for home in homes:
+            shutil.rmtree(home)
+
+
+def test_replanning_removes_old_chunks():  # a second plan leaves no tiles or merged chunk of the first one behind
+    home = tempfile.mkdtemp()
+    try:
+        doc, chunk = project(home)
+        with contextlib.redirect_stdout(io.StringIO()):
+            part2.plan_tiles(doc, chunk, "LowestQuality", 16, "NONE", 5)
+            doc.mergeChunks(chunks=[c.key for c in doc.chunks[1:]], merge_dense_clouds=False)
+            doc.chunks[-1].label = chunk.label + " merged"  # left by a run that stopped inside merge_tiles
+            tiles = part2.plan_tiles(doc, chunk, "LowestQuality", 16, "NONE", 5)
+        assert [c.label for c in doc.chunks] == [chunk.label] + [label for label, n in tiles]
+
+        for camera in chunk.cameras:
+            camera.enabled = False
+        try:
+            part2.plan_tiles(doc, chunk, "LowestQuality", 16, "NONE", 5)
+        except RuntimeError as e:
+            assert "no aligned and enabled cameras" in str(e)
+        else:
+            raise AssertionError("plan_tiles without cameras did not fail")
+    finally:
+        shutil.rmtree(home)
+
+
+def test_tile_batches():  # Tiling_Tiles_Per_Run: each run saves and records its tiles, then stops before the next
+    home = tempfile.mkdtemp()
+    try:
+        doc, chunk = project(home)
+        with contextlib.redirect_stdout(io.StringIO()):
+            tiles = part2.plan_tiles(doc, chunk, "LowestQuality", 16, "NONE", 5)
+            progress = []
+            for run in range(3):
+                runner = StageRunner(home, DOC_TITLE, "part2", restart=False, explain=False)
+                saves = SaveManager(doc, home, DOC_TITLE, "part2", "exit", runner=runner)  # no saves at checkpoints
+                done = part2.build_tiles(runner, saves, doc, tiles, "LowestQuality", "2")
+                if done:  # the run goes on to merge the tiles and saves at the end
+                    saves.finish()
+                progress.append((done, part_progress(home, DOC_TITLE, 2), saves.dirty))
+        assert len(tiles) == 4
+        # run 1 stops with its 2 tiles saved and recorded, run 2 builds the other 2, run 3 finds every tile built
+        assert progress == [(False, 2, False), (True, 4, False), (True, 4, False)], progress
+        assert all(e["saved"] for e in part_stages(home, DOC_TITLE, 2))
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    for test in (test_tiled_matches_untiled, test_replanning_removes_old_chunks, test_tile_batches):
+        test()
+        print(test.__name__ + " passed")
@@ -0,0 +1,140 @@
+#######################################################################################################################
+# ------ Test: file-backed work queue (metashape_queue.py) with several local worker processes ------------------------
+#######################################################################################################################
+# Workers on one machine claim tasks exactly like workers on several nodes, so the queue is exercised here with a few
+# worker processes on a temporary queue directory and short leases. No Metashape needed.
+# run with:  python benchmarks/test_work_queue.py   (or python -m pytest benchmarks/test_work_queue.py)
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metashape_queue import WorkQueue, read_json, worker_process
+
+LEASE = 2.
+# appends the task name to a shared file - every line is one run
+RECORD = "import sys; f = open(sys.argv[1], 'a'); f.write(sys.argv[2] + '\\n'); f.close()"
+
+
+def run_workers(root, n, idle_exit=1.):
+    workers = [Process(target=worker_process, args=(root, LEASE, idle_exit, 0.05, i)) for i in range(n)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+def runs(path):
+    with open(path, 'r') as f:
+        return f.read().split()
+
+
+def test_claim_exclusivity():  # 40 tasks, 4 workers: every task runs exactly once
+    root = tempfile.mkdtemp()
+    try:
+        queue = WorkQueue(root, LEASE)
+        record = os.path.join(root, "runs.txt")
+        names = ["task" + str(i) for i in range(40)]
+        for name in names:
+            queue.add(name, [sys.executable, "-c", RECORD, record, name])
+        run_workers(root, 4)
+        assert sorted(runs(record)) == sorted(names)
+        assert len(queue.ids("done")) == 40 and not queue.ids("pending") and not queue.ids("claimed")
+    finally:
+        shutil.rmtree(root)
+
+
+def test_dependencies():  # a chained task runs after the one it waits for; a task after a failed one fails
+    root = tempfile.mkdtemp()
+    try:
+        queue = WorkQueue(root, LEASE)
+        record = os.path.join(root, "runs.txt")
+        first = queue.add("first", [sys.executable, "-c", RECORD, record, "first"])
+        queue.add("second", [sys.executable, "-c", RECORD, record, "second"], [first])
+        broken = queue.add("broken", [sys.executable, "-c", "raise SystemExit(1)"], max_attempts=1)
+        blocked = queue.add("blocked", [sys.executable, "-c", RECORD, record, "blocked"], [broken])
+        run_workers(root, 3)
+        assert runs(record) == ["first", "second"]
+        assert queue.ids("failed") == sorted([broken, blocked])
+    finally:
+        shutil.rmtree(root)
+
+
+def test_lease_expiry_and_requeue():  # the task of a worker that stopped responding is run by another worker
+    root = tempfile.mkdtemp()
+    try:
+        queue = WorkQueue(root, LEASE)
+        record = os.path.join(root, "runs.txt")
+        task_id = queue.add("orphan", [sys.executable, "-c", RECORD, record, "orphan"])
+        task = queue.claim()  # a worker claims it and starts its run ...
+        task["attempts"] += 1
+        assert queue.finish(task, "claimed")
+        old = time.time() - 2 * LEASE  # ... then its heartbeat stops
+        os.utime(queue.path("claimed", task_id), (old, old))
+
+        queue.expire_leases()
+        assert queue.ids("pending") == [task_id] and not queue.ids("claimed")
+
+        # the dead worker's late result must not bring the task back to claimed/ or done/
+        assert not queue.finish(task, "done")
+        assert queue.ids("pending") == [task_id] and not queue.ids("claimed") and not queue.ids("done")
+
+        run_workers(root, 2)
+        done = read_json(queue.path("done", task_id))
+        assert runs(record) == ["orphan"] and done["attempts"] == 2
+    finally:
+        shutil.rmtree(root)
+
+
+def test_half_finished_task_is_requeued():  # a worker that died inside finish() leaves a private file behind
+    root = tempfile.mkdtemp()
+    try:
+        queue = WorkQueue(root, LEASE)
+        task_id = queue.add("halfway", [sys.executable, "-c", "pass"])
+        queue.claim()
+        owned = os.path.join(root, "claimed", task_id + ".dead.owned")
+        os.rename(queue.path("claimed", task_id), owned)
+        queue.expire_leases()
+        assert os.path.isfile(owned)  # still within the lease
+        old = time.time() - 2 * LEASE
+        os.utime(owned, (old, old))
+        queue.expire_leases()
+        assert queue.ids("pending") == [task_id] and not os.listdir(os.path.join(root, "claimed"))
+    finally:
+        shutil.rmtree(root)
+
+
+def test_attempt_counting():  # a failing task is retried max_attempts times, then stays in failed/
+    root = tempfile.mkdtemp()
+    try:
+        queue = WorkQueue(root, LEASE)
+        record = os.path.join(root, "runs.txt")
+        command = "import sys; f = open(sys.argv[1], 'a'); f.write('try\\n'); f.close(); sys.exit(1)"
+        task_id = queue.add("flaky", [sys.executable, "-c", command, record], max_attempts=3)
+        run_workers(root, 2)
+        failed = read_json(queue.path("failed", task_id))
+        assert len(runs(record)) == 3 and failed["attempts"] == 3 and len(failed["runs"]) == 3
+
+        # a task whose lease expires on its last attempt is not run again
+        task_id = queue.add("last", [sys.executable, "-c", "pass"], max_attempts=1)
+        task = queue.claim()
+        task["attempts"] += 1
+        assert queue.finish(task, "claimed")
+        old = time.time() - 2 * LEASE
+        os.utime(queue.path("claimed", task_id), (old, old))
+        queue.expire_leases()
+        assert os.path.isfile(queue.path("failed", task_id))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    for test in (test_claim_exclusivity, test_dependencies, test_lease_expiry_and_requeue,
+                 test_half_finished_task_is_requeued, test_attempt_counting):
+        start = time.time()
+        test()
+        print(test.__name__ + " passed (" + str(round(time.time() - start, 1)) + " s)")
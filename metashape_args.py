@@ -0,0 +1,17 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: command line options of the workflow scripts -------------------------------------
+#######################################################################################################################
+# The three scripts are run inside Metashape (metashape -r <script> [options]) and read their options straight from
+# sys.argv:
+#   --input <file>  - the project's input file (default: the input_file.csv next to the script)
+#   --restart / --explain - see metashape_stages.py
+
+import sys
+
+
+def input_file_path(default):  # the --input <file> given to a script, else the input_file.csv next to it
+    if "--input" in sys.argv:
+        i = sys.argv.index("--input")
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1].replace('\\', '/')
+    return default
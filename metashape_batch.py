@@ -0,0 +1,229 @@
+#######################################################################################################################
+# ------ Metashape workflow: multi-project batch scheduler ------------------------------------------------------------
+#######################################################################################################################
+# Runs parts 1, 2 and 3 of many projects from a manifest, with at most --workers Metashape processes at a time.
+# Each project has its own input file, given to the scripts with --input (the scripts still default to the
+# input_file.csv next to them). Run with a normal Python 3 interpreter (not inside Metashape):
+#   python metashape_batch.py manifest.csv --metashape /opt/metashape-pro/metashape.sh --workers 4
+#
+# manifest.csv columns (one row per project):
+#   name        - project name used in the logs and summary
+#   input_file  - path of the project's input_file.csv
+#   parts       - parts to run, e.g. 123, 1 or 23
+#   part2_after - file that must exist before part 2 starts (REVIEW = <home>/<doc_title>_part1_reviewed, NONE)
+#   part3_after - the same for part 3 (REVIEW = <home>/<doc_title>_part2_reviewed, NONE)
+# e.g.  Sev_SEG_20180531,D:/Sev_SEG_20180531/input_file.csv,123,REVIEW,NONE
+#
+# A part counts as finished when its last stage (export_settings / create_settings_summary) is complete in the
+# project's stage ledger. A part that exits after completing some of its stages but not the last one (e.g. part 2
+# building a few tiles per run, see Tiling_Tiles_Per_Run) is queued again straight away; a part that fails, or stops
+# without completing any stage, is retried up to --retries times. Whenever a worker is free the next runnable part is
+# started, in manifest order. Parts waiting for a review flag are checked every --poll seconds; with --no-wait the
+# scheduler stops once only such parts are left - run it again after the review and finished parts are skipped.
+#
+# Every run is logged to <manifest folder>/batch_logs/ and the results are collected in batch_summary.csv (one row per
+# part run: status, exit code, start, end and minutes; parts left waiting for a review name the flag file in the log
+# column) and printed at the end.
+
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+SCRIPTS = {1: "metashape_part1_SPC.py", 2: "metashape_part2_DPC.py", 3: "metashape_part3_Exp.py"}
+FINAL_STAGES = {1: "export_settings", 2: "export_settings", 3: "create_settings_summary"}
+SUMMARY_COLUMNS = ["project", "part", "attempt", "status", "exit_code", "start", "end", "minutes", "log"]
+
+
+def read_settings(input_file):  # (home, doc_title) from a project's input file
+    with open(input_file, 'r') as f:
+        values = [row[1] for row in csv.reader(f)]
+    return values[1], values[2]
+
+
+def part_stages(home, doc_title, part):  # the part's entries in the project's stage ledger
+    path = home + '/' + doc_title + '.files/stage_ledger.json'
+    try:
+        with open(path, 'r') as f:
+            stages = json.load(f)["stages"]
+    except (OSError, ValueError, KeyError):
+        return []
+    return [e for e in stages if e.get("part") == "part" + str(part)]
+
+
+def part_finished(home, doc_title, part):  # the last stage of the part is complete in the stage ledger
+    return any(e["name"] == FINAL_STAGES[part] and e["status"] == "complete" for e in part_stages(home, doc_title, part))
+
+
+def part_progress(home, doc_title, part):  # number of completed stages of the part
+    return sum(1 for e in part_stages(home, doc_title, part) if e["status"] == "complete")
+
+
+class Project:
+
+    def __init__(self, row):
+        self.name = row["name"]
+        self.input_file = row["input_file"]
+        self.home, self.doc_title = read_settings(self.input_file)
+        self.parts = [int(p) for p in row.get("parts", "123").strip()]
+        self.flags = {2: self.flag_path(row.get("part2_after", "NONE"), 1),
+                      3: self.flag_path(row.get("part3_after", "NONE"), 2)}
+        self.attempts = dict((p, 0) for p in self.parts)
+        self.failed = False
+
+    def flag_path(self, value, after_part):
+        value = (value or "NONE").strip()
+        if value == "NONE":
+            return None
+        if value == "REVIEW":
+            return self.home + "/" + self.doc_title + "_part" + str(after_part) + "_reviewed"
+        return value
+
+    def next_part(self):  # first part still to run, or None when all are finished
+        for part in self.parts:
+            if not part_finished(self.home, self.doc_title, part):
+                return part
+        return None
+
+    def waiting_for(self, part):  # the review flag the part still waits for, or None
+        flag = self.flags.get(part)
+        return flag if flag is not None and not os.path.exists(flag) else None
+
+
+class Scheduler:
+
+    def __init__(self, projects, metashape, workers, retries, poll, log_dir, summary_path, wait):
+        self.projects = projects
+        self.metashape = metashape
+        self.workers = workers
+        self.retries = retries
+        self.poll = poll
+        self.log_dir = log_dir
+        self.summary_path = summary_path
+        self.wait = wait
+        self.running = {}  # project name -> (project, part, process, start, log path, log file, progress)
+        self.rows = []
+
+    def command(self, project, part):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SCRIPTS[part])
+        return [self.metashape, "-r", script, "--input", project.input_file]
+
+    def start(self, project, part):
+        project.attempts[part] += 1
+        log_path = os.path.join(self.log_dir, project.name + "_part" + str(part) + "_" +
+                                str(project.attempts[part]) + ".log")
+        log = open(log_path, 'w')
+        process = subprocess.Popen(self.command(project, part), stdout=log, stderr=subprocess.STDOUT)
+        self.running[project.name] = (project, part, process, datetime.now(), log_path, log,
+                                      part_progress(project.home, project.doc_title, part))
+        print(str(datetime.now()) + " started " + project.name + " part " + str(part) + " (attempt " +
+              str(project.attempts[part]) + ", " + str(len(self.running)) + "/" + str(self.workers) + " workers)")
+
+    def record(self, project, part, status, exit_code=None, start=None, log_path=""):
+        end = datetime.now()
+        minutes = round((end - start).total_seconds() / 60., 2) if start is not None else ""
+        self.rows.append([project.name, part, project.attempts.get(part, 0), status, exit_code,
+                          str(start) if start is not None else "", str(end), minutes, log_path])
+        self.write_summary()
+
+    def collect(self):  # record the parts that have exited
+        for name, (project, part, process, start, log_path, log, progress) in list(self.running.items()):
+            code = process.poll()
+            if code is None:
+                continue
+            log.close()
+            del self.running[name]
+            if part_finished(project.home, project.doc_title, part):
+                status = "finished"
+            elif code == 0 and part_progress(project.home, project.doc_title, part) > progress:
+                status = "incomplete"  # e.g. a batch of tiles - runs again
+            else:  # crashed, or stopped without completing any stage (e.g. markers not placed)
+                status = "failed"
+                if project.attempts[part] > self.retries:
+                    project.failed = True
+            print(str(datetime.now()) + " " + project.name + " part " + str(part) + " " + status +
+                  " (exit code " + str(code) + ")")
+            self.record(project, part, status, code, start, log_path)
+
+    def ready(self):  # [(project, part)] that can start now, and the number waiting for a review flag
+        ready, waiting = [], 0
+        for project in self.projects:
+            if project.failed or project.name in self.running:
+                continue
+            part = project.next_part()
+            if part is None:
+                continue
+            if project.waiting_for(part) is not None:
+                waiting += 1
+                continue
+            ready.append((project, part))
+        return ready, waiting
+
+    def run(self):
+        while True:
+            self.collect()
+            ready, waiting = self.ready()
+            for project, part in ready[:self.workers - len(self.running)]:
+                self.start(project, part)
+            if not self.running and not ready:
+                if waiting and self.wait:
+                    time.sleep(self.poll)
+                    continue
+                break
+            time.sleep(min(self.poll, 10))
+
+        for project in self.projects:  # parts left waiting for a review
+            part = project.next_part()
+            if part is not None and not project.failed and project.waiting_for(part) is not None:
+                print(project.name + " part " + str(part) + " waiting for " + project.waiting_for(part))
+                self.record(project, part, "waiting", log_path=project.waiting_for(part))
+        return self
+
+    def write_summary(self):
+        with open(self.summary_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(SUMMARY_COLUMNS)
+            writer.writerows(self.rows)
+
+    def report(self):
+        print("{:<24} {:>4} {:>7} {:<12} {:>9}".format("project", "part", "attempt", "status", "minutes"))
+        for row in self.rows:
+            print("{:<24} {:>4} {:>7} {:<12} {:>9}".format(row[0][:24], row[1], row[2], row[3][:12], row[7]))
+        for project in self.projects:
+            minutes = sum(r[7] for r in self.rows if r[0] == project.name and r[7] != "")
+            print(project.name + ": " + str(round(minutes, 1)) + " minutes of Metashape time")
+        print("summary written to " + self.summary_path)
+
+
+def read_manifest(path):
+    with open(path, 'r') as f:
+        return [Project(row) for row in csv.DictReader(f) if row.get("name", "").strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Metashape workflow for the projects in a manifest")
+    parser.add_argument("manifest")
+    parser.add_argument("--metashape", required=True, help="Metashape executable (metashape.sh / metashape.exe)")
+    parser.add_argument("--workers", type=int, default=2, help="Metashape processes run at the same time")
+    parser.add_argument("--retries", type=int, default=1, help="times a failed part is run again")
+    parser.add_argument("--poll", type=float, default=60., help="seconds between checks for review flag files")
+    parser.add_argument("--no-wait", dest="wait", action="store_false",
+                        help="stop when only parts waiting for a review flag are left")
+    args = parser.parse_args()
+
+    folder = os.path.dirname(os.path.abspath(args.manifest))
+    log_dir = os.path.join(folder, "batch_logs")
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    scheduler = Scheduler(read_manifest(args.manifest), args.metashape, args.workers, args.retries, args.poll, log_dir,
+                          os.path.join(folder, "batch_summary.csv"), args.wait)
+    scheduler.run().report()
+    return 1 if any(p.failed for p in scheduler.projects) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: per-camera diagnostics -----------------------------------------------------------
+#######################################################################################################################
+# Keeps the per-camera reprojection error (RMSE), the number of tie points used for it and the number of projections
+# as arrays and flags outlier cameras with robust statistics, so that a single bad camera can't shift the threshold:
+#   z = (value - median) / (1.4826 x median absolute deviation)
+# A camera is flagged if its RMSE z score is above the limit, if its tie point count (log scale) is below -limit,
+# or if it has no valid tie points at all.
+
+import csv
+import math
+
+import numpy as np
+
+MAD_SCALE = 1.4826  # MAD -> standard deviation for normally distributed values
+COLUMNS = ["camera", "enabled", "rmse_pix", "rmse_z", "n_tiepoints", "n_projections", "tiepoint_z", "flagged",
+           "reason"]
+
+
+def robust_z(values):  # robust z scores (nan stays nan); all zero if the values have no spread
+    values = np.asarray(values, dtype=float)
+    z = np.full(len(values), np.nan)
+    finite = np.isfinite(values)
+    if not finite.any():
+        return z
+    median = np.median(values[finite])
+    mad = np.median(np.abs(values[finite] - median)) * MAD_SCALE
+    z[finite] = (values[finite] - median) / mad if mad > 0 else 0.
+    return z
+
+
+class CameraDiagnostics:
+
+    def __init__(self, errors, projections, z_limit=3.5):
+        # errors - metashape_tiepoints.ReprojectionErrors of the chunk
+        self.cameras = errors.cameras
+        self.rmse = errors.camera_rmse
+        self.n_tiepoints = errors.camera_nproj
+        self.n_projections = np.array([len(projections[c]) for c in self.cameras], dtype=np.int64)
+        self.z_limit = z_limit
+
+        self.rmse_z = robust_z(self.rmse)
+        self.tiepoint_z = robust_z(np.log1p(self.n_tiepoints))
+        self.high_error = np.nan_to_num(self.rmse_z) > z_limit
+        self.few_tiepoints = np.nan_to_num(self.tiepoint_z) < -z_limit
+        self.no_tiepoints = self.n_tiepoints == 0
+        self.flagged = self.high_error | self.few_tiepoints | self.no_tiepoints
+
+    def reason(self, i):
+        reasons = []
+        if self.no_tiepoints[i]:
+            reasons.append("no valid tie points")
+        if self.high_error[i]:
+            reasons.append("high reprojection error")
+        if self.few_tiepoints[i] and not self.no_tiepoints[i]:
+            reasons.append("few tie points")
+        return "; ".join(reasons)
+
+    def mean_rmse(self):  # mean RMSE (pix) of the cameras that are not flagged
+        keep = ~self.flagged & np.isfinite(self.rmse)
+        return float(self.rmse[keep].mean()) if keep.any() else float("nan")
+
+    def disable_flagged(self):  # returns the number of cameras disabled
+        n_disabled = 0
+        for i in np.flatnonzero(self.flagged):
+            if self.cameras[i].enabled:
+                self.cameras[i].enabled = False
+                n_disabled += 1
+        return n_disabled
+
+    def write_table(self, path):  # one row per aligned camera, worst RMSE first
+        order = np.argsort(-np.nan_to_num(self.rmse, nan=np.inf), kind="stable")
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            for i in order:
+                writer.writerow([self.cameras[i].label, "TRUE" if self.cameras[i].enabled else "FALSE",
+                                 round(float(self.rmse[i]), 4) if not math.isnan(self.rmse[i]) else "",
+                                 round(float(self.rmse_z[i]), 2) if not math.isnan(self.rmse_z[i]) else "",
+                                 int(self.n_tiepoints[i]), int(self.n_projections[i]),
+                                 round(float(self.tiepoint_z[i]), 2), "TRUE" if self.flagged[i] else "FALSE",
+                                 self.reason(i)])
+
+    def report(self):
+        finite = np.isfinite(self.rmse)
+        print("camera diagnostics: " + str(len(self.cameras)) + " aligned cameras, median RMSE " +
+              (str(round(float(np.median(self.rmse[finite])), 3)) if finite.any() else "-") + " pix, " +
+              str(int(np.count_nonzero(self.flagged))) + " flagged (|z| > " + str(self.z_limit) + ")")
+        for i in np.flatnonzero(self.flagged):
+            print("  flagged camera " + self.cameras[i].label + ": " + self.reason(i) + " (RMSE " +
+                  str(round(float(self.rmse[i]), 3)) + " pix, " + str(int(self.n_tiepoints[i])) + " tie points)")
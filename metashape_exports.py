@@ -0,0 +1,168 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: concurrent product exports -------------------------------------------------------
+#######################################################################################################################
+# The exports of part 3 (dense cloud LAZ, textured model, orthomosaic and DSM GeoTIFFs, PDF report) only read the
+# project, so once the builds are saved they can run side by side. With Export_Workers set, part 3 writes one job file
+# per export and runs each in its own worker process, started the way the batch runner starts the parts:
+#   <metashape> -r metashape_part3_Exp.py --export-worker <job.json> <result.json>
+# (or <python> metashape_part3_Exp.py ... when part 3 itself runs in a Python with the stand-alone Metashape module -
+# that interpreter is checked once to import Metashape, otherwise the exports run one after the other).
+# The worker opens the .psx with read_only=True, calls the export function on doc.chunk and writes its wall time,
+# status and error (if any) to the result file. All results are collected in <doc_title>_export_results.csv.
+#
+# Each export worker holds its own copy of the chunk data it exports, so the number of workers running at once is
+#   min(Export_Workers, number of exports, available memory / Export_Worker_Memory_GB)
+# (Export_Workers AUTO = one per core), and at least one.
+
+import csv
+import json
+import os
+import subprocess
+import sys
+import time
+import traceback
+from datetime import datetime
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+RESULT_COLUMNS = ["export", "status", "seconds", "started", "worker_exit_code", "output", "error", "log"]
+
+
+def available_memory_gb():  # memory that can be used without swapping, or None if unknown
+    if psutil is not None:
+        return psutil.virtual_memory().available / 1024. ** 3
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024. ** 2
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def export_workers(requested, memory_per_worker_gb, n_jobs):  # number of worker processes to run at once
+    if requested in (None, "", "NONE", "FALSE", "0"):
+        return 1
+    workers = (os.cpu_count() or 1) if requested == "AUTO" else int(requested)
+    available = available_memory_gb()
+    if available is not None and memory_per_worker_gb not in (None, "", "NONE"):
+        by_memory = int(available // float(memory_per_worker_gb))
+        if by_memory < workers:
+            print("export workers limited to " + str(max(1, by_memory)) + " by available memory (" +
+                  str(round(available, 1)) + " GB, " + str(memory_per_worker_gb) + " GB per worker)")
+        workers = by_memory
+    return max(1, min(workers, n_jobs))
+
+
+def worker_command(executable=None):  # the command line before the script for an export worker, or None
+    executable = executable or sys.executable
+    if not os.path.basename(executable).lower().startswith("python"):
+        return [executable, "-r"]  # part 3 runs inside Metashape: the workers run their script with it too
+    try:
+        status = subprocess.call([executable, "-c", "import Metashape"], stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+    except OSError:
+        status = None
+    return [executable] if status == 0 else None
+
+
+class ExportFanOut:
+
+    def __init__(self, script, project, command, job_dir, workers):
+        self.script = script  # the part 3 script, run with --export-worker
+        self.project = project  # .psx opened read-only by the workers
+        self.command = command  # from worker_command()
+        self.job_dir = job_dir
+        self.workers = workers
+        self.jobs = []  # [(name, function name, args)]
+        self.results = {}  # name -> result dict
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+
+    def add(self, name, function, *args):  # args: everything the export function takes after chunk
+        self.jobs.append((name, function, list(args)))
+
+    def start(self, name, function, args):
+        job_path = os.path.join(self.job_dir, name + "_job.json")
+        result_path = os.path.join(self.job_dir, name + "_result.json")
+        log_path = os.path.join(self.job_dir, name + ".log")
+        if os.path.isfile(result_path):
+            os.remove(result_path)
+        with open(job_path, 'w') as f:
+            json.dump({"name": name, "project": self.project, "function": function, "args": args}, f, indent=1)
+        log = open(log_path, 'w')
+        process = subprocess.Popen(self.command + [self.script, "--export-worker", job_path, result_path],
+                                   stdout=log, stderr=subprocess.STDOUT)
+        print(str(datetime.now()) + " started export " + name)
+        return process, log, result_path, log_path, time.time()
+
+    def finished(self, name, process, log, result_path, log_path, start):
+        log.close()
+        try:
+            with open(result_path, 'r') as f:
+                result = json.load(f)
+        except (OSError, ValueError):  # the worker died before writing its result
+            result = {"status": "failed", "seconds": round(time.time() - start, 3),
+                      "started": str(datetime.fromtimestamp(start)), "output": None,
+                      "error": "worker exited with code " + str(process.returncode) + " - see " + log_path}
+        result.update(export=name, worker_exit_code=process.returncode, log=log_path)
+        self.results[name] = result
+        print(str(datetime.now()) + " export " + name + " " + result["status"] + " (" + str(result["seconds"]) + " s)")
+
+    def run(self):
+        queue = list(self.jobs)
+        running = {}
+        while queue or running:
+            while queue and len(running) < self.workers:
+                name, function, args = queue.pop(0)
+                running[name] = self.start(name, function, args)
+            time.sleep(0.5)
+            for name, job in list(running.items()):
+                if job[0].poll() is not None:
+                    del running[name]
+                    self.finished(name, *job)
+        return self
+
+    def result(self, name):  # the export's output path; raises if the export failed
+        result = self.results[name]
+        if result["status"] != "complete":
+            raise RuntimeError("export " + name + " failed: " + str(result["error"]))
+        return result["output"]
+
+    def write_table(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(RESULT_COLUMNS)
+            for name, function, args in self.jobs:
+                r = self.results.get(name, {})
+                writer.writerow([name] + [r.get(c) for c in RESULT_COLUMNS[1:]])
+
+    def report(self, wall):
+        total = sum(r["seconds"] for r in self.results.values())
+        failed = [n for n, r in self.results.items() if r["status"] != "complete"]
+        print(str(len(self.results)) + " exports with " + str(self.workers) + " workers in " + str(round(wall, 1)) +
+              " s (" + str(round(total, 1)) + " s of export time)" + (", failed: " + ", ".join(failed) if failed else ""))
+
+
+def run_job(job_path, result_path, open_chunk, functions):  # worker side: run one export job, write its result
+    # open_chunk - callable(project path) -> chunk opened read-only;  functions - {name: export function}
+    with open(job_path, 'r') as f:
+        job = json.load(f)
+    start = time.time()
+    result = {"status": "complete", "started": str(datetime.now()), "output": None, "error": None}
+    try:
+        chunk = open_chunk(job["project"])
+        result["output"] = functions[job["function"]](chunk, *job["args"])
+    except Exception as e:
+        traceback.print_exc()
+        result.update(status="failed", error=repr(e))
+    result["seconds"] = round(time.time() - start, 3)
+    with open(result_path + ".tmp", 'w') as f:
+        json.dump(result, f, indent=1)
+    os.replace(result_path + ".tmp", result_path)
+    sys.stdout.flush()
+    return 0 if result["status"] == "complete" else 1
@@ -0,0 +1,125 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: iterative gradual selection of tie points ----------------------------------------
+#######################################################################################################################
+# Gradual selection in the style of the USGS Metashape workflow: each criterion (a PointCloud.Filter criterion) has a
+# target value and a maximum fraction of the remaining points that may be removed in one pass. Every iteration runs
+# the criteria in order; a criterion removes the points above max(target, the value that removes the maximum
+# fraction), and the cameras are re-optimised after each criterion that removed points. Iterations stop when every
+# criterion has reached its target, when no criterion's mean value (at the start of its pass) improved by more than
+# the tolerance (relative) since the previous iteration, or after the maximum number of iterations.
+#
+# Criteria are written "<criterion>:<target>:<max fraction>" separated by ";", e.g.
+#   ReconstructionUncertainty:10:0.1;ProjectionAccuracy:3:0.1;ReprojectionError:0.3:0.1
+# Every pass is printed and written to a CSV log.
+
+import csv
+import time
+
+import numpy as np
+
+from metashape_tiepoints import tiepoint_snapshot, invalidate_snapshot
+
+COLUMNS = ["iteration", "criterion", "target", "threshold", "points_before", "points_removed", "mean_value",
+           "max_value", "seconds_filter", "seconds_optimize"]
+
+
+def parse_criteria(text):  # [(criterion, target, max fraction), ...]
+    criteria = []
+    for item in text.split(";"):
+        if not item.strip():
+            continue
+        name, target, fraction = [s.strip() for s in item.split(":")]
+        fraction = float(fraction)
+        if not 0 < fraction <= 1:
+            raise ValueError("gradual selection: max fraction of " + name + " must be in (0, 1]: " + str(fraction))
+        criteria.append((name, float(target), fraction))
+    return criteria
+
+
+def selection_threshold(values, target, max_fraction):  # value above which points are removed, None if converged
+    if len(values) == 0 or values.max() <= target:
+        return None
+    return max(target, float(np.quantile(values, 1 - max_fraction)))
+
+
+class GradualSelection:
+
+    def __init__(self, chunk, filter_class, criteria, optimize, max_iterations=5, tolerance=0.01):
+        self.chunk = chunk
+        self.filter_class = filter_class  # Metashape.PointCloud.Filter
+        self.criteria = criteria  # from parse_criteria
+        self.optimize = optimize  # function(chunk) - optimizeCameras with the workflow's fit flags
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.rows = []  # one log row per criterion pass
+        self.n_removed = 0
+        self.n_optimized = 0
+        self.stop_reason = None
+
+    def criterion_values(self, name):  # (filter, values of the valid points, snapshot)
+        f = self.filter_class()
+        f.init(self.chunk, getattr(self.filter_class, name))
+        snapshot = tiepoint_snapshot(self.chunk)
+        values = np.asarray(f.values, dtype=float)
+        if len(values) == len(snapshot):
+            values = values[snapshot.valid]
+        return f, values, snapshot
+
+    def run_criterion(self, iteration, name, target, max_fraction):  # one pass - returns the number of points removed
+        start = time.perf_counter()
+        f, values, snapshot = self.criterion_values(name)
+        threshold = selection_threshold(values, target, max_fraction)
+        n_removed = 0
+        if threshold is not None:
+            f.selectPoints(threshold)
+            snapshot.refresh_selected()
+            n_removed = snapshot.n_selected()
+            f.removePoints(threshold)
+            snapshot.remove_selected()
+        seconds_filter = time.perf_counter() - start
+
+        seconds_optimize = 0.
+        if n_removed:
+            start = time.perf_counter()
+            self.optimize(self.chunk)
+            invalidate_snapshot(self.chunk)  # optimisation moves the tie points
+            self.n_optimized += 1
+            seconds_optimize = time.perf_counter() - start
+
+        self.n_removed += n_removed
+        row = [iteration, name, target, round(threshold, 4) if threshold is not None else "converged", len(values),
+               n_removed, round(float(values.mean()), 4) if len(values) else 0,
+               round(float(values.max()), 4) if len(values) else 0, round(seconds_filter, 2), round(seconds_optimize, 2)]
+        self.rows.append(row)
+        print("gradual selection " + str(iteration) + " " + name + ": " + str(n_removed) + "/" + str(len(values)) +
+              " points removed above " + str(row[3]) + " (target " + str(target) + ", mean " + str(row[6]) +
+              ", max " + str(row[7]) + ") in " + str(row[8]) + " s, optimisation " + str(row[9]) + " s")
+        return n_removed
+
+    def run(self):
+        previous = None
+        for iteration in range(1, self.max_iterations + 1):
+            removed = [self.run_criterion(iteration, *criterion) for criterion in self.criteria]
+            if not any(removed):
+                self.stop_reason = "all criteria reached their targets"
+                break
+            current = [row[6] for row in self.rows[-len(self.criteria):]]  # mean values at the start of each pass
+            if previous is not None:
+                improvement = max((p - c) / abs(p) if p else 0. for p, c in zip(previous, current))
+                if improvement < self.tolerance:
+                    self.stop_reason = "improvement " + str(round(improvement, 4)) + " below tolerance"
+                    break
+            previous = current
+        else:
+            self.stop_reason = "maximum of " + str(self.max_iterations) + " iterations"
+        return self
+
+    def write_log(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            writer.writerows(self.rows)
+
+    def report(self):
+        print("gradual selection: " + str(self.n_removed) + " points removed, " + str(self.n_optimized) +
+              " optimisations - stopped: " + str(self.stop_reason))
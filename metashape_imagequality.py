@@ -0,0 +1,88 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: image quality statistics ---------------------------------------------------------
+#######################################################################################################################
+# The image quality of every camera (camera.meta["Image/Quality"], set by analyzePhotos) is read once into an array;
+# the threshold, the number of cameras at or above each quality bin, the histogram and the percentiles are then
+# computed from that array. The threshold is either the fixed Image_Quality_Threshold or, when
+# Image_Quality_Percentile is set, the quality below which that percentage of the cameras lies.
+
+import numpy as np
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def quality_array(cameras):  # image quality of each camera, nan where Metashape has not estimated it
+    qualities = np.full(len(cameras), np.nan)
+    for i, camera in enumerate(cameras):
+        value = camera.meta["Image/Quality"]
+        if value is not None:
+            qualities[i] = float(value)
+    return qualities
+
+
+def parse_bins(text):  # "0.5,0.6,0.7,0.8,0.9" -> sorted array of bin thresholds
+    return np.array(sorted(float(b) for b in text.split(",") if b.strip()), dtype=float)
+
+
+def percentile_threshold(qualities, percentile):  # quality below which `percentile` % of the cameras lie
+    measured = qualities[~np.isnan(qualities)]
+    if len(measured) == 0:
+        return None
+    return float(np.percentile(measured, float(percentile)))
+
+
+class ImageQualityStats:
+    #   qualities - image quality of each camera (nan = not estimated)
+    #   threshold - cameras below it are disabled (None = no filter)
+    #   bins      - ascending quality thresholds the counts and histogram are reported for
+
+    def __init__(self, qualities, threshold=None, bins=(0.5, 0.6, 0.7, 0.8, 0.9)):
+        self.qualities = qualities
+        self.threshold = threshold
+        self.bins = np.asarray(bins, dtype=float)
+
+        measured = qualities[~np.isnan(qualities)]
+        self.n_cameras = len(qualities)
+        self.n_measured = len(measured)
+        if threshold is None:
+            self.below = np.zeros(len(qualities), dtype=bool)
+        else:
+            self.below = qualities < threshold  # nan (not estimated) is never below the threshold
+        self.n_below = int(np.count_nonzero(self.below))
+
+        # histogram over the intervals (-inf, b0), [b0, b1), ... [bn, inf) and the number at or above each bin
+        self.histogram = np.bincount(np.searchsorted(self.bins, measured, side='right'),
+                                     minlength=len(self.bins) + 1)
+        self.at_or_above = self.histogram[::-1].cumsum()[::-1][1:]
+        if len(measured):
+            self.percentiles = np.percentile(measured, PERCENTILES)
+            kept = measured[measured >= threshold] if threshold is not None else measured
+            self.min_kept = float(kept.min()) if len(kept) else None
+            self.mean = float(measured.mean())
+        else:
+            self.percentiles = np.full(len(PERCENTILES), np.nan)
+            self.min_kept = None
+            self.mean = None
+
+    def perc(self, n):
+        return round(n / self.n_cameras * 100, 1) if self.n_cameras else 0.
+
+    def report(self):
+        if self.threshold is not None:
+            print("number of cameras disabled = " + str(self.n_below))
+            print("percent of cameras disabled = " + str(self.perc(self.n_below)) + "%")
+            print("number of cameras enabled = " + str(self.n_cameras - self.n_below))
+        for b, n in zip(self.bins[::-1], self.at_or_above[::-1]):
+            print("number (%) of photos with image quality >= " + str(b) + ": " + str(int(n)) + " (" +
+                  str(self.perc(n)) + "%)")
+        print("image quality percentiles " + str(list(PERCENTILES)) + ": " +
+              str([round(float(p), 3) for p in self.percentiles]))
+
+    def settings_rows(self):  # [name, value] rows for PhSc1_settings_TEMP.csv - all numeric
+        rows = [["img_qual_threshold", self.threshold if self.threshold is not None else 0],
+                ["img_qual_mean", round(self.mean, 4) if self.mean is not None else 0]]
+        rows += [["img_qual_p" + str(p), round(float(v), 4)] for p, v in zip(PERCENTILES, self.percentiles)]
+        rows += [["n_img_qual_ge_" + str(b), int(n)] for b, n in zip(self.bins, self.at_or_above)]
+        edges = ["0"] + [str(b) for b in self.bins] + ["max"]
+        rows += [["n_img_qual_" + lo + "_to_" + hi, int(n)] for lo, hi, n in zip(edges[:-1], edges[1:], self.histogram)]
+        return rows
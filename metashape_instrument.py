@@ -0,0 +1,154 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: per-stage timing, memory and I/O instrumentation ---------------------------------
+#######################################################################################################################
+# Every stage run through a StageRunner and every project save made by a SaveManager is measured and appended as one
+# JSON line to <home>/<doc_title>.files/stage_metrics.jsonl (next to PhSc1_settings_TEMP.csv):
+#   wall_s / cpu_s          - elapsed and process CPU time (all threads, including Metashape's own)
+#   peak_rss_mb             - peak resident memory during the stage (Linux, or Windows with psutil); otherwise the
+#                             peak of the whole process so far
+#   read_bytes/write_bytes  - bytes read and written by the process (Linux /proc, or psutil if installed)
+#   export_bytes_written    - size of the files created or changed in the export folder
+# Each record also carries the project, part and quality settings so runs can be compared across projects.
+
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def dir_state(path):  # {file: [size, mtime]} for every file below path
+    state = {}
+    if path is None or not os.path.isdir(path):
+        return state
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            full = os.path.join(root, f).replace('\\', '/')
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            state[full] = [st.st_size, st.st_mtime]
+    return state
+
+
+def changed_files(before, after):  # files that are new or changed between two dir_state calls
+    return dict((p, s) for p, s in after.items() if before.get(p) != s)
+
+
+def proc_status_kb(field):  # e.g. VmHWM from /proc/self/status (Linux)
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_peak_rss():  # Linux: reset VmHWM so the next reading is the peak of this stage only
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    hwm = proc_status_kb("VmHWM")
+    if hwm is not None:
+        return round(hwm / 1024., 1)
+    if psutil is not None:
+        peak = getattr(psutil.Process().memory_info(), "peak_wset", None)  # Windows
+        if peak is not None:
+            return round(peak / 1048576., 1)
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kB on Linux, bytes on macOS
+        return round(peak / (1048576. if sys.platform == "darwin" else 1024.), 1)
+    return None
+
+
+def io_counters():  # (bytes read, bytes written) by this process so far, or (None, None)
+    try:
+        counters = {}
+        with open("/proc/self/io", 'r') as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key] = int(value)
+        return counters["rchar"], counters["wchar"]  # includes network filesystems, unlike read_bytes
+    except (OSError, ValueError, KeyError):
+        pass
+    if psutil is not None:
+        try:
+            c = psutil.Process().io_counters()
+            return c.read_bytes, c.write_bytes
+        except (AttributeError, psutil.Error):
+            pass
+    return None, None
+
+
+def difference(after, before):
+    if after is None or before is None:
+        return None
+    return after - before
+
+
+class StageMetrics:
+
+    def __init__(self, home, doc_title, part, export_dir=None, tags=None):
+        self.path = home + "/" + doc_title + ".files/stage_metrics.jsonl"
+        self.export_dir = export_dir
+        self.base = {"project": doc_title, "part": part}
+        self.base.update(tags or {})  # e.g. quality settings
+        self.pending = []  # records waiting for Metashape to create the .files folder
+
+    def write(self, record):
+        self.pending.append(record)
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return
+        with open(self.path, 'a') as f:
+            for r in self.pending:
+                f.write(json.dumps(r) + "\n")
+        self.pending = []
+
+    def skipped(self, name):
+        record = dict(self.base)
+        record.update(time=str(datetime.now()), stage=name, kind="stage", status="skipped")
+        self.write(record)
+
+    def measure(self, name, kind, func, *args, **kwargs):  # run func and record what it cost
+        record = dict(self.base)
+        record.update(time=str(datetime.now()), stage=name, kind=kind, status="complete")
+
+        reset_peak_rss()
+        export_before = dir_state(self.export_dir)
+        read_before, written_before = io_counters()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            record["status"] = "failed"
+            record["error"] = repr(e)
+            raise
+        finally:
+            record["wall_s"] = round(time.perf_counter() - wall, 3)
+            record["cpu_s"] = round(time.process_time() - cpu, 3)
+            record["peak_rss_mb"] = peak_rss_mb()
+            read_after, written_after = io_counters()
+            record["read_bytes"] = difference(read_after, read_before)
+            record["write_bytes"] = difference(written_after, written_before)
+            changed = changed_files(export_before, dir_state(self.export_dir))
+            record["export_bytes_written"] = sum(s[0] for s in changed.values())
+            self.write(record)
@@ -0,0 +1,97 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: marker to camera candidate ranking -----------------------------------------------
+#######################################################################################################################
+# Between part 1 and part 2 each marker is placed on the five images whose cameras are closest to it, then on five more.
+# After alignment this finds those images: the aligned camera centres are put in a spatial index (scipy cKDTree, or a
+# numpy search without scipy), each marker is projected into its nearest cameras, and cameras that see the marker are
+# ranked by distance and by how close to the image centre the marker falls. The ranked list of every marker is
+# written to a CSV table, and the top cameras can optionally get (unpinned) marker projections straight away.
+
+import csv
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+SEARCH_FACTOR = 5  # cameras searched per marker = SEARCH_FACTOR x the number of candidates wanted
+COLUMNS = ["marker", "rank", "camera", "distance_m", "u_pix", "v_pix", "centre_offset", "score"]
+
+
+def nearest_cameras(centres, positions, k):  # (indices, distances) of the k nearest camera centres of each position
+    k = min(k, len(centres))
+    if cKDTree is not None:
+        dist, idx = cKDTree(centres).query(positions, k)
+        return idx.reshape(len(positions), k), dist.reshape(len(positions), k)
+    idx = np.empty((len(positions), k), dtype=np.int64)
+    dist = np.empty((len(positions), k))
+    for m, p in enumerate(positions):  # one marker at a time keeps memory at n_cameras
+        d = np.sqrt(((centres - p) ** 2).sum(axis=1))
+        near = np.argpartition(d, k - 1)[:k] if k < len(d) else np.arange(len(d))
+        near = near[np.argsort(d[near])]
+        idx[m], dist[m] = near, d[near]
+    return idx, dist
+
+
+def marker_position(chunk, marker):  # marker position in chunk coordinates (placed, or from its reference)
+    if marker.position is not None:
+        return marker.position
+    if marker.reference.location and chunk.crs is not None and chunk.transform.matrix is not None:
+        return chunk.transform.matrix.inv().mulp(chunk.crs.unproject(marker.reference.location))
+    return None
+
+
+def centre_offset(uv, sensor):  # 0 at the image centre, 1 at the frame edge, > 1 outside the frame
+    w, h = sensor.width, sensor.height
+    return max(abs(uv[0] - w / 2.) / (w / 2.), abs(uv[1] - h / 2.) / (h / 2.))
+
+
+def rank_marker_cameras(chunk, n_candidates=10, scale=1.):
+    # {marker: [(camera, distance_m, u, v, centre_offset, score), ...] best first}
+    # scale - metres per chunk unit (chunk.transform.scale)
+    cameras = [c for c in chunk.cameras if c.transform and c.enabled]
+    markers = []
+    points = []
+    for marker in chunk.markers:
+        position = marker_position(chunk, marker)
+        if position is None:
+            print("marker " + marker.label + " has no position or reference - not ranked")
+            continue
+        markers.append(marker)
+        points.append(position)
+    if not cameras or not markers:
+        return {}
+
+    centres = np.array([tuple(c.center) for c in cameras], dtype=float)
+    idx, dist = nearest_cameras(centres, np.array([tuple(p) for p in points], dtype=float), n_candidates * SEARCH_FACTOR)
+
+    ranking = {}
+    for m, marker in enumerate(markers):
+        candidates = []
+        for i, d in zip(idx[m], dist[m]):
+            camera = cameras[int(i)]
+            if camera.transform.inv().mulp(points[m])[2] <= 0:  # behind the camera
+                continue
+            uv = camera.project(points[m])
+            if uv is None:
+                continue
+            offset = centre_offset(uv, camera.sensor)
+            if offset >= 1:  # outside the image
+                continue
+            distance = float(d) * scale
+            candidates.append((camera, distance, uv[0], uv[1], offset, distance * (1 + offset)))
+        candidates.sort(key=lambda c: c[5])
+        ranking[marker] = candidates[:n_candidates]
+    return ranking
+
+
+def write_ranking(ranking, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for marker, candidates in ranking.items():
+            for rank, (camera, distance, u, v, offset, score) in enumerate(candidates, 1):
+                writer.writerow([marker.label, rank, camera.label, round(distance, 3), round(u, 1), round(v, 1),
+                                 round(offset, 3), round(score, 3)])
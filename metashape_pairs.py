@@ -0,0 +1,168 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: GPS neighbourhood pair planning for matchPhotos ----------------------------------
+#######################################################################################################################
+# On large grid flights most image pairs can't overlap, so instead of letting matchPhotos consider them all the pair
+# list is planned from the camera reference positions:
+#   footprint pairs - cameras closer than their ground footprint (flight height x sensor size / focal length) times
+#                     Pair_Overlap_Factor: covers along-track and cross-track neighbours
+#   k nearest       - the Pair_Neighbours nearest cameras of every camera, so sparse areas stay connected
+#   sequence        - each photo and the next two in capture (file name) order, i.e. along-track on every line
+# Neighbour searches use a KD-tree (scipy.spatial.cKDTree) when scipy is installed; otherwise footprint pairs come from
+# a numpy grid search and the k nearest neighbours are left out.
+
+import math
+import time
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+DEFAULT_FOOTPRINT_RATIO = 1.5  # footprint diagonal / flight height when the sensor size is unknown (~75 deg FOV)
+SEQUENCE_STEPS = 2
+
+
+def unique_pairs(pairs):  # (i, j) with i < j, without repeats
+    if len(pairs) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.sort(pairs, axis=1).astype(np.int64)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    if len(pairs) == 0:
+        return pairs
+    n = int(pairs.max()) + 1
+    codes = np.unique(pairs[:, 0] * n + pairs[:, 1])  # 1-d codes sort much faster than rows
+    return np.column_stack((codes // n, codes % n))
+
+
+def grid_radius_pairs(xy, radius):  # all pairs closer than radius, with a uniform grid instead of a KD-tree
+    cells = np.floor(xy / radius).astype(np.int64)
+    cells -= cells.min(axis=0)
+    ny = int(cells[:, 1].max()) + 3
+    keys = (cells[:, 0] + 1) * ny + cells[:, 1] + 1  # +1: neighbouring cells never wrap to another column
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    found = []
+    for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):  # half of the 3 x 3 neighbourhood: each pair once
+        target = keys + dx * ny + dy
+        start = np.searchsorted(sorted_keys, target, side="left")
+        stop = np.searchsorted(sorted_keys, target, side="right")
+        counts = stop - start
+        i = np.repeat(np.arange(len(xy)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        j = order[np.repeat(start, counts) + offsets]
+        keep = ((xy[i] - xy[j]) ** 2).sum(axis=1) < radius * radius
+        if dx == 0 and dy == 0:
+            keep &= i < j
+        found.append(np.column_stack((i[keep], j[keep])))
+    return np.concatenate(found)
+
+
+def radius_pairs(xy, radius):
+    if cKDTree is not None:
+        return cKDTree(xy).query_pairs(radius, output_type="ndarray")
+    return grid_radius_pairs(xy, radius)
+
+
+def knn_pairs(xy, k):
+    k = min(k, len(xy) - 1)
+    if cKDTree is None or k < 1:
+        return np.empty((0, 2), dtype=np.int64)
+    dist, idx = cKDTree(xy).query(xy, k + 1)  # the first neighbour is the camera itself
+    return np.column_stack((np.repeat(np.arange(len(xy)), k), idx[:, 1:].ravel()))
+
+
+def sequence_pairs(n, steps=SEQUENCE_STEPS):
+    i = np.arange(n)
+    return np.concatenate([np.column_stack((i[:-s], i[s:])) for s in range(1, steps + 1) if s < n] or
+                          [np.empty((0, 2), dtype=np.int64)])
+
+
+class PairPlan:
+
+    def __init__(self, pairs, n_cameras, counts, seconds):
+        self.pairs = pairs  # (i, j) camera indices, i < j
+        self.n_cameras = n_cameras
+        self.counts = counts  # pairs found by each rule (before merging)
+        self.seconds = seconds
+
+    def exhaustive(self):
+        return self.n_cameras * (self.n_cameras - 1) // 2
+
+    def report(self):
+        kept = len(self.pairs)
+        print("pair planning: " + str(kept) + " of " + str(self.exhaustive()) + " possible pairs kept (" +
+              str(round(kept / max(self.exhaustive(), 1) * 100, 2)) + "%) in " + str(round(self.seconds, 2)) + " s - " +
+              ", ".join(k + ": " + str(v) for k, v in self.counts.items()))
+
+
+def plan_pairs(xy, footprint=None, k=10, overlap_factor=1.0):
+    # xy        - horizontal camera positions (m), in capture order
+    # footprint - ground footprint diagonal (m), None to skip the footprint rule
+    start = time.perf_counter()
+    found = {}
+    if footprint is not None:
+        found["footprint"] = radius_pairs(xy, footprint * overlap_factor)
+    if k > 0:
+        found["nearest"] = knn_pairs(xy, k)
+    found["sequence"] = sequence_pairs(len(xy))
+    pairs = unique_pairs(np.concatenate(list(found.values())))
+    counts = dict((name, len(p)) for name, p in found.items())
+    return PairPlan(pairs, len(xy), counts, time.perf_counter() - start)
+
+
+# ---- chunk side -----------------------------------------------------------------------------------------------------
+
+def metric_xy(locations):  # horizontal positions in metres; geographic (lon, lat) locations are projected locally
+    xy = locations[:, :2].astype(float)
+    if np.all(np.abs(xy[:, 0]) <= 180) and np.all(np.abs(xy[:, 1]) <= 90):
+        lat0 = math.radians(float(np.median(xy[:, 1])))
+        xy = (xy - np.median(xy, axis=0)) * np.array([111320. * math.cos(lat0), 110540.])
+    return xy
+
+
+def footprint_ratio(sensor):  # footprint diagonal / flight height from the sensor size and focal length
+    try:
+        diagonal = math.hypot(sensor.width * sensor.pixel_width, sensor.height * sensor.pixel_height)
+        return diagonal / sensor.focal_length
+    except (AttributeError, TypeError, ZeroDivisionError):
+        return DEFAULT_FOOTPRINT_RATIO
+
+
+def flight_height(cameras, setting):  # flight height above ground: the input file value, or AUTO from DJI metadata
+    if setting != "AUTO":
+        return float(setting)
+    heights = []
+    for camera in cameras[:200]:
+        meta = camera.photo.meta if camera.photo is not None else None
+        if meta is not None and "DJI/RelativeAltitude" in meta.keys():
+            heights.append(float(meta["DJI/RelativeAltitude"]))
+    return float(np.median(heights)) if heights else None
+
+
+def camera_pairs(chunk, k, overlap_factor, height_setting):
+    # matchPhotos pairs (camera keys) for the enabled cameras, or None if too few cameras have a reference position
+    cameras = [c for c in chunk.cameras if c.enabled]
+    located = [c for c in cameras if c.reference.location]
+    if len(cameras) < 3 or len(located) < 0.9 * len(cameras):
+        print("pair planning skipped: " + str(len(located)) + "/" + str(len(cameras)) +
+              " enabled cameras have a reference position")
+        return None
+
+    located.sort(key=lambda c: c.photo.path if c.photo is not None else c.label)  # capture order
+    xy = metric_xy(np.array([tuple(c.reference.location) for c in located], dtype=float))
+    height = flight_height(located, height_setting)
+    footprint = height * footprint_ratio(located[0].sensor) if height else None
+    if footprint is None:
+        print("pair planning: flight height unknown - using nearest and sequence neighbours only")
+
+    plan = plan_pairs(xy, footprint, k, overlap_factor)
+    plan.report()
+
+    pairs = [(located[i].key, located[j].key) for i, j in plan.pairs.tolist()]
+    unlocated = [c for c in cameras if not c.reference.location]  # match these with every camera
+    for n, c in enumerate(unlocated):
+        pairs += [(c.key, other.key) for other in located + unlocated[n + 1:]]
+    return pairs
@@ -6,11 +6,28 @@
 # IMPORTS #
 import Metashape as MS
 import math
+import numpy as np
 import os
 import csv
 import inspect
+import sys
 from datetime import datetime
 
+sys.path.append(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))))  # find the workflow helper modules
+from metashape_tiepoints import reprojection_errors, tiepoint_snapshot, invalidate_snapshot, knn_outliers
+from metashape_stages import StageRunner
+from metashape_save import SaveManager
+from metashape_instrument import StageMetrics
+from metashape_args import input_file_path
+from metashape_imagequality import quality_array, percentile_threshold, parse_bins, ImageQualityStats
+from metashape_qualitycache import QualityCache
+from metashape_prescreen import prescreen_photos
+from metashape_photoindex import PhotoIndex
+from metashape_references import transform_references
+from metashape_pairs import camera_pairs
+from metashape_markers import rank_marker_cameras, write_ranking
+from metashape_cameras import CameraDiagnostics
+
 MS.app.console_pane.clear() # comment out when using ISCA
 
 startTime = datetime.now()
@@ -19,7 +36,7 @@ print ("Script start time: " + str(startTime))
 def script_setup():
     file_loc = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 
-    input_file_B = (file_loc + "/" + "input_file.csv")
+    input_file_B = input_file_path(file_loc + "/" + "input_file.csv")  # --input <file> overrides
     input_file_B = input_file_B.replace('\\', '/')
 
     print (input_file_B)
@@ -43,6 +60,8 @@ def script_setup():
     marker_coords = var_list[5]
     marker_crs = var_list[6]
 
+    exportdir = var_list[7]
+
     Est_img_qual = var_list[8]
 
     img_qual_thresh = var_list[9]
@@ -53,7 +72,38 @@ def script_setup():
 
     rolling_shutter = var_list[37]
 
-    altitude_adjustment = var_list[38]
+    revise_altitude = var_list[38]
+    altitude_adjustment = var_list[39]
+
+    save_policy = var_list[41]
+    save_interval = var_list[42]
+    save_backups = var_list[43]
+
+    img_qual_percentile = var_list[44]
+    img_qual_bins = var_list[45]
+    img_qual_cache = var_list[46]
+
+    prescreen = var_list[47]
+    prescreen_sharpness = var_list[48]
+    prescreen_clipped = var_list[49]
+    prescreen_workers = var_list[50]
+
+    pair_planning = var_list[51]
+    pair_neighbours = var_list[52]
+    pair_overlap = var_list[53]
+    pair_height = var_list[54]
+
+    marker_candidates = var_list[55]
+    marker_n_candidates = var_list[56]
+    marker_precreate = var_list[57]
+
+    outlier_filter = var_list[58]
+    outlier_neighbours = var_list[59]
+    outlier_sigma = var_list[60]
+
+    camera_diagnostics = var_list[65]
+    camera_outlier_z = var_list[66]
+    disable_outlier_cameras = var_list[67]
     
     print (home)
     print(doc_title)
@@ -69,13 +119,107 @@ def script_setup():
     elif MS.app.gpu_mask > 1:
         MS.app.cpu_enable = False # Disable CPU for GPU accelerated tasks (faster when multiple GPUs are present)
 
-    doc.save(home+name)
+    # stage timings, memory and I/O go to <doc_title>.files/stage_metrics.jsonl
+    metrics = StageMetrics(home, doc_title, "part1", exportdir, {"spc_quality": spc_quality,
+                                                                 "estimate_image_quality": Est_img_qual})
+    runner = StageRunner(home, doc_title, "part1", metrics=metrics)  # stage ledger - allows a killed run to be resumed
+    saves = SaveManager(doc, home, doc_title, "part1", save_policy, save_interval, save_backups, runner,
+                        metrics=metrics)
+
+    if runner.completed("load_photos") and os.path.isfile(home + name):
+        print("resuming previous run of " + home + name)
+        if os.path.exists(home + '/' + doc_title + '.files/lock'):
+            os.remove(home + '/' + doc_title + '.files/lock')
+        doc.open(home + name, read_only=False)
+    else:
+        saves.save("new project")  # creates the project and its .files folder
+
+    with saves.on_failure():
+        # image files below datadir (no sidecars, thumbnails or duplicates) and their EXIF/XMP tags - cached
+        index = PhotoIndex(home).scan(datadir)
+        index.report()
+        photos = index.photos()
+
+        if prescreen == "TRUE":  # reject blurred / badly exposed photos before they are added to the chunk
+            photos = runner.run("prescreen_photos", prescreen_photos, photos,
+                                home + '/' + doc_title + '.files/photo_prescreen.csv', prescreen_sharpness,
+                                prescreen_clipped, prescreen_workers, project_stage=False)
+
+        runner.run("load_photos", load_photos, photos, coord_sys, marker_coords, marker_crs, rolling_shutter,
+                   revise_altitude, altitude_adjustment, index.relative_altitudes(),
+                   check=lambda: doc.chunk is not None and len(doc.chunk.cameras) > 0)
+        chunk = doc.chunk
+        saves.checkpoint("load_photos", expensive=True)
+
+        orig_n_cams, n_filter_removed, perc_filter_removed, real_qual_thresh, qual_rows = runner.run(
+            "preprocess", preprocess, Est_img_qual, img_qual_thresh, chunk, img_qual_percentile, img_qual_bins,
+            home if img_qual_cache == "TRUE" else None)
+        saves.checkpoint("preprocess", expensive=True)
+
+        runner.run("build_SPC", build_SPC, chunk, spc_quality, pair_planning, pair_neighbours, pair_overlap, pair_height,
+                   check=lambda: chunk.point_cloud is not None)
+        projections = chunk.point_cloud.projections
+        saves.checkpoint("build_SPC", expensive=True)
+
+        total_points, perc_ab_thresh, nselected = runner.run("filter_reproj_err", filter_reproj_err, chunk,
+                                                             reproj_err_limit)
+        saves.checkpoint("filter_reproj_err")
+
+        n_outliers, outlier_limit = 0, 0
+        if outlier_filter == "TRUE":  # isolated tie points far from their neighbours (floating noise, sky points)
+            n_outliers, outlier_limit = runner.run("filter_outliers", filter_outliers, chunk, outlier_neighbours,
+                                                   outlier_sigma)
+            saves.checkpoint("filter_outliers")
+
+        errors = {}  # reprojection errors after the filters, computed once for the diagnostics and the reference settings
+
+        def reproj_errors():
+            if "errors" not in errors:
+                errors["errors"] = reprojection_errors(chunk, tiepoint_snapshot(chunk), projections)
+            return errors["errors"]
+
+        robust_rmse = None
+        if camera_diagnostics == "TRUE":  # per-camera table; flagged cameras don't count towards tiepoint accuracy
+            n_flagged, n_disabled, robust_rmse = runner.run(
+                "camera_diagnostics", diagnose_cameras, reproj_errors, projections, camera_outlier_z,
+                disable_outlier_cameras, home + '/' + doc_title + '_camera_diagnostics.csv',
+                outputs=[home + '/' + doc_title + '_camera_diagnostics.csv'],
+                project_stage=disable_outlier_cameras == "TRUE")
+            saves.checkpoint("camera_diagnostics")
+
+        n_not_aligned = runner.run("ref_setting_setup", ref_setting_setup, doc, reproj_errors, robust_rmse)
+        saves.checkpoint("ref_setting_setup")
+
+        if marker_candidates == "TRUE":  # cameras to place each marker on, closest and best framed first
+            runner.run("rank_marker_cameras", rank_marker_candidates, chunk, marker_n_candidates, marker_precreate,
+                       home + '/' + doc_title + '_marker_candidates.csv',
+                       outputs=[home + '/' + doc_title + '_marker_candidates.csv'],
+                       project_stage=marker_precreate == "TRUE")
+            saves.checkpoint("rank_marker_cameras")
+
+        runner.run("export_settings", export_settings, orig_n_cams, n_filter_removed, perc_filter_removed,
+                   real_qual_thresh, n_not_aligned, total_points, nselected, n_outliers, outlier_limit, home,
+                   doc_title, qual_rows,
+                   outputs=[home + '/' + doc_title + '.files/PhSc1_settings_TEMP.csv'], project_stage=False)
+
+        # SAVE DOCUMENT
+        saves.finish()
+
+    if perc_ab_thresh > 20:
+
+        print("-------------------------------------------------------------")
+        print("WARNING >20% OF POINTS ABOVE REPROJECTION ERROR THRESHOLD!!!!")
+        print("-------------------------------------------------------------")
+
+        # Get Execution Time...
+    print("Total Time: " + str(datetime.now() - startTime))  # GET TOTAL TIME
+
 
-    # Locate and add photos
-    photos = os.listdir(datadir)  # Get the photos filenames
-    print (photos)
-    photos = [os.path.join(datadir, p) for p in photos]  # convert to full paths
-    print (photos)
+def load_photos(photos, coord_sys, marker_coords, marker_crs, rolling_shutter, revise_altitude, altitude_adjustment,
+                rel_altitudes):
+
+    # Add photos (from the photo index, less any rejected by the pre-screen)
+    print("adding " + str(len(photos)) + " photos")
 
     chunk = MS.app.document.addChunk()  # create a chunk -  Warning you need to delete the original automatically created chunk when Metashape opens if running the script from tools
 
@@ -86,29 +230,28 @@ def script_setup():
 
     new_crs = MS.CoordinateSystem(coord_sys)  # define desired Coordinate System
 
-    try:
-        for camera in chunk.cameras:  # set the coordinates for cameras
-            camera.reference.location = MS.CoordinateSystem.transform(camera.reference.location,chunk.crs, new_crs) # old script: new_crs.project(chunk.crs.unproject(camera.reference.location))#MSCHANGE
-    except Exception:
-
-        print("Images do not have projection data... No Worries! continue without!")
-
-    #  New script section to correct for DJI absolute altitude problems - this portion of script reads the relative altitude (height of DJI drone above take off point) from the DJI meat data
-    #  The relative altitiude is then added to the known absolute altitude of the take of point(defined through input file line 38) to give a new value of z in the absolute altitude of the camers used by Metashape
+    #  DJI absolute altitude correction - the relative altitude (height of the DJI drone above the take off point, from
+    #  the DJI metadata) is added to the known absolute altitude of the take off point (altitude_adjustment in the input
+    #  file) to give the z of the camera reference. Only applied when revise_altitude is TRUE.
     #  This portion of the script needs to be checked to see how it interacts with non DJI drone data
-
-    alt = float(altitude_adjustment) #MSCHANGE
-
-    for camera in chunk.cameras:  #MSCHANGE
-        if not camera.reference.location:
-            continue
-
-        if ("DJI/RelativeAltitude" in camera.photo.meta.keys()) and camera.reference.location:  #MSCHANGE
-
-            z = float(camera.photo.meta["DJI/RelativeAltitude"])
-            camera.reference.location = (camera.reference.location.x, camera.reference.location.y, z + alt)
-
-
+    rel_alts = None
+    if revise_altitude == "TRUE":
+        # relative altitudes come from the photo index (read once, cached) rather than from each camera's photo.meta
+        rel_alts = []
+        for camera in chunk.cameras:  #MSCHANGE
+            z = rel_altitudes.get(camera.photo.path.replace('\\', '/'))
+            if z is None and "DJI/RelativeAltitude" in camera.photo.meta.keys():  # photo not in the index
+                z = float(camera.photo.meta["DJI/RelativeAltitude"])
+            rel_alts.append(z)
+
+    # camera locations (from the photo EXIF, in chunk.crs) are transformed to the project crs in one batch and the
+    # altitude correction is applied in the same pass - cameras that fail are listed, the others are still updated
+    cam_report = transform_references(chunk.cameras, chunk.crs, new_crs,
+                                      lambda v: MS.CoordinateSystem.transform(v, chunk.crs, new_crs), "camera",
+                                      rel_alts, altitude_adjustment)
+    cam_report.report()
+    if cam_report.n_no_location == len(chunk.cameras):
+        print("Images do not have projection data... No Worries! continue without!")
 
     # Optional import of markers if desired...
     if marker_coords == "NONE":  # if no markers are given then pass
@@ -120,136 +263,109 @@ def script_setup():
         if marker_crs == coord_sys:  # if marker and project crs match then pass otherwise convert marker crs
             pass
         else:
-            for marker in chunk.markers:  # This needs testing  but should theoretically work...
-                marker.reference.location = new_crs.project(chunk.crs.unproject(marker.reference.location))
+            marker_cs = MS.CoordinateSystem(marker_crs)
+            transform_references(chunk.markers, marker_cs, new_crs,
+                                 lambda v: MS.CoordinateSystem.transform(v, marker_cs, new_crs), "marker").report()
 
     chunk.crs = new_crs  # set project coordinate system
     chunk.updateTransform #MSCHANGE
 
-    doc.save(home + name)
-
-    orig_n_cams, n_filter_removed, perc_filter_removed, real_qual_thresh = preprocess(Est_img_qual, img_qual_thresh, chunk)
-
-    doc.save(home + name)
-    points, projections = build_SPC(chunk, spc_quality)
-
-    total_points, perc_ab_thresh, nselected = filter_reproj_err(chunk, reproj_err_limit)
-
-    n_not_aligned = ref_setting_setup(doc, points, projections, home, name)
-
-    export_settings(orig_n_cams, n_filter_removed, perc_filter_removed, real_qual_thresh, n_not_aligned,
-                    total_points, nselected, home, doc_title)
-
-    # SAVE DOCUMENT
-    doc.save(home + name)
-    if perc_ab_thresh > 20:
-
-        print("-------------------------------------------------------------")
-        print("WARNING >20% OF POINTS ABOVE REPROJECTION ERROR THRESHOLD!!!!")
-        print("-------------------------------------------------------------")
-
-        # Get Execution Time...
-    print("Total Time: " + str(datetime.now() - startTime))  # GET TOTAL TIME
-
 
+def preprocess(Est_img_qual, img_qual_thresh, chunk, img_qual_percentile, img_qual_bins, qual_cache_dir):
 
-def preprocess(Est_img_qual, img_qual_thresh, chunk):
+    # image qualities already computed for these photos (same file, or same content) are read from the cache and
+    # only the remaining photos are analysed
+    cache = QualityCache(qual_cache_dir) if qual_cache_dir is not None else None
 
     # Estimating Image Quality and excluding poor images
     if Est_img_qual == "TRUE":
 
         print("running image quality filter...")
 
-        chunk.analyzePhotos()  # MSCHANGE
-
-        qual = float(img_qual_thresh)
+        if cache is not None:
+            cache.analyse(chunk.cameras, chunk.analyzePhotos)
+        else:
+            chunk.analyzePhotos()  # MSCHANGE
 
-        kept_img_quals = []
-        dumped_img_quals = []
+        qualities = quality_array(chunk.cameras)  # one pass over the cameras
 
-        for camera in chunk.cameras:
-            IQ = float(camera.meta["Image/Quality"])
-            if IQ < qual:
-                camera.enabled = False
-                dumped_img_quals.append(IQ)
+        if img_qual_percentile != "NONE":
+            qual = percentile_threshold(qualities, img_qual_percentile)
+            if qual is None:  # no camera has a quality value
+                qual = float(img_qual_thresh)
+                print("image quality percentile could not be applied (no camera quality values) - using the fixed "
+                      "threshold " + str(qual))
             else:
-                kept_img_quals.append(IQ)
-
-
-        print("number of cameras disabled = " + str(len(dumped_img_quals)))
-        print("percent of cameras disabled = " + str(round((len(dumped_img_quals)/(len(kept_img_quals)+len(dumped_img_quals))*100), 1)) + "%")
-        print("number of cameras enabled = " + str(len(kept_img_quals)))
-
-
-        p09 = [i for i in kept_img_quals if i >= 0.9]
-        p08 = [i for i in kept_img_quals if i >= 0.8]
-        p07 = [i for i in kept_img_quals if i >= 0.7]
-        p06 = [i for i in kept_img_quals if i >= 0.6]
-        p05 = [i for i in kept_img_quals if i >= 0.5]
-
-
-        print("number of photos with image quality >= 0.9: " + str(len(p09)))
-        print("percent of cameras with image quality >= 0.9: " + str(round((len(p09)/(len(kept_img_quals)+len(dumped_img_quals))*100), 1)) + "%")
-
-        print("number of photos with image quality >= 0.8: " + str(len(p08)))
-        print("percent of cameras with image quality >= 0.8: " + str(round((len(p08)/(len(kept_img_quals)+len(dumped_img_quals))*100), 1)) + "%")
-
-        print("number of photos with image quality >= 0.7: " + str(len(p07)))
-        print("percent of cameras with image quality >= 0.7: " + str(round((len(p07)/(len(kept_img_quals)+len(dumped_img_quals))*100), 1)) + "%")
+                print("image quality threshold from the " + str(img_qual_percentile) + "th percentile: " +
+                      str(round(qual, 3)))
+        else:
+            qual = float(img_qual_thresh)
 
-        print("number of photos with image quality >= 0.6: " + str(len(p06)))
-        print("percent of cameras with image quality >= 0.6: " + str(round((len(p06)/(len(kept_img_quals)+len(dumped_img_quals))*100), 1)) + "%")
+        stats = ImageQualityStats(qualities, qual, parse_bins(img_qual_bins))
 
-        print("number of photos with image quality >= 0.5: " + str(len(p05)))
-        print("percent of cameras with image quality >= 0.5: " + str(round((len(p05)/(len(kept_img_quals)+len(dumped_img_quals))*100), 1)) + "%")
+        for i in np.flatnonzero(stats.below):
+            chunk.cameras[int(i)].enabled = False
 
+        stats.report()
 
-        orig_n_cams = len(dumped_img_quals) + len(kept_img_quals)
-        n_filter_removed = len(dumped_img_quals)
-        perc_filter_removed = round(((n_filter_removed/orig_n_cams)*100), 1)
-        real_qual_thresh = min(kept_img_quals)
+        orig_n_cams = stats.n_cameras
+        n_filter_removed = stats.n_below
+        perc_filter_removed = stats.perc(n_filter_removed)
+        real_qual_thresh = stats.min_kept
     else:
 
         print("image quality filtering skipped...")
 
-        chunk.estimateImageQuality()
-        all_imgs_qual = []
-        for camera in chunk.cameras:
-            IQ = float(camera.meta["Image/Quality"])
-            all_imgs_qual.append(IQ)
+        if cache is not None:
+            cache.analyse(chunk.cameras, chunk.estimateImageQuality)
+        else:
+            chunk.estimateImageQuality()
+        stats = ImageQualityStats(quality_array(chunk.cameras), None, parse_bins(img_qual_bins))
+        stats.report()
 
-        orig_n_cams = len(chunk.cameras)
+        orig_n_cams = stats.n_cameras
         n_filter_removed = "no_filter_applied"
         perc_filter_removed = "no_filter_applied"
-        real_qual_thresh = min(all_imgs_qual)
+        real_qual_thresh = stats.min_kept
+
+    if cache is not None:
+        cache.report()
+        cache.close()
 
-    return orig_n_cams, n_filter_removed, perc_filter_removed, real_qual_thresh
+    return orig_n_cams, n_filter_removed, perc_filter_removed, real_qual_thresh, stats.settings_rows()
 
-def build_SPC(chunk, spc_quality):
+def build_SPC(chunk, spc_quality, pair_planning, pair_neighbours, pair_overlap, pair_height):
 
     print("building sparse point cloud...")
 
+    # optionally restrict matching to camera pairs planned from the reference positions (see metashape_pairs.py)
+    pair_args = {}
+    if pair_planning == "TRUE":
+        pairs = camera_pairs(chunk, int(pair_neighbours), float(pair_overlap), pair_height)
+        if pairs is not None:
+            pair_args["pairs"] = pairs
+
     # Match and Align Photos and Cameras
     if spc_quality == "LowestAccuracy":
         chunk.matchPhotos(downscale=5,
                           generic_preselection=True, reference_preselection=True, filter_mask=False, keypoint_limit=40000,
-                          tiepoint_limit=8000)  # LowestAccuracy accuracy changed to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
+                          tiepoint_limit=8000, **pair_args)  # LowestAccuracy accuracy changed to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
     elif spc_quality == "LowAccuracy":
         chunk.matchPhotos(downscale=4,
                           generic_preselection=True, reference_preselection=True, filter_mask=False, keypoint_limit=40000,
-                          tiepoint_limit=8000) # accuracy changed to downscale in Metashape 1.6.4, removed preselection MSCHANGEMSCHANGE
+                          tiepoint_limit=8000, **pair_args) # accuracy changed to downscale in Metashape 1.6.4, removed preselection MSCHANGEMSCHANGE
     elif spc_quality == "MediumAccuracy":
         chunk.matchPhotos(downscale=3,
                           generic_preselection=True, reference_preselection=True, filter_mask=False, keypoint_limit=40000,
-                          tiepoint_limit=8000) #accuracy changed to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
+                          tiepoint_limit=8000, **pair_args) #accuracy changed to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
     elif spc_quality == "HighAccuracy":
         chunk.matchPhotos(downscale=2,
                           generic_preselection=True, reference_preselection=True, filter_mask=False, keypoint_limit=40000,
-                          tiepoint_limit=8000)# accuracy changed to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
+                          tiepoint_limit=8000, **pair_args)# accuracy changed to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
     elif spc_quality == "HighestAccuracy":
         chunk.matchPhotos(downscale=1,
                           generic_preselection=True, reference_preselection=True, filter_mask=False, keypoint_limit=40000,
-                          tiepoint_limit=8000) # accuracy changed to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
+                          tiepoint_limit=8000, **pair_args) # accuracy changed to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
     else:
 
         print("---------------------------------------------------------------------------------------------")
@@ -260,9 +376,10 @@ def build_SPC(chunk, spc_quality):
         chunk.matchPhotos(downscale=1,
                           generic_preselection=True, reference_preselection=True, filter_mask=False,
                           keypoint_limit=40000,
-                          tiepoint_limit=8000) # accuracy changd to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
+                          tiepoint_limit=8000, **pair_args) # accuracy changd to downscale in Metashape 1.6.4 removed preselection MSCHANGEMSCHANGE
 
     chunk.alignCameras(adaptive_fitting=False)
+    invalidate_snapshot(chunk)  # new sparse cloud
 
     point_cloud = chunk.point_cloud
     points = point_cloud.points
@@ -288,40 +405,28 @@ def count_aligned(chunk): # GET NUMBER OF ALIGNED AND NON-ALIGNED CAMERAS
 
     return (n_aligned, n_not_aligned)
 
-def calc_reprojection_error(chunk, points, projections):
-
-    npoints = len(points)
-
-    photo_avg = []
+def calc_reprojection_error(errors):
+    # errors from metashape_tiepoints.reprojection_errors: the track_id -> point lookup is built once and each camera's
+    # projections are evaluated as arrays - cameras without any valid projection are left out of the list
 
-    for camera in chunk.cameras:
-        if not camera.transform:
-            continue
-        point_index = 0
-        photo_num = 0
-        photo_err = 0
-        for proj in projections[camera]:
-            track_id = proj.track_id
-            while point_index < npoints and points[point_index].track_id < track_id:
-                point_index += 1
-            if point_index < npoints and points[point_index].track_id == track_id:
-                if not points[point_index].valid:
-                    continue
+    return errors.rmse_list()  # returns list of rmse values for each camera
 
-                dist = camera.error(points[point_index].coord, proj.coord).norm() ** 2  # get the square error for each point in camera
+def diagnose_cameras(reproj_errors, projections, camera_outlier_z, disable_outlier_cameras, table_path):
 
-                photo_num += 1 # counts number of points per camera
-                photo_err += dist # creates list of square point errors
+    diagnostics = CameraDiagnostics(reproj_errors(), projections, float(camera_outlier_z))
+    diagnostics.report()
 
-        photo_avg.append(math.sqrt(photo_err / photo_num))  # get root mean square error for each camera
+    n_disabled = 0
+    if disable_outlier_cameras == "TRUE":
+        n_disabled = diagnostics.disable_flagged()
+        print(str(n_disabled) + " flagged cameras disabled")
+    diagnostics.write_table(table_path)
 
-    return photo_avg  # returns list of rmse values for each camera
+    robust_rmse = diagnostics.mean_rmse()
+    return int(diagnostics.flagged.sum()), n_disabled, robust_rmse if not math.isnan(robust_rmse) else None
 
-def ref_setting_setup(doc, points, projections,
-                      home, name):
+def ref_setting_setup(doc, reproj_errors, robust_rmse=None):
 
-    #save first
-    # doc.save(home + name)
     chunk = doc.chunk
     # get number of aligned cameras
     n_aligned, n_not_aligned = count_aligned(chunk)
@@ -346,7 +451,7 @@ def ref_setting_setup(doc, points, projections,
     chunk.marker_location_accuracy = mark_loc_acc  # SINGLE VALUE USED WHEN MARKER-SPECIFIC ERRORS ARE UNAVAILABLE
     chunk.marker_projection_accuracy = mark_proj_acc  # FOR MANUALLY PLACED MARKERS
 
-    total_error = calc_reprojection_error(chunk, points, projections) # calculate reprojection error
+    total_error = calc_reprojection_error(reproj_errors()) # calculate reprojection error
 
     reproj_error = sum(total_error)/len(total_error) # get average rmse for all cameras
 
@@ -354,6 +459,10 @@ def ref_setting_setup(doc, points, projections,
     print(round(reproj_error, 3))
     print("max reprojection error is: " + str(max(total_error)))
 
+    if robust_rmse is not None:  # leave out the cameras flagged by the camera diagnostics
+        reproj_error = robust_rmse
+        print("mean reprojection error without flagged cameras: " + str(round(reproj_error, 3)))
+
 
     if reproj_error < 1:
         reproj_error = 1
@@ -363,10 +472,29 @@ def ref_setting_setup(doc, points, projections,
     tiepoint_acc = (round(reproj_error, 2))
     chunk.tiepoint_accuracy = tiepoint_acc
 
-    doc.save(home + name)
-
     return n_not_aligned
 
+def rank_marker_candidates(chunk, n_candidates, precreate, table_path):
+
+    if not chunk.markers:
+        print("no markers in the chunk - marker camera ranking skipped")
+        return 0
+    scale = chunk.transform.scale if chunk.transform.scale else 1.
+    ranking = rank_marker_cameras(chunk, int(n_candidates), scale)
+    write_ranking(ranking, table_path)
+    print("ranked cameras for " + str(len(ranking)) + "/" + str(len(chunk.markers)) + " markers - see " + table_path)
+
+    n_created = 0
+    if precreate == "TRUE":  # unpinned projections: the marker only has to be dragged into place and pinned
+        for marker, candidates in ranking.items():
+            for camera, distance, u, v, offset, score in candidates:
+                if camera not in marker.projections.keys():
+                    marker.projections[camera] = MS.Marker.Projection(MS.Vector([u, v]), False)
+                    n_created += 1
+        print(str(n_created) + " marker projections created")
+
+    return n_created
+
 def filter_reproj_err (chunk, reproj_err_limit):
     # Filter points by their reprojection error and remove those with values > 0.45 (or the limit set in the input file)
 
@@ -376,9 +504,11 @@ def filter_reproj_err (chunk, reproj_err_limit):
 
     f = MS.PointCloud.Filter()
     f.init(chunk, MS.PointCloud.Filter.ReprojectionError)
+    snapshot = tiepoint_snapshot(chunk)  # shared copy of the sparse cloud - read once per run
     f.selectPoints(Reproj_Err_Limit)
-    nselected = len([p for p in chunk.point_cloud.points if p.selected])
-    total_points = len(chunk.point_cloud.points)
+    snapshot.refresh_selected()
+    nselected = snapshot.n_selected()
+    total_points = len(snapshot)
     perc_ab_thresh = round((nselected/total_points*100), 1)
 
     if perc_ab_thresh > 20:
@@ -395,18 +525,55 @@ def filter_reproj_err (chunk, reproj_err_limit):
     print("Removing points above error threshold...")
 
     f.removePoints(Reproj_Err_Limit)
+    snapshot.remove_selected()
 
     return total_points, perc_ab_thresh, nselected
 
 
+def filter_outliers(chunk, outlier_neighbours, outlier_sigma):
+    # Statistical outlier removal: remove points whose mean distance to their nearest neighbours is more than
+    # outlier_sigma standard deviations above average
+
+    print("filtering tiepoint outliers (neighbours = " + str(outlier_neighbours) + ", sigma = " + str(outlier_sigma) +
+          ")")
+
+    snapshot = tiepoint_snapshot(chunk)
+    result = knn_outliers(snapshot, int(outlier_neighbours), float(outlier_sigma))
+    if result is None:
+        print("outlier filter skipped: scipy is not installed (metashape -m pip install scipy)")
+        return 0, 0
+    outliers, limit = result
+
+    scale = chunk.transform.scale if chunk.transform.scale else 1.
+    limit = round(limit * scale, 4) if not math.isnan(limit) else 0
+    n_outliers = int(np.count_nonzero(outliers))
+    n_valid = int(np.count_nonzero(snapshot.valid))
+
+    print("number of outlier points (mean neighbour distance > " + str(limit) + "): " + str(n_outliers) + "/" +
+          str(n_valid) + "(" + str(round(n_outliers / max(n_valid, 1) * 100, 2)) + "%)")
+
+    if n_outliers:
+        print("Removing outlier points...")
+        snapshot.set_selected(outliers)
+        chunk.point_cloud.removeSelectedPoints()
+        snapshot.remove_selected()
+
+    return n_outliers, limit
+
+
 def export_settings(orig_n_cams, n_filter_removed, perc_filter_removed, real_qual_thresh, n_not_aligned,
-                    total_points, nselected, home, doc_title):
+                    total_points, nselected, n_outliers, outlier_limit, home, doc_title, qual_rows):
     print("exporting settings to temp_folder")
 
     opt_list = ["n_cameras_loaded", "n_cams_removed_qual_filter", "%_cams_removed_qual_filter", "img_qual_min_val",
-                "n_cameras_not_aligned", "n_points_orig_SPC", "n_points_removed_reproj_filter"]
+                "n_cameras_not_aligned", "n_points_orig_SPC", "n_points_removed_reproj_filter",
+                "n_points_removed_outlier_filter", "outlier_filter_distance_limit"]
     params_list = [orig_n_cams, n_filter_removed, perc_filter_removed, real_qual_thresh, n_not_aligned,
-                   total_points, nselected]
+                   total_points, nselected, n_outliers, outlier_limit]
+
+    # image quality statistics (threshold, percentiles, histogram) follow the fixed rows read by part 3
+    opt_list += [r[0] for r in qual_rows]
+    params_list += [r[1] for r in qual_rows]
 
     if os.path.exists(home + '/' + doc_title + '.files'):
 
@@ -5,6 +5,7 @@
 #######################################################################################################################
 
 import Metashape as MS #MSCHANGE
+import numpy as np
 import os
 import csv
 import inspect
@@ -12,6 +13,18 @@ from datetime import datetime
 import sys
 import time
 
+sys.path.append(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))))  # find the workflow helper modules
+from metashape_tiepoints import tiepoint_snapshot, region_outliers
+from metashape_stages import StageRunner
+from metashape_save import SaveManager
+from metashape_instrument import StageMetrics
+from metashape_args import input_file_path
+from metashape_gradual import GradualSelection, parse_criteria
+from metashape_region import read_aoi, fit_region
+from metashape_markers import marker_position
+from metashape_tiles import (cameras_per_tile, split_tiles, tile_members, region_frame, tile_region, plan_report,
+                             tile_label)
+
 # Clear the Console screen
 MS.app.console_pane.clear()  # deactivate when running on ISCA MSCHANGE
 
@@ -24,7 +37,7 @@ print ("Script start time: " + str(startTime))
 def script_setup():
     file_loc = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 
-    input_file_B = (file_loc + "/" + "input_file.csv")
+    input_file_B = input_file_path(file_loc + "/" + "input_file.csv")  # --input <file> overrides
     input_file_B = input_file_B.replace('\\', '/')
 
 
@@ -57,6 +70,26 @@ def script_setup():
     pair_dpc_lim = var_list[35]
     pair_dpc_val = var_list[36]
 
+    save_policy = var_list[41]
+    save_interval = var_list[42]
+    save_backups = var_list[43]
+
+    gradual_selection = var_list[61]
+    gradual_criteria = var_list[62]
+    gradual_iterations = var_list[63]
+    gradual_tolerance = var_list[64]
+
+    region_source = var_list[68]
+    region_aoi = var_list[69]
+    region_trim = var_list[70]
+    region_margin = var_list[71]
+
+    tiling = var_list[72]
+    tile_cameras = var_list[73]
+    tile_memory = var_list[74]
+    tile_overlap = var_list[75]
+    tiles_per_run = var_list[76]
+
     # create export directory if it doesn't already exist
     if os.path.exists(exportdir):
 
@@ -87,6 +120,10 @@ def script_setup():
         except IOError:
             print("running interactively... continue")
 
+    # stage timings, memory and I/O go to <doc_title>.files/stage_metrics.jsonl
+    metrics = StageMetrics(home, doc_title, "part2", exportdir, {"dpc_quality": dpc_quality})
+    runner = StageRunner(home, doc_title, "part2", metrics=metrics)  # stage ledger - allows a killed run to be resumed
+
     doc.open(home + name, read_only=False)
     chunk = doc.chunk
 
@@ -99,18 +136,64 @@ def script_setup():
 
     count_aligned(chunk)
 
-    Optimise_Bundle_adj(chunk, doc, home, name, doc_title)
-
-    n_cams_enabled_DPC, n_points_final_SPC, n_points_orig_DPC, outside_BB = build_DPC(chunk, dpc_quality, pair_dm_lim, pair_dm_val,
-                                                                          pair_dpc_lim, pair_dpc_val)
-    doc.save(home + name)
-
-    export_settings(home, doc_title, outside_BB, n_points_final_SPC, n_points_orig_DPC, n_cams_enabled_DPC)
-
-    
-    doc.save(home + "/" + doc_title + "_backup2.psx", doc.chunks)
+    saves = SaveManager(doc, home, doc_title, "part2", save_policy, save_interval, save_backups, runner,
+                        metrics=metrics)
+
+    with saves.on_failure():
+        n_points_gradual = 0
+        if gradual_selection == "TRUE":  # iterative filtering, optimising the cameras after each criterion
+            gradual_args = (chunk, gradual_criteria, gradual_iterations, gradual_tolerance,
+                            home + '/' + doc_title + '.files/gradual_selection.csv')
+            optimised = runner.will_run("gradual_selection", *gradual_args)
+            n_points_gradual = runner.run("gradual_selection", run_gradual_selection, *gradual_args,
+                                          outputs=[home + '/' + doc_title + '.files/gradual_selection.csv'])
+            saves.checkpoint("gradual_selection")
+        else:
+            optimised = runner.will_run("Optimise_Bundle_adj", chunk)
+            runner.run("Optimise_Bundle_adj", Optimise_Bundle_adj, chunk)
+            saves.checkpoint("Optimise_Bundle_adj")
+        if optimised:  # a resumed run (e.g. the next batch of tiles) keeps the backup of the run that optimised
+            saves.backup(home + "/" + doc_title + "_backup.psx")
+
+        runner.run("set_region", set_region, chunk, region_source, region_aoi, region_trim, region_margin)
+        saves.checkpoint("set_region")
+
+        tile_rows = []
+        if tiling == "TRUE":  # depth maps and dense cloud per tile, a few tiles per run, then merged
+            n_cams_enabled_DPC, n_points_final_SPC, outside_BB = runner.run("prepare_DPC", prepare_DPC, chunk,
+                                                                            pair_dm_lim, pair_dm_val, pair_dpc_lim,
+                                                                            pair_dpc_val)
+            tiles = runner.run("plan_tiles", plan_tiles, doc, chunk, dpc_quality, tile_cameras, tile_memory,
+                               tile_overlap)
+            saves.checkpoint("plan_tiles", expensive=True)
+
+            if not build_tiles(runner, saves, doc, tiles, dpc_quality, tiles_per_run):
+                return  # this run's batch of tiles is saved and recorded - the rest of part 2 runs once all are built
+
+            n_points_orig_DPC, tile_rows = runner.run("merge_tiles", merge_tiles, doc, chunk, tiles,
+                                                      home + '/' + doc_title + '.files/merged_tiles.ply',
+                                                      check=lambda: chunk.dense_cloud is not None)
+            saves.checkpoint("merge_tiles", expensive=True)
+        else:
+            n_cams_enabled_DPC, n_points_final_SPC, n_points_orig_DPC, outside_BB = runner.run("build_DPC", build_DPC,
+                                                                                               chunk, dpc_quality,
+                                                                                               pair_dm_lim, pair_dm_val,
+                                                                                               pair_dpc_lim,
+                                                                                               pair_dpc_val,
+                                                                                               check=lambda: chunk.dense_cloud is not None)
+            saves.checkpoint("build_DPC", expensive=True)
+
+        runner.run("export_settings", export_settings, home, doc_title, outside_BB, n_points_final_SPC,
+                   n_points_orig_DPC, n_cams_enabled_DPC, n_points_gradual, tile_rows,
+                   outputs=[home + '/' + doc_title + '.files/PhSc2_settings_TEMP.csv'], project_stage=False)
+
+        saves.finish()
+
+    saves.backup(home + "/" + doc_title + "_backup2.psx")
 #####################################################################################################################
 
+DPC_DOWNSCALE = {"LowestQuality": 5, "LowQuality": 4, "MediumQuality": 3, "HighQuality": 2, "UltraQuality": 1}
+
 def check_markers(chunk):
     n_markers = len(chunk.markers)
     quit_yn = None
@@ -190,27 +273,86 @@ def count_aligned(chunk): # GET NUMBER OF ALIGNED AND NOT-ALIGNED CAMERAS
 
 
 
-def Optimise_Bundle_adj(chunk, doc, home, name, doc_title):
+def Optimise_Bundle_adj(chunk):
     chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True,
                           fit_b2=True, fit_k1=True, fit_k2=True, fit_k3=False,
                           fit_k4=False, fit_p1=True, fit_p2=True, fit_p3=False,
                           fit_p4=False)  # As suggested in James, et al. (2017)
 
     print("Optimization Parameters:")
-    print(MS.app.document.chunk.meta['optimize/fit_flags'])
+    print(chunk.meta['optimize/fit_flags'])
 
 
-    print("save")
-    doc.save(home + name)
-    doc.save(home + "/" + doc_title + "_backup.psx", doc.chunks)
+def run_gradual_selection(chunk, gradual_criteria, gradual_iterations, gradual_tolerance, log_path):
 
+    selection = GradualSelection(chunk, MS.PointCloud.Filter, parse_criteria(gradual_criteria), Optimise_Bundle_adj,
+                                 int(gradual_iterations), float(gradual_tolerance)).run()
+    selection.write_log(log_path)
+    selection.report()
 
-def build_DPC(chunk, dpc_quality, pair_dm_lim, pair_dm_val, pair_dpc_lim, pair_dpc_val):
+    if selection.n_optimized == 0:  # nothing removed - still optimise once, as without gradual selection
+        Optimise_Bundle_adj(chunk)
+
+    return selection.n_removed
+
+
+def set_region(chunk, region_source, region_aoi, region_trim, region_margin):
 
     chunk.resetRegion()  # reset bounding region following the manual point cleaning
     region = chunk.region
-    region.size = 1.5 * region.size  # increase bounding region
-    chunk.region = region  # set new region
+    scale = chunk.transform.scale if chunk.transform.scale else 1.
+    default_volume = (1.5 ** 3) * region.size.x * region.size.y * region.size.z * scale ** 3
+
+    if region_source == "DEFAULT":
+        region.size = 1.5 * region.size  # increase bounding region
+        chunk.region = region  # set new region
+        print("region: tie point box x 1.5 (" + str(round(default_volume)) + " m3)")
+        return round(default_volume, 1), round(default_volume, 1)
+
+    T = chunk.transform.matrix
+    up = np.array([0., 0., 1.])
+    to_internal = None
+    if T is not None and chunk.crs is not None:  # vertical direction and CRS -> chunk conversion
+        T_inv = T.inv()
+
+        def to_internal(p):
+            return np.array(tuple(T_inv.mulp(chunk.crs.unproject(MS.Vector([float(v) for v in p])))))
+
+        c = chunk.crs.project(T.mulp(region.center))
+        up = to_internal([c.x, c.y, c.z + 1]) - to_internal([c.x, c.y, c.z])
+
+    vertices = None
+    if region_source == "AOI":
+        if to_internal is None or not os.path.isfile(region_aoi):
+            print("region: AOI file missing or chunk not referenced - using the tie point extent")
+        else:
+            vertices = np.array([to_internal(v) for v in read_aoi(region_aoi)])
+    elif region_source == "MARKERS":
+        positions = [marker_position(chunk, m) for m in chunk.markers]
+        positions = [tuple(p) for p in positions if p is not None]
+        if len(positions) < 3:
+            print("region: fewer than 3 located markers - using the tie point extent")
+        else:
+            vertices = np.array(positions, dtype=float)
+
+    snapshot = tiepoint_snapshot(chunk)
+    fit = fit_region(snapshot.coords[snapshot.valid, :3], up, region_source if vertices is not None else "TIEPOINTS",
+                     vertices, float(region_trim), float(region_margin))
+
+    region.center = MS.Vector(fit.center.tolist())
+    region.size = MS.Vector(fit.size.tolist())
+    region.rot = MS.Matrix(fit.rot.tolist())
+    chunk.region = region
+
+    volume = fit.volume() * scale ** 3
+    print("region fitted to " + fit.source + ": " + " x ".join(str(round(v * scale, 1)) for v in fit.size) +
+          " m, " + str(round(volume)) + " m3 instead of " + str(round(default_volume)) + " m3 with the 1.5 x box (" +
+          str(round((1 - volume / default_volume) * 100, 1)) + "% less volume)")
+
+    return round(volume, 1), round(default_volume, 1)
+
+
+def prepare_DPC(chunk, pair_dm_lim, pair_dm_val, pair_dpc_lim, pair_dpc_val):
 
     #####  Check number of enabled cameras ###
     camlist = []
@@ -222,30 +364,15 @@ def build_DPC(chunk, dpc_quality, pair_dm_lim, pair_dm_val, pair_dpc_lim, pair_d
 
     ## check number of points in final sparse cloud ###
     # first check n points outside bounding box: ###
-    R = chunk.region.rot
-    C = chunk.region.center
-    size = chunk.region.size
-    for point in chunk.point_cloud.points:
-        if point.valid:
-            v = point.coord
-            v.size = 3
-            v_c = v - C
-            v_r = R.t() * v_c
-            if abs(v_r.x) > abs(size.x / 2.):
-                point.selected = True
-            elif abs(v_r.z) > abs(size.z / 2.):
-                point.selected = True
-            elif abs(v_r.y) > abs(size.y / 2.):
-                point.selected = True
-            else:
-                continue
-
-    outside_BB = len([p for p in chunk.point_cloud.points if p.selected])
+    snapshot = tiepoint_snapshot(chunk)  # coordinates and flags of the sparse cloud, read in one pass
+    outside, n_outside, n_inside = region_outliers(chunk, snapshot, select=True)  # select points outside region
+
+    outside_BB = snapshot.n_selected()
 
     print("number of points outside bounding box is:" + str(outside_BB))
 
 
-    n_points_final_SPC = len(chunk.point_cloud.points) - outside_BB
+    n_points_final_SPC = len(snapshot) - outside_BB
 
     if pair_dm_lim == "TRUE":  # This part determines if a pair limit is required for depth map filtering
 
@@ -263,28 +390,30 @@ def build_DPC(chunk, dpc_quality, pair_dm_lim, pair_dm_val, pair_dpc_lim, pair_d
     else:
         MS.app.settings.setValue('main/dense_cloud_max_neighbors', -1)
 
+    return n_cams_enabled_DPC, n_points_final_SPC, outside_BB
 
 
-    print("building Dense Point Cloud...")
+def dpc_downscale(dpc_quality):  # depth map downscale for the DPC quality in the input file
 
-    if dpc_quality == "LowestQuality":
-        chunk.buildDepthMaps(downscale=5, filter_mode=MS.MildFiltering, reuse_depth=True)
-    elif dpc_quality == "LowQuality":
-        chunk.buildDepthMaps(downscale=4, filter_mode=MS.MildFiltering, reuse_depth=True)
-    elif dpc_quality == "MediumQuality":
-        chunk.buildDepthMaps(downscale=3, filter_mode=MS.MildFiltering, reuse_depth=True)
-    elif dpc_quality == "HighQuality":
-        chunk.buildDepthMaps(downscale=2, filter_mode=MS.MildFiltering, reuse_depth=True)
-    elif dpc_quality == "UltraQuality":
-        chunk.buildDepthMaps(downscale=1, filter_mode=MS.MildFiltering, reuse_depth=True)
-    else:
+    if dpc_quality in DPC_DOWNSCALE:
+        return DPC_DOWNSCALE[dpc_quality]
+
+    print("---------------------------------------------------------------------------------------------")
+    print("--------------------- WARNING! SET A CORRECT NAME FOR DPC QUALITY ---------------------------")
+    print("------------------------------- DEFAULTING TO HIGH QUALITY ----------------------------------")
+    print("---------------------------------------------------------------------------------------------")
 
-        print("---------------------------------------------------------------------------------------------")
-        print("--------------------- WARNING! SET A CORRECT NAME FOR DPC QUALITY ---------------------------")
-        print("------------------------------- DEFAULTING TO HIGH QUALITY ----------------------------------")
-        print("---------------------------------------------------------------------------------------------")
+    return DPC_DOWNSCALE["HighQuality"]
 
-        chunk.buildDepthMaps(downscale=2, filter_mode=MS.MildFiltering, reuse_depth=True)
+
+def build_DPC(chunk, dpc_quality, pair_dm_lim, pair_dm_val, pair_dpc_lim, pair_dpc_val):
+
+    n_cams_enabled_DPC, n_points_final_SPC, outside_BB = prepare_DPC(chunk, pair_dm_lim, pair_dm_val, pair_dpc_lim,
+                                                                     pair_dpc_val)
+
+    print("building Dense Point Cloud...")
+
+    chunk.buildDepthMaps(downscale=dpc_downscale(dpc_quality), filter_mode=MS.MildFiltering, reuse_depth=True)
 
     chunk.buildDenseCloud(point_colors=True)
 
@@ -293,11 +422,144 @@ def build_DPC(chunk, dpc_quality, pair_dm_lim, pair_dm_val, pair_dpc_lim, pair_d
 
     return n_cams_enabled_DPC, n_points_final_SPC, n_points_orig_DPC, outside_BB
 
-def export_settings(home, doc_title, outside_BB, n_points_final_SPC, n_points_orig_DPC, n_cams_enabled_DPC):
+
+def find_chunk(doc, label):
+    for chunk in doc.chunks:
+        if chunk.label == label:
+            return chunk
+    return None
+
+
+def plan_tiles(doc, chunk, dpc_quality, tile_cameras, tile_memory, tile_overlap):
+
+    for old in [c for c in doc.chunks if c.label.startswith(chunk.label + " tile ") or
+                c.label == chunk.label + " merged"]:  # tiles of an earlier plan, or their merge if it was interrupted
+        doc.remove([old])
+
+    region = chunk.region
+    center = np.array(tuple(region.center), dtype=float)
+    rot = np.array([list(region.rot.row(i)) for i in range(3)], dtype=float)
+    size = np.array(tuple(region.size), dtype=float)
+    scale = chunk.transform.scale if chunk.transform.scale else 1.
+    margin = float(tile_overlap) / scale  # metres -> chunk units
+
+    cameras = [c for c in chunk.cameras if c.transform and c.enabled]
+    if not cameras:
+        raise RuntimeError("no aligned and enabled cameras in " + chunk.label + " - nothing to build tiles from")
+    xy = region_frame(center, rot, [tuple(c.center) for c in cameras])
+    sensor = cameras[0].sensor
+    max_per_tile = cameras_per_tile(tile_cameras, tile_memory, sensor.width, sensor.height, dpc_downscale(dpc_quality))
+
+    boxes = split_tiles(xy, -size[:2] / 2., size[:2] / 2., max_per_tile)
+    index = dict((camera, i) for i, camera in enumerate(chunk.cameras))
+
+    tiles = []
+    for i, (lo, hi) in enumerate(boxes):
+        members = set(index[cameras[k]] for k in tile_members(xy, lo, hi, margin))
+        tile = chunk.copy()
+        tile.label = tile_label(chunk.label, i, len(boxes))
+        tile.remove([c for k, c in enumerate(tile.cameras) if k not in members])
+
+        tile_center, tile_size = tile_region(center, rot, size, lo, hi, margin)  # depth maps: tile plus overlap
+        tile_box = tile.region
+        tile_box.center = MS.Vector(tile_center.tolist())
+        tile_box.size = MS.Vector(tile_size.tolist())
+        tile_box.rot = region.rot
+        tile.region = tile_box
+        core_center, core_size = tile_region(center, rot, size, lo, hi)  # dense cloud: the tile only
+        tile.meta["workflow/tile_core"] = ",".join(str(v) for v in core_center.tolist() + core_size.tolist())
+
+        tiles.append([tile.label, len(members)])
+
+    plan_report(boxes, [n for label, n in tiles], max_per_tile)
+    return tiles
+
+
+def build_tile(doc, label, dpc_quality):
+
+    tile = find_chunk(doc, label)
+    print("building depth maps for " + label + " (" + str(len(tile.cameras)) + " cameras)...")
+    tile.buildDepthMaps(downscale=dpc_downscale(dpc_quality), filter_mode=MS.MildFiltering, reuse_depth=True)
+
+    core = [float(v) for v in tile.meta["workflow/tile_core"].split(",")]
+    region = tile.region
+    region.center = MS.Vector(core[:3])
+    region.size = MS.Vector(core[3:])
+    tile.region = region  # dense points only inside the tile, so neighbouring tiles don't overlap
+
+    print("building Dense Point Cloud for " + label + "...")
+    tile.buildDenseCloud(point_colors=True)
+    return tile.dense_cloud.point_count
+
+
+def build_tiles(runner, saves, doc, tiles, dpc_quality, tiles_per_run):  # False if tiles are left for the next run
+    n_built = 0
+    for label, n_tile_cameras in tiles:
+        if runner.completed("dense " + label):
+            continue
+        if tiles_per_run != "ALL" and n_built >= int(tiles_per_run):
+            # stop before the next tile, whatever the save policy: saving the project also marks the tiles built in
+            # this run as complete and saved in the stage ledger, so the next run starts at the next tile and the batch
+            # scheduler and work queue (which compare completed stages before and after a run) see the part as
+            # incomplete rather than failed
+            saves.save("tile batch")
+            print("-------------------------------------------------------------")
+            print(str(n_built) + " tiles built in this run - run part 2 again to build the next tiles")
+            print("-------------------------------------------------------------")
+            return False
+        runner.run("dense " + label, build_tile, doc, label, dpc_quality,
+                   check=lambda: find_chunk(doc, label).dense_cloud is not None)
+        saves.checkpoint("dense " + label, expensive=True)
+        n_built += 1
+    return True
+
+
+def merge_tiles(doc, chunk, tiles, merge_path):
+
+    chunks = [find_chunk(doc, label) for label, n_cameras in tiles]
+    tile_rows = [[label, n_cameras, c.dense_cloud.point_count] for (label, n_cameras), c in zip(tiles, chunks)]
+
+    print("merging the dense clouds of " + str(len(chunks)) + " tiles...")
+    doc.mergeChunks(chunks=[c.key for c in chunks], merge_dense_clouds=True, merge_markers=False)
+    merged = doc.chunks[-1]
+    merged.label = chunk.label + " merged"
+
+    # the merged chunk only holds the dense clouds and the tile cameras (twice where tiles overlap), without the
+    # reference settings and tie points part 3 reads - its dense cloud is moved into the source chunk instead
+    points_crs = {}
+    if chunk.crs is not None and chunk.transform.matrix is not None:  # shifted, so the coordinates keep their precision
+        center = chunk.crs.project(chunk.transform.matrix.mulp(chunk.region.center))
+        points_crs = {"crs": chunk.crs, "shift": MS.Vector([round(center.x, -3), round(center.y, -3), 0.])}
+    merged.exportPoints(merge_path, source_data=MS.DenseCloudData, format=MS.PointsFormatPLY, save_normals=True,
+                        save_colors=True, save_classes=True, save_confidence=True, **points_crs)
+    if chunk.dense_cloud is not None:  # from an earlier run
+        chunk.remove([chunk.dense_cloud])
+    chunk.importPoints(merge_path, format=MS.PointsFormatPLY, calculate_normals=False, **points_crs)
+    os.remove(merge_path)
+
+    for c in chunks + [merged]:
+        doc.remove([c])
+    doc.chunk = chunk
+
+    n_points_orig_DPC = chunk.dense_cloud.point_count
+    print("merged dense cloud: " + str(n_points_orig_DPC) + " points")
+    return n_points_orig_DPC, tile_rows
+
+
+def export_settings(home, doc_title, outside_BB, n_points_final_SPC, n_points_orig_DPC, n_cams_enabled_DPC,
+                    n_points_gradual, tile_rows):
     print("exporting settings to temp_folder")
 
-    opt_list = ["n_points_outside_BB","n_points_final_SPC", "n_points_orig_DPC", "n_cams_enabled_DPC"]
-    params_list = [outside_BB, n_points_final_SPC, n_points_orig_DPC, n_cams_enabled_DPC]
+    opt_list = ["n_points_outside_BB","n_points_final_SPC", "n_points_orig_DPC", "n_cams_enabled_DPC",
+                "n_points_removed_gradual_selection"]
+    params_list = [outside_BB, n_points_final_SPC, n_points_orig_DPC, n_cams_enabled_DPC, n_points_gradual]
+
+    # tiled dense cloud: cameras and dense points of each tile
+    opt_list += ["n_tiles"]
+    params_list += [len(tile_rows)]
+    for i, (label, n_cameras, n_points) in enumerate(tile_rows):
+        opt_list += ["tile_" + str(i + 1) + "_n_cameras", "tile_" + str(i + 1) + "_n_points_DPC"]
+        params_list += [n_cameras, n_points]
     if os.path.exists(home + '/' + doc_title + '.files'):
 
         with open(home + '/' + doc_title + '.files/PhSc2_settings_TEMP.csv', 'w', newline='') as f:
@@ -8,10 +8,21 @@ import os
 import csv
 import inspect
 import shutil
+import sys
 from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))))  # find the workflow helper modules
+from metashape_stages import StageRunner, fingerprint
+from metashape_save import SaveManager
+from metashape_instrument import StageMetrics
+from metashape_args import input_file_path
+from metashape_exports import ExportFanOut, export_workers, run_job, worker_command
+from metashape_products import ProductPlan
+from metashape_pyramid import derive_raster
 #hello
 # Clear the Console screen
-PS.app.console.clear()  # comment out when using ISCA
+if "--export-worker" not in sys.argv:  # export workers write to their own log
+    PS.app.console.clear()  # comment out when using ISCA
 
 startTime = datetime.now()
 print("Script start time: " + str(startTime))
@@ -21,18 +32,20 @@ print("Script start time: " + str(startTime))
 def script_setup():
     file_loc = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 
-    input_file_B = (file_loc + "/" + "input_file.csv")
+    input_file_B = input_file_path(file_loc + "/" + "input_file.csv")  # --input <file> overrides
     input_file_B = input_file_B.replace('\\', '/')
 
     print(input_file_B)
 
     var_list = []
+    config = {}  # {variable: value} - used for the stage fingerprints
 
     with open(input_file_B, 'r') as f:
         mycsv = csv.reader(f)
         for row in mycsv:
             colB = row[1]
             var_list.append(colB)
+            config[row[0]] = colB
     #getting directories etc.
     home = var_list[1]
     doc_title = var_list[2]
@@ -69,10 +82,26 @@ def script_setup():
 
     # big tiff options
     bt_ortho_lr = var_list[21]
-    bt_ortho_hr = var_list[22]
+    bt_ortho_hr = var_list[24]
     bt_dsm_lr = var_list[27]
     bt_dsm_hr = var_list[30]
 
+    # project save options
+    save_policy = var_list[41]
+    save_interval = var_list[42]
+    save_backups = var_list[43]
+
+    # export fan-out options
+    e_workers = var_list[77]
+    e_worker_mem = var_list[78]
+
+    # build only the products the requested exports need
+    product_planning = var_list[79]
+
+    # low resolution ortho / DSM made from the high resolution export
+    raster_pyramid = var_list[80]
+    pyramid_dsm_method = var_list[81]
+
     print(home)
     print(doc_title)
     print(datadir)
@@ -87,30 +116,140 @@ def script_setup():
         PS.app.cpu_enable = False # Disable CPU for GPU accelerated tasks (faster when multiple GPUs are present)
 
 
-    doc.open(home + name, read_only=False)
+    # stage timings, memory and I/O go to <doc_title>.files/stage_metrics.jsonl
+    metrics = StageMetrics(home, doc_title, "part3", exportdir, {"mesh_quality": mesh_qual,
+                                                                 "ortho_resolutions": [r_ortho_lr, r_ortho_hr],
+                                                                 "dsm_resolutions": [r_dsm_lr, r_dsm_hr]})
+    runner = StageRunner(home, doc_title, "part3", watch_dir=exportdir,
+                         metrics=metrics)  # stage ledger - allows a killed run to be resumed
+
+    doc.open(home + name, read_only=runner.explain)
     chunk = doc.chunk
 
     dpc_npoints = chunk.dense_cloud.point_count
 
-    export_DPC(chunk, doc_title, exportdir, e_DPC)
+    ortho_surface = "mesh"
+    if product_planning == "TRUE":  # the plan replaces the Build_* flags (also in the fingerprints below)
+        plan = ProductPlan(config, dpc_npoints, metrics.path)
+        plan.report()
+        b_mesh, b_texture, b_ortho, b_dsm = [plan.flag(s) for s in ("build_mesh", "build_texture", "build_ortho",
+                                                                     "build_dsm")]
+        config.update(Build_Mesh=b_mesh, Build_Texture=b_texture, Build_Orthomosaic=b_ortho, Build_DSM=b_dsm)
+        ortho_surface = plan.surface or "mesh"
+
+    # stage fingerprints: the input_file.csv settings each stage depends on plus its upstream products - a stage is
+    # only run again when its fingerprint changes (run with --explain to see what will run and why)
+    fp_dense = fingerprint(config, [], state={"dense_cloud_points": dpc_npoints})
+    fp_e_dpc = fingerprint(config, ["Export_Dense_Point_Cloud", "Export_Folder"], {"dense_cloud": fp_dense})
+    fp_mesh = fingerprint(config, ["Build_Mesh", "Mesh_Quality"], {"dense_cloud": fp_dense})
+    fp_texture = fingerprint(config, ["Build_Texture"], {"build_mesh": fp_mesh})
+    fp_e_model = fingerprint(config, ["Export_Model", "Export_Folder"], {"build_texture": fp_texture})
+    fp_dsm = fingerprint(config, ["Build_DSM"], {"dense_cloud": fp_dense})
+    if ortho_surface == "dem":
+        fp_ortho = fingerprint(config, ["Build_Orthomosaic"], {"build_dsm": fp_dsm}, state={"ortho_surface": "dem"})
+    else:
+        fp_ortho = fingerprint(config, ["Build_Orthomosaic"], {"build_mesh": fp_mesh})
+    fp_e_ortho_lr = fingerprint(config, ["Export_Orthomosaic_LowRes", "Orthomosaic_LowRes_Resolution",
+                                         "Orthomosaic_LowRes_Write_Big_Tiff", "Export_Folder"], {"build_ortho": fp_ortho})
+    fp_e_ortho_hr = fingerprint(config, ["Export_Orthomosaic_HighRes", "Orthomosaic_HighRes_Resolution",
+                                         "Orthomosaic_HighRes_Write_Big_Tiff", "Export_Folder"], {"build_ortho": fp_ortho})
+    fp_e_dsm_lr = fingerprint(config, ["Export_DSM_LowRes", "DSM_LowRes_Resolution", "DSM_LowRes_Write_Big_Tiff",
+                                       "Export_Folder"], {"build_dsm": fp_dsm})
+    # with the raster pyramid the HR DSM is written uncompressed, so an existing compressed one has to be exported again
+    dsm_pyramid = raster_pyramid == "TRUE" and e_dsm_lr == "TRUE" and e_dsm_hr == "TRUE" and \
+        float(r_dsm_lr) > float(r_dsm_hr)
+    fp_e_dsm_hr = fingerprint(config, ["Export_DSM_HighRes", "DSM_HighRes_Resolution", "DSM_HighRes_Write_Big_Tiff",
+                                       "Export_Folder"], {"build_dsm": fp_dsm},
+                              state={"uncompressed": True} if dsm_pyramid else None)
+    fp_report = fingerprint(config, ["Export_Report", "Export_Folder"],
+                            {"build_texture": fp_texture, "build_ortho": fp_ortho, "build_dsm": fp_dsm})
+
+    saves = SaveManager(doc, home, doc_title, "part3", save_policy, save_interval, save_backups, runner,
+                        read_only=runner.explain, metrics=metrics)
+
+    # export stages: (function, arguments after chunk, fingerprint)
+    exports = {"export_DPC": (export_DPC, [doc_title, exportdir, e_DPC], fp_e_dpc),
+               "export_model": (export_model, [e_model, exportdir, doc_title], fp_e_model),
+               "export_ortho_LR": (export_ortho, [exportdir, doc_title, e_ortho_lr, r_ortho_lr, bt_ortho_lr, "LR"],
+                                   fp_e_ortho_lr),
+               "export_ortho_HR": (export_ortho, [exportdir, doc_title, e_ortho_hr, r_ortho_hr, bt_ortho_hr, "HR"],
+                                   fp_e_ortho_hr),
+               "export_dsm_LR": (export_dsm, [exportdir, doc_title, e_dsm_lr, r_dsm_lr, bt_dsm_lr, "LR"], fp_e_dsm_lr),
+               "export_dsm_HR": (export_dsm, [exportdir, doc_title, e_dsm_hr, r_dsm_hr, bt_dsm_hr, "HR"], fp_e_dsm_hr),
+               "export_report": (export_report, [exportdir, doc_title, e_report], fp_report)}
+    fan_out = e_workers not in ("FALSE", "NONE", "0") and not runner.explain
+
+    # raster pyramid: LR export stage -> (product, HR resolution, LR resolution, LR big tiff, method, fingerprint)
+    pyramid = {}
+    if raster_pyramid == "TRUE":
+        if e_ortho_lr == "TRUE" and e_ortho_hr == "TRUE" and float(r_ortho_lr) > float(r_ortho_hr):
+            pyramid["export_ortho_LR"] = ("Ortho", r_ortho_hr, r_ortho_lr, bt_ortho_lr, "average", fingerprint(
+                config, ["Export_Orthomosaic_LowRes", "Orthomosaic_LowRes_Resolution", "Orthomosaic_LowRes_Write_Big_Tiff",
+                         "Export_Folder", "Raster_Pyramid"], {"export_ortho_HR": fp_e_ortho_hr}))
+        if dsm_pyramid:
+            pyramid["export_dsm_LR"] = ("DSM", r_dsm_hr, r_dsm_lr, bt_dsm_lr, pyramid_dsm_method, fingerprint(
+                config, ["Export_DSM_LowRes", "DSM_LowRes_Resolution", "DSM_LowRes_Write_Big_Tiff", "Export_Folder",
+                         "Raster_Pyramid", "Raster_Pyramid_DSM_Method"], {"export_dsm_HR": fp_e_dsm_hr}))
+            exports["export_dsm_HR"][1].append(True)  # uncompressed, so that it can be read back block by block
+        for name in pyramid:
+            del exports[name]
+
+    def export(name):  # run an export stage now - or leave it to the export workers after the builds
+        if fan_out:
+            return
+        if name in pyramid:
+            derive(name)
+        else:
+            func, args, fp = exports[name]
+            runner.run(name, func, chunk, *args, project_stage=False, fingerprint=fp)
+
+    def derive(name):  # a low resolution raster from the high resolution export
+        product, r_hr, r_lr, bt_lr, method, fp = pyramid[name]
+        runner.run(name, derive_lowres, chunk, exportdir, doc_title, product, r_hr, r_lr, bt_lr, method,
+                   project_stage=False, fingerprint=fp)
+
+    with saves.on_failure():
+        export("export_DPC")
+
+        runner.run("build_mesh", build_mesh, chunk, b_mesh, mesh_qual, fingerprint=fp_mesh,
+                   check=lambda: b_mesh != "TRUE" or chunk.model is not None)
+        saves.checkpoint("build_mesh", expensive=True)
+
+        runner.run("build_texture", build_texture, chunk, b_texture, fingerprint=fp_texture,
+                   check=lambda: b_texture != "TRUE" or chunk.model is not None)
+        saves.checkpoint("build_texture", expensive=True)
+
+        export("export_model")
 
-    build_mesh(chunk, doc, home, name, b_mesh, mesh_qual)
+        runner.run("build_dsm", build_dsm, chunk, b_dsm, fingerprint=fp_dsm,  # before the ortho - may be its surface
+                   check=lambda: b_dsm != "TRUE" or chunk.elevation is not None)
+        saves.checkpoint("build_dsm", expensive=True)
 
-    build_texture(chunk, doc, home, name, b_texture, e_model, exportdir, doc_title)
+        export("export_dsm_HR")
+        export("export_dsm_LR")
 
-    build_ortho(chunk, exportdir, doc, home, name, doc_title, b_ortho, e_ortho_lr, e_ortho_hr, r_ortho_lr, r_ortho_hr,
-                bt_ortho_lr, bt_ortho_hr)
+        runner.run("build_ortho", build_ortho, chunk, b_ortho, ortho_surface, fingerprint=fp_ortho,
+                   check=lambda: b_ortho != "TRUE" or chunk.orthomosaic is not None)
+        saves.checkpoint("build_ortho", expensive=True)
 
-    build_dsm(chunk, exportdir, doc_title, doc, home, name, b_dsm, e_dsm_lr, e_dsm_hr, r_dsm_lr, r_dsm_hr,
-              bt_dsm_lr, bt_dsm_hr)
+        export("export_ortho_HR")
+        export("export_ortho_LR")
+        export("export_report")
 
-    export_report(chunk, exportdir, doc_title, e_report)
+        if fan_out:
+            fan_out_exports(runner, saves, metrics, chunk, exports, home, doc_title, exportdir, e_workers, e_worker_mem)
+            for name in pyramid:
+                derive(name)
 
-    create_settings_summary(chunk, home, doc_title, exportdir, dpc_npoints)
+        runner.run("create_settings_summary", create_settings_summary, chunk, home, doc_title, exportdir, dpc_npoints,
+                   project_stage=False)
 
-    doc.save(home + name)
-    
-    doc.save(home + "/" + doc_title + "_backup.psx", doc.chunks)
+        saves.finish()
+
+    if runner.explain:  # nothing was run - leave the project untouched
+        return
+
+    saves.backup(home + "/" + doc_title + "_backup.psx")
 
    # Removing unecessary second backup file
     if os.path.isfile(home + "/" + doc_title + "_backup2.psx"):
@@ -119,12 +258,61 @@ def script_setup():
         print("Deleting backup2")
     else: print("Backup2 file does not exist")
 
+def fan_out_exports(runner, saves, metrics, chunk, exports, home, doc_title, exportdir, e_workers, e_worker_mem):
+    # run the export stages that are due in parallel worker processes (see metashape_exports.py)
+    due = [n for n, (func, args, fp) in exports.items() if runner.will_run(n, chunk, *args, fingerprint=fp)]
+    command = worker_command() if due else None
+    if due and command is None:
+        print("export workers skipped: " + sys.executable + " cannot import Metashape in a worker process - "
+              "exporting one after the other")
+    elif due:
+        if saves.dirty:  # the workers read the saved project
+            saves.save("before export workers")
+        workers = export_workers(e_workers, e_worker_mem, len(due))
+        fan = ExportFanOut(os.path.abspath(inspect.getfile(inspect.currentframe())), home + "/" + doc_title + ".psx",
+                           command, home + "/" + doc_title + ".files/export_jobs", workers)
+        for name in due:
+            func, args, fp = exports[name]
+            fan.add(name, func.__name__, *args)
+        start = datetime.now()
+        fan.run()
+        fan.write_table(exportdir + "/" + doc_title + "_export_results.csv")
+        fan.report((datetime.now() - start).total_seconds())
+        for name, result in fan.results.items():
+            record = dict(metrics.base)
+            record.update(time=result["started"], stage=name, kind="export worker", status=result["status"],
+                          wall_s=result["seconds"], error=result["error"])
+            metrics.write(record)
+
+    failed = []
+    for name, (func, args, fp) in exports.items():  # record the results (and skip the exports that were not due)
+        try:
+            if name in due and command is not None:
+                output = fan.results[name]["output"]
+                runner.run(name, fan.result, name, outputs=[output] if output else None, project_stage=False,
+                           fingerprint=fp)
+            else:
+                runner.run(name, func, chunk, *args, project_stage=False, fingerprint=fp)
+        except RuntimeError as e:
+            print(str(e))
+            failed.append(name)
+    if failed:
+        raise RuntimeError("exports failed: " + ", ".join(failed) + " - see " + doc_title + "_export_results.csv")
+
+
+def open_read_only(path):  # export workers: the chunk of the saved project, without locking it
+    doc = PS.Document()
+    doc.open(path, read_only=True)
+    return doc.chunk
+
+
 def export_DPC(chunk, doc_title, exportdir, e_DPC):  # export points
     if e_DPC == "TRUE":
         if chunk.dense_cloud is not None:
             print("Exporting Dense Point Cloud")
             dpc_name = "/" + doc_title + "_dpc_export.laz"
             chunk.exportPoints(exportdir + dpc_name, precision=3, projection=chunk.crs)  # specify projection to use.
+            return exportdir + dpc_name
         else:
             print("you need to build a dense point cloud")
     else:
@@ -132,7 +320,7 @@ def export_DPC(chunk, doc_title, exportdir, e_DPC):  # export points
         pass
 
 
-def build_mesh(chunk, doc, home, name, b_mesh, mesh_qual):
+def build_mesh(chunk, b_mesh, mesh_qual):
 
     if b_mesh == "TRUE":
         print("building mesh")
@@ -153,23 +341,23 @@ def build_mesh(chunk, doc, home, name, b_mesh, mesh_qual):
             print("---------------------------------------------------------------------------------------------")
             chunk.buildModel(surface=PS.HeightField, source=PS.DenseCloudData, interpolation=PS.EnabledInterpolation,
                              face_count=PS.HighFaceCount, vertex_colors=True)
-        doc.save(home + name)  # save
 
     else:
         print("meshing build option not selected")
 
 
-def build_texture(chunk, doc, home, name, b_texture, e_model, exportdir, doc_title):
+def build_texture(chunk, b_texture):
     if b_texture == "TRUE":
         print("building texture")
         chunk.buildUV(mapping=PS.GenericMapping)
         chunk.buildTexture(blending=PS.MosaicBlending, size=2048, fill_holes=True, ghosting_filter=True)
 
-        doc.save(home + name)  # save
 
     else:
         print("texture build option not selected")
 
+
+def export_model(chunk, e_model, exportdir, doc_title):
     if e_model == "TRUE":
         if chunk.model is not None:
             print("exporting textured model")
@@ -177,6 +365,7 @@ def build_texture(chunk, doc, home, name, b_texture, e_model, exportdir, doc_tit
             chunk.exportModel(model_path, binary=True, precision=3, texture_format=PS.ImageFormatJPEG, texture=True,
                         normals=False, colors=True, udim=False,
                         strip_extensions=False, raster_transform=PS.RasterTransformNone)
+            return model_path
 
         else:
             print(" WARNING: must build mesh and texture before export")
@@ -184,143 +373,81 @@ def build_texture(chunk, doc, home, name, b_texture, e_model, exportdir, doc_tit
         print("textured model export not selected")
 
 
-def build_ortho(chunk, exportdir, doc, home, name, doc_title, b_ortho, e_ortho_lr, e_ortho_hr, r_ortho_lr, r_ortho_hr,
-                bt_ortho_lr, bt_ortho_hr):  # Currently no option to add "description metadata to exports add when available!!!
+def build_ortho(chunk, b_ortho, surface="mesh"):  # Currently no option to add "description metadata to exports add when available!!!
     if b_ortho == "TRUE":
-        print("building Orthomosaic")
-        chunk.buildOrthomosaic(surface=PS.ModelData, blending=PS.MosaicBlending, fill_holes=True)
-        doc.save(home + name)  # save
+        print("building Orthomosaic on the " + ("DEM" if surface == "dem" else "mesh"))
+        chunk.buildOrthomosaic(surface=PS.ElevationData if surface == "dem" else PS.ModelData,
+                               blending=PS.MosaicBlending, fill_holes=True)
     else:
         print("build orthomosaic option not selected")
 
-    o_mm_lr = int(round(float(r_ortho_lr) * 1000))
-    o_mm_hr = int(round(float(r_ortho_hr) * 1000))
 
-    if bt_ortho_lr == "TRUE":  # if low res ortho big tiff option true
-        if e_ortho_lr == "TRUE":
-            if chunk.orthomosaic is not None:
-                print("exporting low resolution orthomosaic")
-                ortho_res_lr = float(r_ortho_lr)  # set the desired resolution
+def export_ortho(chunk, exportdir, doc_title, e_ortho, r_ortho, bt_ortho, res_label):  # res_label is "LR" or "HR"
+    res_name = {"LR": "low", "HR": "high"}[res_label]
 
-                ortho_path_lr = exportdir + "/" + doc_title + "_Ortho_LR_"+ str(o_mm_lr) + "mm.tiff"
-                chunk.exportOrthomosaic(ortho_path_lr, raster_transform=PS.RasterTransformNone, dx=ortho_res_lr,
-                                        dy=ortho_res_lr, tiff_big=True, tiff_compression=PS.TiffCompressionNone,
-                                        write_alpha=True)
-            else:
-                print("must build Orthomosaic before export")
-        else:
-            print("low resolution Orthomosaic export option not selected")
-    else:  # big tiff false here...
-        if e_ortho_lr == "TRUE":
-            if chunk.orthomosaic is not None:
-                print("exporting low resolution orthomosaic")
-                ortho_res_lr = float(r_ortho_lr)  # set the desired resolution
-
-                ortho_path_lr = exportdir + "/" + doc_title + "_Ortho_LR_" + str(o_mm_lr) + "mm.tiff"
-                chunk.exportOrthomosaic(ortho_path_lr, raster_transform=PS.RasterTransformNone, dx=ortho_res_lr,
-                                        dy=ortho_res_lr, tiff_big=False, tiff_compression=PS.TiffCompressionNone,
-                                        write_alpha=True)
-            else:
-                print("must build Orthomosaic before export")
-        else:
-            print("low resolution Orthomosaic export option not selected")
+    if e_ortho == "TRUE":
+        if chunk.orthomosaic is not None:
+            print("exporting " + res_name + " resolution orthomosaic")
+            ortho_res = float(r_ortho)  # set the desired resolution
 
-    if bt_ortho_hr == "TRUE": # high res big tiff option true
-        if e_ortho_hr == "TRUE":
-            if chunk.orthomosaic is not None:
-                print("exporting high resolution orthomosaic")
-
-                ortho_res_hr = float(r_ortho_hr)  # set the desired resolution
-
-                ortho_path_hr = exportdir + "/" + doc_title + "_Ortho_HR_" + str(o_mm_hr) + "mm.tiff"
-                chunk.exportOrthomosaic(ortho_path_hr, raster_transform=PS.RasterTransformNone, dx=ortho_res_hr,
-                                        dy=ortho_res_hr, tiff_big=True, tiff_compression=PS.TiffCompressionNone,
-                                        write_alpha=True)
-            else:
-                print("must build Orthomosaic before export")
-        else:
-            print("high resolution Orthomosaic export option not selected")
-
-    else:  # big tiff option False
-        if e_ortho_hr == "TRUE":
-            if chunk.orthomosaic is not None:
-                print("exporting high resolution orthomosaic")
-
-                ortho_res_hr = float(r_ortho_hr)  # set the desired resolution
-
-                ortho_path_hr = exportdir + "/" + doc_title + "_Ortho_HR_" + str(o_mm_hr) + "mm.tiff"
-                chunk.exportOrthomosaic(ortho_path_hr, raster_transform=PS.RasterTransformNone, dx=ortho_res_hr,
-                                        dy=ortho_res_hr, tiff_big=False, tiff_compression=PS.TiffCompressionNone,
-                                        write_alpha=True)
-            else:
-                print("must build Orthomosaic before export")
+            ortho_path = raster_path(exportdir, doc_title, "Ortho", ortho_res, res_label)
+            chunk.exportOrthomosaic(ortho_path, raster_transform=PS.RasterTransformNone, dx=ortho_res,
+                                    dy=ortho_res, tiff_big=(bt_ortho == "TRUE"),  # big tiff option
+                                    tiff_compression=PS.TiffCompressionNone, write_alpha=True)
+            return ortho_path
         else:
-            print("high resolution Orthomosaic export option not selected")
+            print("must build Orthomosaic before export")
+    else:
+        print(res_name + " resolution Orthomosaic export option not selected")
 
 
-def build_dsm(chunk, exportdir, doc_title, doc, home, name, b_dsm, e_dsm_lr, e_dsm_hr, r_dsm_lr, r_dsm_hr,
-              bt_dsm_lr, bt_dsm_hr):
+def build_dsm(chunk, b_dsm):
     # build DSMs
     if b_dsm == "TRUE":
         print("building DSM...")
         chunk.buildDem(source=PS.DenseCloudData, interpolation=PS.EnabledInterpolation)
-        doc.save(home + name)
     else:
         print(" build dsm option not selected")
 
-    #export DSMs
 
-    mm_lr = int(round(float(r_dsm_lr) * 1000))
-    mm_hr = int(round(float(r_dsm_hr) * 1000))
+def export_dsm(chunk, exportdir, doc_title, e_dsm, r_dsm, bt_dsm, res_label, uncompressed=False):  # res_label is "LR" or "HR"
+    res_name = {"LR": "low", "HR": "high"}[res_label]
 
-    if bt_dsm_lr == "TRUE":
-        if e_dsm_lr == "TRUE":
-            if chunk.elevation is not None:
-                print("exporting low resolution DSM")
-                dsm_res_lr = float(r_dsm_lr)
-                dsm_path_lr = exportdir + "/" + doc_title + "_DSM_LR_" + str(mm_lr) +"mm.tiff"
-                chunk.exportDem(dsm_path_lr, raster_transform=PS.RasterTransformNone, dx=dsm_res_lr,
-                                dy=dsm_res_lr, tiff_big=True)
-            else:
-                print("build DSM before trying to export")
-        else:
-            print("low resolution DSM export option not selected")
-    else:
-        if e_dsm_lr == "TRUE":
-            if chunk.elevation is not None:
-                print("exporting low resolution DSM")
-                dsm_res_lr = float(r_dsm_lr)
-                dsm_path_lr = exportdir + "/" + doc_title + "_DSM_LR_" + str(mm_lr) +"mm.tiff"
-                chunk.exportDem(dsm_path_lr, raster_transform=PS.RasterTransformNone, dx=dsm_res_lr, dy=dsm_res_lr,
-                                tiff_big=False)
-            else:
-                print("build DSM before trying to export")
-        else:
-            print("low resolution DSM export option not selected")
-    if bt_dsm_hr == "TRUE":
-        if e_dsm_hr == "TRUE":
-            if chunk.elevation is not None:
-                print("exporting high resolution DSM")
-                dsm_res_hr = float(r_dsm_hr)
-                dsm_path_hr = exportdir + "/" + doc_title + "_DSM_HR_" + str(mm_hr) +"mm.tiff"
-                chunk.exportDem(dsm_path_hr, raster_transform=PS.RasterTransformNone, dx=dsm_res_hr,
-                                dy=dsm_res_hr, tiff_big=True)
-            else:
-                print("build DSM before trying to export")
+    if e_dsm == "TRUE":
+        if chunk.elevation is not None:
+            print("exporting " + res_name + " resolution DSM")
+            dsm_res = float(r_dsm)
+
+            dsm_path = raster_path(exportdir, doc_title, "DSM", dsm_res, res_label)
+            compression = {"tiff_compression": PS.TiffCompressionNone} if uncompressed else {}
+            chunk.exportDem(dsm_path, raster_transform=PS.RasterTransformNone, dx=dsm_res, dy=dsm_res,
+                            tiff_big=(bt_dsm == "TRUE"), **compression)  # big tiff option
+            return dsm_path
         else:
-            print("high resolution DSM export option not selected")
+            print("build DSM before trying to export")
     else:
-        if e_dsm_hr == "TRUE":
-            if chunk.elevation is not None:
-                print("exporting high resolution DSM")
-                dsm_res_hr = float(r_dsm_hr)
-                dsm_path_hr = exportdir + "/" + doc_title + "_DSM_HR_" + str(mm_hr) +"mm.tiff"
-                chunk.exportDem(dsm_path_hr, raster_transform=PS.RasterTransformNone, dx=dsm_res_hr, dy=dsm_res_hr,
-                                tiff_big=False)
-            else:
-                print("build DSM before trying to export")
-        else:
-            print("high resolution DSM export option not selected")
+        print(res_name + " resolution DSM export option not selected")
+
+
+def raster_path(exportdir, doc_title, product, res, res_label):  # e.g. <doc_title>_DSM_HR_50mm.tiff
+    return exportdir + "/" + doc_title + "_" + product + "_" + res_label + "_" + str(int(round(float(res) * 1000))) + \
+        "mm.tiff"
+
+
+def derive_lowres(chunk, exportdir, doc_title, product, r_hr, r_lr, bt_lr, method):  # product is "Ortho" or "DSM"
+    hr_path = raster_path(exportdir, doc_title, product, r_hr, "HR")
+    lr_path = raster_path(exportdir, doc_title, product, r_lr, "LR")
+    try:
+        print("resampling the high resolution " + product + " to " + str(r_lr) + " m (" + method + ")")
+        width, height = derive_raster(hr_path, lr_path, float(r_lr), method, bt_lr == "TRUE")
+        print("written " + lr_path + " (" + str(width) + " x " + str(height) + ")")
+        return lr_path
+    except (OSError, ValueError) as e:
+        print("can't resample " + hr_path + ": " + str(e) + " - exporting the low resolution " + product +
+              " from Metashape")
+    if product == "Ortho":
+        return export_ortho(chunk, exportdir, doc_title, "TRUE", r_lr, bt_lr, "LR")
+    return export_dsm(chunk, exportdir, doc_title, "TRUE", r_lr, bt_lr, "LR")
 
 
 def export_report(chunk, exportdir, doc_title, e_report):
@@ -329,6 +456,7 @@ def export_report(chunk, exportdir, doc_title, e_report):
         print("generating and exporting photoscan report")
         report_path = exportdir + "/" + doc_title + "_process_report.pdf"
         chunk.exportReport(path=report_path, description=doc_title)
+        return report_path
     else:
         print("export report option not selected")
 
@@ -366,21 +494,25 @@ def create_settings_summary(chunk, home, doc_title, exportdir, dpc_npoints):
     if os.path.isfile(s1_out_sett) and os.path.isfile(s2_out_sett):
         print("settings files for scripts 1 and 2 present - creating settings file output...")
         sett_s1s = []
+        names_s1 = []
 
         with open(s1_out_sett, 'r') as f:
             mycsv = csv.reader(f)
             for row in mycsv:
                 colB = row[1]
                 sett_s1s.append(colB)
+                names_s1.append(row[0])
         sett_s1s = [0 if x == "no_filter_applied" else x for x in sett_s1s]
         
         sett_s2s = []
+        names_s2 = []
 
         with open(s2_out_sett, 'r') as f:
             mycsv = csv.reader(f)
             for row in mycsv:
                 colB = row[1]
                 sett_s2s.append(colB)
+                names_s2.append(row[0])
 
         sett_s1 = [float(i) for i in sett_s1s]
         sett_s2 = [float(i) for i in sett_s2s]
@@ -403,8 +535,19 @@ def create_settings_summary(chunk, home, doc_title, exportdir, dpc_npoints):
         n_pnts_orig_spc = sett_s1[5]
         n_pnts_rem_REF = sett_s1[6]
         perc_pnts_rem_REF = round((sett_s1[6]/sett_s1[5]) * 100, 3)
-        n_pnts_rem_manual = (sett_s1[5] - sett_s1[6]) - (sett_s2[1] + sett_s2[0])
-        perc_pnts_rem_manual = round((((sett_s1[5] - sett_s1[6]) - (sett_s2[1] + sett_s2[0]))/sett_s1[5]) * 100, 3)
+        # outlier filter count - not in settings files written before the filter was added
+        if "n_points_removed_outlier_filter" in names_s1:
+            n_pnts_rem_OF = sett_s1[names_s1.index("n_points_removed_outlier_filter")]
+        else:
+            n_pnts_rem_OF = 0
+        perc_pnts_rem_OF = round((n_pnts_rem_OF/sett_s1[5]) * 100, 3)
+        if "n_points_removed_gradual_selection" in names_s2:
+            n_pnts_rem_GS = sett_s2[names_s2.index("n_points_removed_gradual_selection")]
+        else:
+            n_pnts_rem_GS = 0
+        perc_pnts_rem_GS = round((n_pnts_rem_GS/sett_s1[5]) * 100, 3)
+        n_pnts_rem_manual = (sett_s1[5] - sett_s1[6] - n_pnts_rem_OF - n_pnts_rem_GS) - (sett_s2[1] + sett_s2[0])
+        perc_pnts_rem_manual = round((((sett_s1[5] - sett_s1[6] - n_pnts_rem_OF - n_pnts_rem_GS) - (sett_s2[1] + sett_s2[0]))/sett_s1[5]) * 100, 3)
         n_pnts_rem_BB = sett_s2[0]
         perc_pnts_rem_BB = round((sett_s2[0]/sett_s1[5]) * 100, 3)
         n_pnts_SPC_final = sett_s2[1]
@@ -422,7 +565,9 @@ def create_settings_summary(chunk, home, doc_title, exportdir, dpc_npoints):
                     "n cameras manually disabled", "% cameras manually disabled", "n cameras enabled",
                     "% cameras enabled", "",
                     "n points in original SPC", "n SPC points removed in reproj. err. filter",
-                    "% SPC points removed in reproj. err. filter", "n SPC points removed manually",
+                    "% SPC points removed in reproj. err. filter", "n SPC points removed in outlier filter",
+                    "% SPC points removed in outlier filter", "n SPC points removed in gradual selection",
+                    "% SPC points removed in gradual selection", "n SPC points removed manually",
                     "% SPC points removed manually", "n points removed by Bounding Box",
                     "% points removed by Bounding Box", "n points in final SPC", "",
                     "n points in original DPC", "n points removed manually DPC", "% points removed manually DPC",
@@ -431,7 +576,9 @@ def create_settings_summary(chunk, home, doc_title, exportdir, dpc_npoints):
                        n_cams_loaded, n_cams_rem_QF, perc_cams_rem_QF,
                        min_qual_val, n_cams_not_align, perc_cams_not_align, n_cams_man_disab, perc_cams_man_disab,
                        n_cams_enabled, perc_cams_enabled, blank,
-                       n_pnts_orig_spc, n_pnts_rem_REF, perc_pnts_rem_REF, n_pnts_rem_manual, perc_pnts_rem_manual,
+                       n_pnts_orig_spc, n_pnts_rem_REF, perc_pnts_rem_REF, n_pnts_rem_OF, perc_pnts_rem_OF,
+                       n_pnts_rem_GS, perc_pnts_rem_GS,
+                       n_pnts_rem_manual, perc_pnts_rem_manual,
                        n_pnts_rem_BB, perc_pnts_rem_BB, n_pnts_SPC_final, blank,
                        n_pnts_orig_DPC, n_pnts_man_rem_DPC, perc_pnts_man_rem_DPC, n_pnts_final_DPC]
 
@@ -453,6 +600,11 @@ def create_settings_summary(chunk, home, doc_title, exportdir, dpc_npoints):
 
 
 if __name__ == '__main__':
+    if "--export-worker" in sys.argv:  # one export of the fan-out: --export-worker <job.json> <result.json>
+        i = sys.argv.index("--export-worker")
+        sys.exit(run_job(sys.argv[i + 1], sys.argv[i + 2], open_read_only,
+                         {"export_DPC": export_DPC, "export_model": export_model, "export_ortho": export_ortho,
+                          "export_dsm": export_dsm, "export_report": export_report}))
     script_setup()
     print("Total Time: " + str(datetime.now() - startTime))  # GET TOTAL TIME
 
@@ -0,0 +1,228 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: photo directory index ------------------------------------------------------------
+#######################################################################################################################
+# Walks the photo folder (including sub folders), keeps only image files (no sidecars, thumbnails or hidden files) and
+# reads the EXIF/XMP tags the workflow needs - camera make/model, capture time, GPS position and the DJI relative
+# altitude - in a thread pool, reading only the metadata segments of each file. Results are cached in
+# <home>/photo_index_cache.sqlite keyed by path, size and mtime, so reruns only read new or changed photos.
+# Photos with identical content (same size and fast hash) are reported and only the first copy is used.
+
+import json
+import os
+import re
+import sqlite3
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from metashape_qualitycache import fast_hash
+
+CACHE_NAME = "photo_index_cache.sqlite"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".tif", ".tiff", ".png", ".dng")
+
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+XMP_TAGS = {"RelativeAltitude": "rel_alt", "AbsoluteAltitude": "xmp_alt", "GimbalPitchDegree": "gimbal_pitch",
+            "FlightYawDegree": "flight_yaw"}
+XMP_PATTERN = re.compile(rb'drone-dji:(\w+)(?:="([^"]*)"|>([^<]*)<)')
+
+
+# ---- metadata readers -----------------------------------------------------------------------------------------------
+
+def jpeg_segments(f):  # APP1 payloads (EXIF and XMP) of a JPEG, read up to the start of the image data
+    payloads = []
+    if f.read(2) != b"\xff\xd8":
+        return payloads
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF or marker[1] == 0xDA:  # start of scan - no metadata after it
+            return payloads
+        length = f.read(2)
+        if len(length) < 2:
+            return payloads
+        size = struct.unpack(">H", length)[0] - 2
+        if marker[1] == 0xE1:
+            payloads.append(f.read(size))
+        else:
+            f.seek(size, os.SEEK_CUR)
+
+
+def ifd_value(tiff, typ, count, raw, endian):
+    if typ == 2:
+        return raw.split(b"\0", 1)[0].decode("ascii", "replace").strip()
+    if typ in (1, 7):
+        return tuple(raw)
+    if typ in (3, 4, 9):
+        fmt = {3: "H", 4: "I", 9: "i"}[typ]
+        return struct.unpack(endian + fmt * count, raw)
+    fmt = "I" if typ == 5 else "i"
+    values = struct.unpack(endian + fmt * (2 * count), raw)
+    return tuple(n / float(d) if d else 0. for n, d in zip(values[0::2], values[1::2]))
+
+
+def read_ifd(tiff, offset, endian):  # {tag: value} of one TIFF image file directory
+    entries = {}
+    n = struct.unpack_from(endian + "H", tiff, offset)[0]
+    for k in range(n):
+        tag, typ, count, value = struct.unpack_from(endian + "HHI4s", tiff, offset + 2 + 12 * k)
+        if typ not in TYPE_SIZES:
+            continue
+        total = TYPE_SIZES[typ] * count
+        if total <= 4:
+            raw = value[:total]
+        else:
+            start = struct.unpack(endian + "I", value)[0]
+            raw = tiff[start:start + total]
+            if len(raw) < total:
+                continue
+        entries[tag] = ifd_value(tiff, typ, count, raw, endian)
+    return entries
+
+
+def degrees(dms, ref):
+    value = dms[0] + dms[1] / 60. + dms[2] / 3600.
+    return -value if ref in ("S", "W") else value
+
+
+def parse_exif(tiff):  # make, model, capture time and GPS position from a TIFF structure
+    meta = {}
+    endian = "<" if tiff[:2] == b"II" else ">"
+    try:
+        ifd0 = read_ifd(tiff, struct.unpack_from(endian + "I", tiff, 4)[0], endian)
+        meta["make"] = ifd0.get(0x010F)
+        meta["model"] = ifd0.get(0x0110)
+        meta["time"] = ifd0.get(0x0132)
+        if 0x8769 in ifd0:
+            exif = read_ifd(tiff, ifd0[0x8769][0], endian)
+            meta["time"] = exif.get(0x9003, meta["time"])
+        if 0x8825 in ifd0:
+            gps = read_ifd(tiff, ifd0[0x8825][0], endian)
+            if 2 in gps and 4 in gps:
+                meta["lat"] = degrees(gps[2], gps.get(1))
+                meta["lon"] = degrees(gps[4], gps.get(3))
+            if 6 in gps:
+                below = gps.get(5, (0,))[0] == 1
+                meta["alt"] = -gps[6][0] if below else gps[6][0]
+    except (struct.error, IndexError, TypeError):
+        pass  # truncated or unusual EXIF - keep what was read
+    return meta
+
+
+def parse_xmp(data):
+    meta = {}
+    for name, attribute, element in XMP_PATTERN.findall(data):
+        key = XMP_TAGS.get(name.decode("ascii"))
+        if key is not None:
+            try:
+                meta[key] = float(attribute or element)
+            except ValueError:
+                pass
+    return meta
+
+
+def read_metadata(path):  # EXIF and DJI XMP tags of a JPEG or TIFF photo
+    meta = {}
+    with open(path, 'rb') as f:
+        head = f.read(4)
+        f.seek(0)
+        if head in (b"II*\0", b"MM\0*"):
+            data = f.read(262144)  # TIFF/DNG: tags (and usually the XMP packet) are near the start
+            meta.update(parse_exif(data))
+            meta.update(parse_xmp(data))
+            return meta
+        for payload in jpeg_segments(f):
+            if payload.startswith(b"Exif\0\0"):
+                meta.update(parse_exif(payload[6:]))
+            elif b"xmpmeta" in payload[:200]:
+                meta.update(parse_xmp(payload))
+    return meta
+
+
+def is_photo(name):
+    lower = name.lower()
+    return lower.endswith(IMAGE_EXTENSIONS) and not lower.startswith(".") and "thumb" not in lower
+
+
+def index_entry(path, size, mtime):  # what the worker threads compute for one photo
+    entry = {"path": path, "size": size, "mtime": mtime}
+    try:
+        entry["hash"] = fast_hash(path, size)
+        entry.update(read_metadata(path))
+    except OSError as e:
+        entry["error"] = repr(e)
+    return entry
+
+
+# ---- index ----------------------------------------------------------------------------------------------------------
+
+class PhotoIndex:
+
+    def __init__(self, home, workers=16):
+        self.cache_path = home + "/" + CACHE_NAME
+        self.workers = workers  # threads - reading headers is I/O bound, especially on network filesystems
+        self.entries = []  # one dict per photo, sorted by path
+        self.duplicates = {}  # path -> path of the first photo with the same content
+        self.n_skipped = 0  # files that are not photos
+        self.n_cached = 0
+
+    def walk(self, datadir):  # (path, size, mtime) of every photo below datadir
+        files = []
+        for root, dirs, names in os.walk(datadir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(".") and "thumb" not in d.lower())
+            for name in sorted(names):
+                if not is_photo(name):
+                    self.n_skipped += 1
+                    continue
+                path = os.path.join(root, name).replace('\\', '/')
+                st = os.stat(path)
+                files.append((path, st.st_size, st.st_mtime))
+        return files
+
+    def scan(self, datadir):
+        files = self.walk(datadir)
+
+        db = sqlite3.connect(self.cache_path, timeout=60)
+        db.execute("CREATE TABLE IF NOT EXISTS photos (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, meta TEXT)")
+        cached = {}
+        for path, size, mtime, meta in db.execute("SELECT path, size, mtime, meta FROM photos"):
+            cached[path] = (size, mtime, meta)
+
+        entries = []
+        misses = []
+        for path, size, mtime in files:
+            hit = cached.get(path)
+            if hit is not None and hit[0] == size and hit[1] == mtime:
+                entries.append(json.loads(hit[2]))
+            else:
+                misses.append((path, size, mtime))
+        self.n_cached = len(entries)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            new = list(pool.map(lambda f: index_entry(*f), misses))
+        db.executemany("INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?)",
+                       [(e["path"], e["size"], e["mtime"], json.dumps(e)) for e in new if "error" not in e])
+        db.commit()
+        db.close()
+
+        self.entries = sorted(entries + new, key=lambda e: e["path"])
+        first = {}
+        for e in self.entries:
+            key = (e["size"], e.get("hash"))
+            if e.get("hash") is None:
+                continue
+            if key in first:
+                self.duplicates[e["path"]] = first[key]
+            else:
+                first[key] = e["path"]
+        return self
+
+    def photos(self):  # photos to add to the chunk: one copy of each
+        return [e["path"] for e in self.entries if e["path"] not in self.duplicates]
+
+    def relative_altitudes(self):  # {path: DJI relative altitude} for the photos that have one
+        return dict((e["path"], e["rel_alt"]) for e in self.entries if e.get("rel_alt") is not None)
+
+    def report(self):
+        print("photo index: " + str(len(self.entries)) + " photos (" + str(self.n_cached) + " from cache), " +
+              str(self.n_skipped) + " other files skipped, " + str(len(self.duplicates)) + " duplicates, " +
+              str(len(self.relative_altitudes())) + " with DJI relative altitude")
+        for path, original in sorted(self.duplicates.items()):
+            print("duplicate photo not used: " + path + " (same as " + original + ")")
@@ -0,0 +1,154 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: photo sharpness / exposure pre-screen --------------------------------------------
+#######################################################################################################################
+# Scores every photo in a list before it is added to the chunk, so blurred and badly exposed frames (e.g. open
+# water) don't cost load time and memory:
+#   sharpness  - variance of the Laplacian of a downsampled greyscale decode
+#   dark/bright - fraction of pixels clipped at black / white
+# Photos below Prescreen_Min_Sharpness or with more than Prescreen_Max_Clipped of their pixels clipped are rejected.
+# Scores are written to a CSV table (one row per photo).
+#
+# The photos are decoded in a pool of worker processes (one per core by default). Metashape's embedded interpreter
+# can't start worker processes itself, so part 1 runs this file with Metashape's bundled Python:
+#   python metashape_prescreen.py <photo folder or .txt list> <score table.csv> [--min-sharpness 20] [--max-clipped 0.5]
+#                                 [--workers 0] [--max-side 512]
+# Requires Pillow (metashape -m pip install pillow); without it the pre-screen is skipped and every photo is used.
+
+import argparse
+import csv
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+NO_PILLOW = 3  # exit status when Pillow is missing
+COLUMNS = ["path", "sharpness", "dark_fraction", "bright_fraction", "mean", "accepted", "reason"]
+
+
+def score_image(path, max_side=512):  # (path, sharpness, dark fraction, bright fraction, mean, error)
+    try:
+        with Image.open(path) as img:
+            img.draft("L", (max_side, max_side))  # JPEG: decode at 1/2, 1/4 or 1/8 scale directly
+            img = img.convert("L")
+            img.thumbnail((max_side, max_side))
+            grey = np.asarray(img, dtype=np.float32)
+    except Exception as e:
+        return path, None, None, None, None, repr(e)
+
+    laplacian = (grey[:-2, 1:-1] + grey[2:, 1:-1] + grey[1:-1, :-2] + grey[1:-1, 2:]) - 4 * grey[1:-1, 1:-1]
+    n = grey.size
+    return (path, float(laplacian.var()), float(np.count_nonzero(grey <= 2) / n),
+            float(np.count_nonzero(grey >= 253) / n), float(grey.mean()), None)
+
+
+def score_args(args):
+    return score_image(*args)
+
+
+def judge(score, min_sharpness, max_clipped):  # (accepted, reason)
+    path, sharpness, dark, bright, mean, error = score
+    if error is not None:
+        return True, "not scored: " + error  # let Metashape decide what to do with unreadable files
+    if sharpness < min_sharpness:
+        return False, "sharpness below " + str(min_sharpness)
+    if dark > max_clipped:
+        return False, "underexposed"
+    if bright > max_clipped:
+        return False, "overexposed"
+    return True, ""
+
+
+def read_photo_list(source):  # photos named in a .txt list (one path per line) or every file in a folder
+    if os.path.isdir(source):
+        return [os.path.join(source, p) for p in sorted(os.listdir(source))]
+    with open(source, 'r') as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def screen_photos(photos, table_path, min_sharpness=20., max_clipped=0.5, workers=0, max_side=512):
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(photos) // (workers * 8))  # few round trips, but still balanced across workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        scores = list(pool.map(score_args, [(p, max_side) for p in photos], chunksize=chunksize))
+
+    n_rejected = 0
+    with open(table_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for score in scores:
+            accepted, reason = judge(score, min_sharpness, max_clipped)
+            n_rejected += not accepted
+            writer.writerow(list(score[:5]) + ["TRUE" if accepted else "FALSE", reason])
+    print("pre-screen: " + str(n_rejected) + "/" + str(len(photos)) + " photos rejected - scores in " + table_path)
+
+
+def read_table(table_path):  # (accepted photos, rejected photos) from a score table
+    accepted, rejected = [], []
+    with open(table_path, 'r') as f:
+        for row in csv.DictReader(f):
+            (accepted if row["accepted"] == "TRUE" else rejected).append(row["path"])
+    return accepted, rejected
+
+
+def python_executable():  # a Python interpreter that can run the worker pool (Metashape's bundled one if need be)
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    for name in ("python.exe", "python3", os.path.join("bin", "python3"), os.path.join("bin", "python")):
+        candidate = os.path.join(sys.exec_prefix, name)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def prescreen_photos(photos, table_path, min_sharpness, max_clipped, workers):
+    # photos to add to the chunk: the given photos less those the pre-screen rejects
+    python = python_executable()
+    if python is None:
+        print("pre-screen skipped: no Python interpreter found to run the worker processes")
+        return photos
+
+    list_path = table_path[:-4] + "_input.txt"
+    with open(list_path, 'w') as f:
+        f.writelines(p + "\n" for p in photos)
+    status = subprocess.call([python, os.path.abspath(__file__), list_path, table_path,
+                              "--min-sharpness", str(min_sharpness), "--max-clipped", str(max_clipped),
+                              "--workers", str(workers)])
+    if status == NO_PILLOW:
+        print("pre-screen skipped: Pillow is not installed (metashape -m pip install pillow)")
+        return photos
+    if status != 0:
+        print("pre-screen failed (exit status " + str(status) + ") - using all photos")
+        return photos
+
+    accepted, rejected = read_table(table_path)
+    for path in rejected:
+        print("rejected by pre-screen: " + path)
+    return accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score photos for sharpness and exposure before import")
+    parser.add_argument("photos", help="photo folder, or a text file listing one photo per line")
+    parser.add_argument("table")
+    parser.add_argument("--min-sharpness", type=float, default=20.)
+    parser.add_argument("--max-clipped", type=float, default=0.5)
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (0 = one per core)")
+    parser.add_argument("--max-side", type=int, default=512, help="longest side of the downsampled decode (pix)")
+    args = parser.parse_args()
+
+    if Image is None:
+        print("Pillow is not installed")
+        return NO_PILLOW
+    screen_photos(read_photo_list(args.photos), args.table, args.min_sharpness, args.max_clipped, args.workers, args.max_side)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: product graph for part 3 ---------------------------------------------------------
+#######################################################################################################################
+# The products of part 3 and the steps that make and export them, declared as a graph: every build step makes one
+# product from the products it needs, every export step reads products. With Product_Planning set to TRUE, part 3
+# builds only what the requested exports (Export_* TRUE) need, whatever the Build_* flags say:
+#   - a product that no requested export needs is not built (e.g. a mesh when only the orthomosaic and DSM are wanted)
+#   - a product a requested export needs is built even if its Build_* flag is FALSE
+#   - the orthomosaic is built on the mesh if the mesh is needed anyway, otherwise on the cheaper DEM
+# The plan is printed before anything runs, with the time it saves against the Build_* flags. Build times come from
+# earlier runs of the project (stage_metrics.jsonl), or else from a rough rate per million dense cloud points.
+
+import json
+import os
+
+# build step: (product made, alternative lists of products it needs - the first list is the default)
+BUILDS = {"build_mesh": ("mesh", [["dense_cloud"]]),
+          "build_texture": ("texture", [["mesh"]]),
+          "build_dsm": ("dem", [["dense_cloud"]]),
+          "build_ortho": ("orthomosaic", [["mesh"], ["dem"]])}
+BUILD_FLAGS = {"build_mesh": "Build_Mesh", "build_texture": "Build_Texture", "build_dsm": "Build_DSM",
+               "build_ortho": "Build_Orthomosaic"}
+EXPORTS = {"export_DPC": ("Export_Dense_Point_Cloud", ["dense_cloud"]),
+           "export_model": ("Export_Model", ["mesh", "texture"]),
+           "export_ortho_LR": ("Export_Orthomosaic_LowRes", ["orthomosaic"]),
+           "export_ortho_HR": ("Export_Orthomosaic_HighRes", ["orthomosaic"]),
+           "export_dsm_LR": ("Export_DSM_LowRes", ["dem"]),
+           "export_dsm_HR": ("Export_DSM_HighRes", ["dem"]),
+           "export_report": ("Export_Report", [])}
+SOURCE_PRODUCTS = ("dense_cloud",)  # made in part 2
+SECONDS_PER_MILLION_POINTS = {"build_mesh": 60., "build_texture": 30., "build_dsm": 8., "build_ortho": 25.}
+
+
+def maker(product):  # the build step that makes a product
+    for step, (made, needs) in BUILDS.items():
+        if made == product:
+            return step
+    return None
+
+
+def previous_build_times(metrics_path):  # {stage: wall seconds of its last complete run} from stage_metrics.jsonl
+    times = {}
+    if not os.path.isfile(metrics_path):
+        return times
+    with open(metrics_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("part") == "part3" and record.get("status") == "complete" and record.get("stage") in BUILDS:
+                times[record["stage"]] = record["wall_s"]
+    return times
+
+
+class ProductPlan:
+
+    def __init__(self, config, dense_points, metrics_path=None):
+        self.config = config
+        self.requested = [e for e, (flag, needs) in EXPORTS.items() if config.get(flag) == "TRUE"]
+        self.flagged = [b for b, flag in BUILD_FLAGS.items() if config.get(flag) == "TRUE"]
+        self.history = previous_build_times(metrics_path) if metrics_path else {}
+        self.dense_points = dense_points
+
+        self.reasons = {}  # build step -> [the steps that need it]
+        for export in self.requested:
+            for product in EXPORTS[export][1]:
+                self.require(product, export)
+        self.surface = self.choose_inputs("build_ortho")  # the ortho's surface, once the rest is known
+
+    def require(self, product, needed_by):
+        step = maker(product)
+        if step is None:  # made in part 2
+            return
+        first = step not in self.reasons
+        self.reasons.setdefault(step, []).append(needed_by)
+        if first and len(BUILDS[step][1]) == 1:
+            for p in BUILDS[step][1][0]:
+                self.require(p, step)
+
+    def choose_inputs(self, step):  # for a step with alternative inputs: the first already built, else the cheapest
+        if step not in self.reasons:
+            return None
+        options = BUILDS[step][1]
+        chosen = None
+        for needs in options:
+            if all(p in SOURCE_PRODUCTS or maker(p) in self.reasons for p in needs):
+                chosen = needs
+                break
+        if chosen is None:
+            chosen = min(options, key=lambda needs: sum(self.estimate(maker(p))[0] for p in needs))
+        for p in chosen:
+            self.require(p, step)
+        return chosen[0]
+
+    def builds(self):  # the build steps to run
+        return [b for b in BUILDS if b in self.reasons]
+
+    def flag(self, step):  # "TRUE" / "FALSE" for the build function of a step
+        return "TRUE" if step in self.reasons else "FALSE"
+
+    def estimate(self, step):  # (seconds, where the estimate comes from)
+        if step in self.history:
+            return self.history[step], "previous run"
+        return SECONDS_PER_MILLION_POINTS[step] * self.dense_points / 1e6, "rough estimate"
+
+    def saved_seconds(self):  # estimated time of the builds the flags ask for minus that of the plan
+        return sum(self.estimate(b)[0] for b in self.flagged) - sum(self.estimate(b)[0] for b in self.builds())
+
+    def report(self):
+        print("product plan for the requested exports: " + (", ".join(self.requested) or "none"))
+        for step in BUILDS:
+            seconds, source = self.estimate(step)
+            cost = " (~" + str(round(seconds / 60., 1)) + " min, " + source + ")"
+            if step in self.reasons:
+                on = " on the " + ("DEM" if self.surface == "dem" else "mesh") if step == "build_ortho" else ""
+                note = "" if step in self.flagged else " - " + BUILD_FLAGS[step] + " is FALSE"
+                print("  build " + step[6:] + on + cost + ": needed by " + ", ".join(self.reasons[step]) + note)
+            elif step in self.flagged:
+                print("  skip  " + step[6:] + cost + ": " + BUILD_FLAGS[step] + " is TRUE but no requested export "
+                      "needs it")
+        saved = self.saved_seconds()
+        print("  estimated time " + ("saved" if saved >= 0 else "added") + " against the Build_* flags: " +
+              str(round(abs(saved) / 60., 1)) + " min")
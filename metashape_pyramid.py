@@ -0,0 +1,328 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: low resolution rasters from the high resolution export ---------------------------
+#######################################################################################################################
+# With Raster_Pyramid set to TRUE, part 3 exports the orthomosaic and DSM from Metashape only at the high resolution
+# and makes the low resolution GeoTIFFs from those files here, instead of rasterising the whole product a second time.
+#
+# The high resolution GeoTIFF (uncompressed, stripped or tiled, classic or BigTIFF) is read a block of rows at a time,
+# each strip or tile through its own short-lived memory map, and each block of output rows is written as one strip of
+# the output file as soon as it is computed - memory use is set by the block size (max_block_mb), not by the raster
+# size. Resampling (factor = low / high resolution, need not be a whole number):
+#   average - area-weighted mean of the input pixels under each output pixel (exact for partly covered pixels);
+#             nodata pixels are left out and the alpha band of an orthomosaic weights the colours
+#   nearest - the input pixel at the centre of each output pixel
+#   min/max - the lowest / highest input pixel whose top-left corner is under the output pixel
+# The orthomosaic always uses average, the DSM uses Raster_Pyramid_DSM_Method. The GeoTIFF keys, nodata value and
+# alpha band of the input are copied; the pixel scale becomes the low resolution and the tie point (or transformation)
+# is adjusted so the output covers the same area (allowing for PixelIsPoint rasters).
+
+import math
+import struct
+
+import numpy as np
+
+TYPES = {1: "B", 2: "s", 3: "H", 4: "I", 5: "II", 6: "b", 7: "B", 8: "h", 9: "i", 10: "ii", 11: "f", 12: "d",
+         16: "Q", 17: "q", 18: "Q"}
+GEO_TAGS = (33550, 33922, 34264, 34735, 34736, 34737, 42113)  # pixel scale, tie point, transformation, geo keys,
+#                                                               geo doubles, geo ascii, GDAL nodata
+METHODS = ("average", "nearest", "min", "max")
+
+
+class GeoTiff:  # an uncompressed GeoTIFF read through a memory map
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        order = self.read(0, 2)
+        if order not in (b"II", b"MM"):
+            raise ValueError(path + " is not a TIFF file")
+        self.bo = "<" if order == b"II" else ">"
+        version = self.unpack("H", 2)[0]
+        self.big = version == 43
+        if version not in (42, 43):
+            raise ValueError(path + ": unknown TIFF version " + str(version))
+        self.tags = self.read_ifd(self.unpack("Q", 8)[0] if self.big else self.unpack("I", 4)[0])
+
+        t = self.tags
+        if t.get(259, [1])[0] != 1:
+            raise ValueError(path + " is compressed - export it with TiffCompressionNone")
+        if t.get(284, [1])[0] != 1:
+            raise ValueError(path + ": planar configuration " + str(t[284][0]) + " is not supported")
+        self.width, self.height = t[256][0], t[257][0]
+        self.samples = t.get(277, [1])[0]
+        bits = t.get(258, [1])
+        if len(set(bits)) != 1 or bits[0] % 8:
+            raise ValueError(path + ": unsupported bits per sample " + str(bits))
+        kind = {1: "u", 2: "i", 3: "f"}[t.get(339, [1])[0]]
+        self.dtype = np.dtype(self.bo + kind + str(bits[0] // 8))
+        self.pixel_bytes = self.samples * self.dtype.itemsize
+        self.tiled = 322 in t
+        if self.tiled:
+            self.tile_w, self.tile_h = t[322][0], t[323][0]
+            self.offsets, self.counts = t[324], t[325]
+        else:
+            self.strip_rows = min(t.get(278, [self.height])[0], self.height)
+            self.offsets, self.counts = t[273], t[279]
+        self.nodata = float(t[42113].strip("\x00 ")) if 42113 in t else None
+        self.alpha = self.samples in (2, 4) and 338 in t  # grey / RGB plus an extra (alpha) sample
+
+    def read(self, offset, n):
+        self.f.seek(offset)
+        return self.f.read(n)
+
+    def unpack(self, fmt, offset, count=1):
+        size = struct.calcsize("=" + fmt)
+        return struct.unpack(self.bo + fmt * count, self.read(offset, size * count))
+
+    def read_ifd(self, offset):
+        n = self.unpack("Q" if self.big else "H", offset)[0]
+        entry_size, inline = (20, 8) if self.big else (12, 4)
+        start = offset + (8 if self.big else 2)
+        tags = {}
+        for i in range(n):
+            e = start + i * entry_size
+            tag, kind = self.unpack("HH", e)
+            count = self.unpack("Q" if self.big else "I", e + 4)[0]
+            if kind not in TYPES:
+                continue
+            fmt = TYPES[kind]
+            size = struct.calcsize("=" + fmt) * count
+            at = e + (12 if self.big else 8)
+            if size > inline:
+                at = self.unpack("Q" if self.big else "I", at)[0]
+            if kind == 2:
+                tags[tag] = self.read(at, count).decode("latin-1")
+            else:
+                tags[tag] = list(self.unpack(fmt, at, count))
+        return tags
+
+    def block(self, offset, rows, cols):  # (rows, cols, samples) of a strip or tile, mapped only while it is copied
+        return np.memmap(self.f, dtype=self.dtype, mode='r', offset=offset, shape=(rows, cols, self.samples))
+
+    def rows(self, r0, r1):  # rows r0..r1-1 as a (rows, width, samples) array
+        out = np.empty((r1 - r0, self.width, self.samples), dtype=self.dtype.newbyteorder("="))
+        if not self.tiled:
+            for s in range(r0 // self.strip_rows, (r1 - 1) // self.strip_rows + 1):
+                s0 = s * self.strip_rows
+                n = min(self.strip_rows, self.height - s0)
+                data = self.block(self.offsets[s], n, self.width)
+                a, b = max(r0, s0), min(r1, s0 + n)
+                out[a - r0:b - r0] = data[a - s0:b - s0]
+            return out
+        across = int(math.ceil(self.width / float(self.tile_w)))
+        for tr in range(r0 // self.tile_h, (r1 - 1) // self.tile_h + 1):
+            t0 = tr * self.tile_h
+            a, b = max(r0, t0), min(r1, t0 + self.tile_h)
+            for tc in range(across):
+                c0 = tc * self.tile_w
+                c1 = min(self.width, c0 + self.tile_w)
+                data = self.block(self.offsets[tr * across + tc], self.tile_h, self.tile_w)
+                out[a - r0:b - r0, c0:c1] = data[a - t0:b - t0, :c1 - c0]
+        return out
+
+    def pixel_size(self):  # (x, y) size of a pixel in map units
+        if 33550 in self.tags:
+            return self.tags[33550][0], self.tags[33550][1]
+        if 34264 in self.tags:
+            m = self.tags[34264]
+            return math.hypot(m[0], m[4]), math.hypot(m[1], m[5])
+        raise ValueError(self.path + " has no georeferencing (pixel scale or transformation)")
+
+    def pixel_is_point(self):  # GTRasterTypeGeoKey (1025) = RasterPixelIsPoint
+        keys = self.tags.get(34735, [])
+        for i in range(4, len(keys) - 3, 4):
+            if keys[i] == 1025 and keys[i + 1] == 0:
+                return keys[i + 3] == 2
+        return False
+
+    def geo_tags(self, fx, fy):  # the georeferencing tags of the raster resampled by fx, fy
+        tags = dict((k, v) for k, v in self.tags.items() if k in GEO_TAGS)
+        shift = 0.5 * (fx - 1), 0.5 * (fy - 1)  # PixelIsPoint: new pixel centres lie between old ones
+        if not self.pixel_is_point():
+            shift = 0., 0.
+        if 33550 in tags:
+            sx, sy = tags[33550][0], tags[33550][1]
+            tags[33550] = [sx * fx, sy * fy] + tags[33550][2:]
+            if 33922 in tags:
+                t = list(tags[33922])
+                i, j, x, y = t[0], t[1], t[3], t[4]  # pixel (i, j) is at (x, y); y runs against the rows
+                t[0], t[1] = 0., 0.
+                t[3] = x + (shift[0] - i) * sx
+                t[4] = y - (shift[1] - j) * sy
+                tags[33922] = t
+        if 34264 in tags:
+            m = list(tags[34264])
+            m[3] += m[0] * shift[0] + m[1] * shift[1]
+            m[7] += m[4] * shift[0] + m[5] * shift[1]
+            m[0], m[4] = m[0] * fx, m[4] * fx
+            m[1], m[5] = m[1] * fy, m[5] * fy
+            tags[34264] = m
+        return tags
+
+    def close(self):
+        self.f.close()
+
+
+class TiffWriter:  # streams strips to an uncompressed (Big)TIFF; the directory is written at the end
+
+    def __init__(self, path, width, height, samples, dtype, rows_per_strip, extra_tags, alpha=False, big=False):
+        self.f = open(path, 'wb')
+        self.width, self.height, self.samples = width, height, samples
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.rows_per_strip = rows_per_strip
+        self.extra_tags = extra_tags  # {tag: values} - geo tags of the output
+        self.alpha = alpha
+        self.big = big or width * height * samples * self.dtype.itemsize > 2 ** 32 - 2 ** 27
+        self.offsets, self.counts = [], []
+        if self.big:
+            self.f.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+        else:
+            self.f.write(b"II" + struct.pack("<HI", 42, 0))
+
+    def write(self, rows):  # the next rows_per_strip rows (fewer for the last strip)
+        data = np.ascontiguousarray(rows, dtype=self.dtype).tobytes()
+        self.offsets.append(self.f.tell())
+        self.counts.append(len(data))
+        self.f.write(data)
+
+    def entries(self):
+        kind = {"u": 1, "i": 2, "f": 3}[self.dtype.kind]
+        long_type = 16 if self.big else 4
+        e = {256: (long_type, [self.width]), 257: (long_type, [self.height]),
+             258: (3, [self.dtype.itemsize * 8] * self.samples), 259: (3, [1]),
+             262: (3, [2 if self.samples >= 3 else 1]), 273: (long_type, self.offsets), 277: (3, [self.samples]),
+             278: (long_type, [self.rows_per_strip]), 279: (long_type, self.counts), 284: (3, [1]),
+             339: (3, [kind] * self.samples)}
+        if self.alpha:
+            e[338] = (3, [2])  # unassociated alpha
+        for tag, values in self.extra_tags.items():
+            if isinstance(values, str):
+                e[tag] = (2, values)
+            elif tag in (34735,):
+                e[tag] = (3, values)
+            else:
+                e[tag] = (12, [float(v) for v in values])
+        return sorted(e.items())
+
+    def close(self):
+        entries = self.entries()
+        if self.f.tell() % 2:
+            self.f.write(b"\x00")
+        ifd = self.f.tell()
+        entry_size, inline = (20, 8) if self.big else (12, 4)
+        data_at = ifd + (8 if self.big else 2) + len(entries) * entry_size + (8 if self.big else 4)
+        head, tail = [], []
+        for tag, (kind, values) in entries:
+            if kind == 2:
+                payload = values.encode("latin-1")
+                if not payload.endswith(b"\x00"):
+                    payload += b"\x00"
+                count = len(payload)
+            else:
+                payload = struct.pack("<" + TYPES[kind] * len(values), *values)
+                count = len(values)
+            if len(payload) <= inline:
+                value = payload.ljust(inline, b"\x00")
+            else:
+                value = struct.pack("<Q" if self.big else "<I", data_at + sum(len(t) for t in tail))
+                tail.append(payload + (b"\x00" if len(payload) % 2 else b""))
+            head.append(struct.pack("<HHQ" if self.big else "<HHI", tag, kind, count) + value)
+        self.f.write(struct.pack("<Q" if self.big else "<H", len(entries)))
+        self.f.write(b"".join(head))
+        self.f.write(struct.pack("<Q" if self.big else "<I", 0))
+        self.f.write(b"".join(tail))
+        self.f.seek(8 if self.big else 4)
+        self.f.write(struct.pack("<Q" if self.big else "<I", ifd))
+        self.f.close()
+
+
+def area_sums(values, f, j0, j1, start, axis):
+    # integral of values (pixels = unit intervals from start along axis) over [j f, (j + 1) f) for j = j0..j1-1
+    n = values.shape[axis]
+    c = np.concatenate([np.zeros_like(np.take(values, [0], axis=axis)), np.cumsum(values, axis=axis)], axis=axis)
+    x = np.clip(np.arange(j0, j1 + 1) * f - start, 0, n)
+    i = np.floor(x).astype(np.int64)
+    frac = x - i
+    shape = [1] * values.ndim
+    shape[axis] = len(x)
+    integral = np.take(c, i, axis=axis) + frac.reshape(shape) * np.take(values, np.minimum(i, n - 1), axis=axis)
+    return np.diff(integral, axis=axis)
+
+
+def resample_block(block, fx, fy, j0, j1, r0, out_w, method, nodata, alpha):
+    # output rows j0..j1-1 from the input rows r0.. in block (rows, width, samples)
+    h, w = block.shape[:2]
+    if method == "nearest":
+        rows = np.minimum(np.floor((np.arange(j0, j1) + 0.5) * fy).astype(np.int64) - r0, h - 1)
+        cols = np.minimum(np.floor((np.arange(out_w) + 0.5) * fx).astype(np.int64), w - 1)
+        return block[rows][:, cols]
+
+    values = block.astype(np.float64)
+    valid = np.ones(block.shape[:2] + (1,))
+    if nodata is not None:
+        valid = np.all(values != nodata, axis=2, keepdims=True) & np.all(np.isfinite(values), axis=2, keepdims=True)
+        valid = valid.astype(np.float64)
+
+    if method in ("min", "max"):
+        fill = np.inf if method == "min" else -np.inf
+        values = np.where(valid > 0, values, fill)
+        reduce = np.minimum if method == "min" else np.maximum
+        rows = np.floor(np.arange(j0, j1) * fy).astype(np.int64) - r0
+        cols = np.floor(np.arange(out_w) * fx).astype(np.int64)
+        out = reduce.reduceat(reduce.reduceat(values, rows, axis=0), cols, axis=1)
+        return np.where(np.isfinite(out), out, nodata if nodata is not None else 0.)
+
+    if alpha:  # colours weighted by alpha, alpha averaged over the whole output pixel
+        weight = values[:, :, -1:] / float(np.iinfo(block.dtype).max if block.dtype.kind in "ui" else 1.)
+        weight = weight * valid
+        colour_sum = area_sums(area_sums(values[:, :, :-1] * weight, fy, j0, j1, r0, 0), fx, 0, out_w, 0, 1)
+        weight_sum = area_sums(area_sums(weight, fy, j0, j1, r0, 0), fx, 0, out_w, 0, 1)
+        alpha_sum = area_sums(area_sums(values[:, :, -1:] * valid, fy, j0, j1, r0, 0), fx, 0, out_w, 0, 1)
+        colour = np.divide(colour_sum, weight_sum, out=np.zeros_like(colour_sum), where=weight_sum > 0)
+        return np.concatenate([colour, alpha_sum / (fx * fy)], axis=2)
+
+    value_sum = area_sums(area_sums(values * valid, fy, j0, j1, r0, 0), fx, 0, out_w, 0, 1)
+    weight_sum = area_sums(area_sums(valid, fy, j0, j1, r0, 0), fx, 0, out_w, 0, 1)
+    out = np.divide(value_sum, weight_sum, out=np.zeros_like(value_sum), where=weight_sum > 0)
+    if nodata is not None:
+        out[np.broadcast_to(weight_sum <= 0, out.shape)] = nodata
+    return out
+
+
+def to_dtype(values, dtype):  # rounded and clipped for integer rasters
+    if dtype.kind in "ui":
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(values), info.min, info.max).astype(dtype)
+    return values.astype(dtype)
+
+
+def derive_raster(src_path, dst_path, resolution, method="average", big_tiff=False, max_block_mb=256):
+    # write dst_path: src_path resampled to resolution (map units); returns (width, height) of the output
+    if method not in METHODS:
+        raise ValueError("unknown resampling method '" + str(method) + "' - use one of " + ", ".join(METHODS))
+    src = GeoTiff(src_path)
+    try:
+        sx, sy = src.pixel_size()
+        fx, fy = float(resolution) / sx, float(resolution) / sy
+        if fx <= 1 or fy <= 1:
+            raise ValueError("resolution " + str(resolution) + " is not coarser than " + src_path)
+        out_w = int(math.ceil(src.width / fx - 1e-9))
+        out_h = int(math.ceil(src.height / fy - 1e-9))
+        per_output_row = fy * src.width * src.samples * 8 * 6  # float64 working arrays per output row
+        block_rows = int(max(1, min(out_h, max_block_mb * 2 ** 20 // per_output_row)))
+
+        dst = TiffWriter(dst_path, out_w, out_h, src.samples, src.dtype, block_rows, src.geo_tags(fx, fy),
+                         alpha=src.alpha, big=big_tiff)
+        try:
+            for j0 in range(0, out_h, block_rows):
+                j1 = min(out_h, j0 + block_rows)
+                r0 = int(math.floor(j0 * fy))
+                r1 = min(src.height, int(math.ceil(j1 * fy)))
+                block = src.rows(r0, r1)
+                out = resample_block(block, fx, fy, j0, j1, r0, out_w, method, src.nodata, src.alpha)
+                dst.write(to_dtype(out, dst.dtype))
+        finally:
+            dst.close()
+        return out_w, out_h
+    finally:
+        src.close()
@@ -0,0 +1,111 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: persistent image quality cache ---------------------------------------------------
+#######################################################################################################################
+# analyzePhotos takes 20-40 minutes on large flights, so the Image/Quality value of every analysed photo is kept in a
+# SQLite database in the project folder (<home>/image_quality_cache.sqlite), shared by all projects in that folder.
+# A photo is a cache hit when its path, size and mtime are unchanged, or - if the photo was copied or moved - when its
+# size and fast content hash (first and last 64 kB) match a cached photo. Only the misses are analysed again.
+
+import hashlib
+import os
+import sqlite3
+import time
+
+CACHE_NAME = "image_quality_cache.sqlite"
+HASH_BLOCK = 65536
+
+
+def fast_hash(path, size):  # hash of the size and the first and last blocks of the file
+    h = hashlib.sha1(str(size).encode("utf-8"))
+    with open(path, 'rb') as f:
+        h.update(f.read(HASH_BLOCK))
+        if size > 2 * HASH_BLOCK:
+            f.seek(-HASH_BLOCK, os.SEEK_END)
+            h.update(f.read(HASH_BLOCK))
+    return h.hexdigest()
+
+
+class QualityCache:
+
+    def __init__(self, home):
+        self.path = home + "/" + CACHE_NAME
+        self.db = sqlite3.connect(self.path, timeout=60)  # several batch jobs may share the project folder
+        self.db.execute("CREATE TABLE IF NOT EXISTS quality (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                        "hash TEXT, quality REAL, seconds REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS quality_hash ON quality (hash, size)")
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.
+        self.pending = {}  # camera -> (path, size, mtime, hash) of the misses
+
+    def photo_key(self, camera):  # (path, size, mtime) or None if the photo can't be read
+        path = camera.photo.path
+        try:
+            st = os.stat(path)
+        except (OSError, AttributeError, TypeError):
+            return None
+        return path.replace('\\', '/'), st.st_size, st.st_mtime
+
+    def lookup(self, camera):  # cached quality of the camera's photo, or None
+        key = self.photo_key(camera)
+        if key is None:
+            return None
+        path, size, mtime = key
+        row = self.db.execute("SELECT quality, seconds FROM quality WHERE path = ? AND size = ? AND mtime = ?",
+                              key).fetchone()
+        digest = None
+        if row is None:
+            try:
+                digest = fast_hash(path, size)
+            except OSError:
+                return None
+            row = self.db.execute("SELECT quality, seconds FROM quality WHERE hash = ? AND size = ?",
+                                  (digest, size)).fetchone()
+        if row is None:
+            self.pending[camera] = (path, size, mtime, digest)
+            return None
+        self.time_saved += row[1] or 0.
+        return row[0]
+
+    def apply(self, cameras):  # write cached values into camera.meta - returns the cameras that still need analysis
+        misses = []
+        for camera in cameras:
+            quality = self.lookup(camera)
+            if quality is None:
+                misses.append(camera)
+            else:
+                camera.meta["Image/Quality"] = str(quality)
+        self.hits += len(cameras) - len(misses)
+        self.misses += len(misses)
+        return misses
+
+    def store(self, cameras, seconds):  # record the qualities Metashape computed for cameras in `seconds` in total
+        per_photo = seconds / len(cameras) if cameras else 0.
+        rows = []
+        for camera in cameras:
+            key = self.pending.pop(camera, None) or self.photo_key(camera)
+            value = camera.meta["Image/Quality"]
+            if key is None or value is None:
+                continue
+            path, size, mtime = key[:3]
+            digest = key[3] if len(key) > 3 and key[3] is not None else fast_hash(path, size)
+            rows.append((path, size, mtime, digest, float(value), per_photo))
+        self.db.executemany("INSERT OR REPLACE INTO quality VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    def analyse(self, cameras, analyse_func):  # run analyse_func(cameras=misses) on the cache misses only
+        misses = self.apply(cameras)
+        if misses:
+            start = time.time()
+            analyse_func(cameras=misses)
+            self.store(misses, time.time() - start)
+        return misses
+
+    def report(self):
+        total = self.hits + self.misses
+        print("image quality cache: " + str(self.hits) + "/" + str(total) + " hits, " + str(self.misses) +
+              " misses, about " + str(round(self.time_saved / 60., 1)) + " min of analysis saved (" + self.path + ")")
+
+    def close(self):
+        self.db.close()
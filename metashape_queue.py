@@ -0,0 +1,316 @@
+#######################################################################################################################
+# ------ Metashape workflow: file-backed work queue for several nodes -------------------------------------------------
+#######################################################################################################################
+# A queue is a directory on a filesystem shared by the nodes. Workers on any node pull tasks from it; no scheduler
+# or database is needed. A task is a command (e.g. one part of one project) stored as a JSON file:
+#   pending/<id>.json  - waiting; runnable once every task in its "after" list is in done/
+#   claimed/<id>.json  - being run; the worker touches the file every lease/3 seconds (heartbeat)
+#   done/<id>.json     - finished, with the exit code, worker, host and run time
+#   failed/<id>.json   - failed max_attempts times
+#   logs/<id>_<attempt>.log - output of each run
+#   claimed/<id>.<token>.owned - a claimed task whose record is being updated by its worker
+# A worker claims a task by renaming it from pending/ to claimed/ - only one rename of a file can succeed, so two
+# workers never run the same task. If a node dies its heartbeat stops, and once the claimed file is older than the
+# lease any worker moves the task back to pending/ (again with a rename), where it is claimed like any other task.
+# Keep the lease well above the clock difference between the nodes.
+#
+# Tasks made with add-project also carry the project's stage ledger: a part that exits after completing some stages
+# but not its last one (part 2 building a batch of tiles, see Tiling_Tiles_Per_Run) goes back to pending/ without
+# using up an attempt.
+#
+#   python metashape_queue.py <queue> add-project D:/site/input_file.csv --metashape metashape.sh [--parts 123]
+#   python metashape_queue.py <queue> add --name my_export --after <id> -- <command> <args>
+#   python metashape_queue.py <queue> work [--workers 4] [--lease 300] [--idle-exit 600]
+#   python metashape_queue.py <queue> status
+# Several workers on one machine (--workers) behave exactly like workers on several nodes, so a queue can be tried
+# out locally.
+
+import argparse
+import csv
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from multiprocessing import Process
+
+from metashape_batch import SCRIPTS, read_settings, part_finished, part_progress
+
+STATES = ("pending", "claimed", "done", "failed")
+SUMMARY_COLUMNS = ["id", "name", "state", "attempts", "exit_code", "worker", "host", "started", "minutes", "after"]
+
+
+def write_json(path, data):  # write to a temporary name, then rename into place (readers never see half a file)
+    tmp = path + "." + uuid.uuid4().hex[:8] + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # moved by another worker, or still being written
+
+
+class WorkQueue:
+
+    def __init__(self, root, lease=300.):
+        self.root = root
+        self.lease = lease
+        for state in STATES + ("logs",):
+            folder = os.path.join(root, state)
+            if not os.path.isdir(folder):
+                os.makedirs(folder, exist_ok=True)
+
+    def path(self, state, task_id):
+        return os.path.join(self.root, state, task_id + ".json")
+
+    def ids(self, state):
+        return sorted(name[:-5] for name in os.listdir(os.path.join(self.root, state)) if name.endswith(".json"))
+
+    # ---- adding tasks -----------------------------------------------------------------------------------------------
+
+    def add(self, name, command, after=(), max_attempts=3, ledger=None):
+        # ids sort in the order the tasks were added, which is the order workers take them
+        task_id = datetime.now().strftime("%Y%m%d%H%M%S%f") + "_" + uuid.uuid4().hex[:6]
+        task = {"id": task_id, "name": name, "command": list(command), "after": list(after), "attempts": 0,
+                "max_attempts": max_attempts, "ledger": ledger, "added": str(datetime.now()), "runs": []}
+        write_json(self.path("pending", task_id), task)
+        return task_id
+
+    def add_project(self, input_file, metashape, parts="123", max_attempts=3):  # one task per part, chained
+        home, doc_title = read_settings(input_file)
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        ids = []
+        for part in [int(p) for p in parts]:
+            command = [metashape, "-r", os.path.join(script_dir, SCRIPTS[part]), "--input", input_file]
+            ids.append(self.add(doc_title + " part " + str(part), command, ids[-1:], max_attempts,
+                                {"home": home, "doc_title": doc_title, "part": part}))
+        return ids
+
+    # ---- claiming ---------------------------------------------------------------------------------------------------
+
+    def runnable(self, task):
+        return all(os.path.isfile(self.path("done", dep)) for dep in task["after"])
+
+    def blocked(self, task):  # a task it waits for has failed for good
+        return any(os.path.isfile(self.path("failed", dep)) for dep in task["after"])
+
+    def claim(self):  # the first runnable pending task, now claimed by this process - or None
+        for task_id in self.ids("pending"):
+            pending = self.path("pending", task_id)
+            task = read_json(pending)
+            if task is None:
+                continue
+            if self.blocked(task):
+                try:
+                    os.rename(pending, self.path("failed", task_id))
+                    print(str(datetime.now()) + " " + task["name"] + " failed: a task it waits for failed")
+                except OSError:
+                    pass
+                continue
+            if not self.runnable(task):
+                continue
+            try:
+                os.utime(pending)  # a fresh heartbeat travels with the rename
+                os.rename(pending, self.path("claimed", task_id))
+            except OSError:
+                continue  # another worker was faster
+            return read_json(self.path("claimed", task_id)) or task
+        return None
+
+    def heartbeat(self, task_id):  # False once the lease has been lost
+        try:
+            os.utime(self.path("claimed", task_id))
+            return True
+        except OSError:
+            return False
+
+    def expire_leases(self):  # move tasks of dead workers back to pending/
+        now = time.time()
+        for task_id in self.ids("claimed"):
+            path = self.path("claimed", task_id)
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+            if age <= self.lease:
+                continue
+            task = read_json(path)
+            state = "failed" if task is not None and task["attempts"] >= task["max_attempts"] else "pending"
+            try:
+                os.rename(path, self.path(state, task_id))
+            except OSError:
+                continue
+            print(str(datetime.now()) + " lease of " + task_id + " expired (" + str(round(age)) + " s) - " +
+                  ("requeued" if state == "pending" else "failed"))
+        for name in os.listdir(os.path.join(self.root, "claimed")):  # worker died in the middle of finish()
+            path = os.path.join(self.root, "claimed", name)
+            try:
+                if not name.endswith(".owned") or now - os.path.getmtime(path) <= self.lease:
+                    continue
+                os.rename(path, self.path("pending", name.split(".")[0]))
+            except OSError:
+                continue
+            print(str(datetime.now()) + " " + name.split(".")[0] + " was left half-finished - requeued")
+
+    def finish(self, task, state):  # move a claimed task to pending/, claimed/, done/ or failed/ with its updated record
+        # the claimed file is first renamed to a name only this worker uses: if the lease has expired and another
+        # worker has moved the task, the rename fails and nothing is written, so the task is never claimed twice
+        owned = os.path.join(self.root, "claimed", task["id"] + "." + uuid.uuid4().hex[:8] + ".owned")
+        try:
+            os.rename(self.path("claimed", task["id"]), owned)
+        except OSError:
+            print("lease of " + task["id"] + " was lost - result not recorded")
+            return False
+        write_json(owned, task)
+        os.rename(owned, self.path(state, task["id"]))
+        return True
+
+    # ---- running ----------------------------------------------------------------------------------------------------
+
+    def run_task(self, task, worker):
+        task["attempts"] += 1
+        if not self.finish(task, "claimed"):  # a run that takes its node down still counts
+            return
+        log_path = os.path.join(self.root, "logs", task["id"] + "_" + str(task["attempts"]) + ".log")
+        ledger = task.get("ledger")
+        progress = part_progress(ledger["home"], ledger["doc_title"], ledger["part"]) if ledger else 0
+
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease / 3.):
+                if not self.heartbeat(task["id"]):
+                    return
+
+        beater = threading.Thread(target=beat)
+        beater.daemon = True
+        beater.start()
+        print(str(datetime.now()) + " " + worker + " running " + task["name"] + " (attempt " +
+              str(task["attempts"]) + ")")
+        start = time.time()
+        try:
+            with open(log_path, 'w') as log:
+                code = subprocess.call(task["command"], stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            code = repr(e)
+        stop.set()
+        beater.join()
+
+        state = "done" if code == 0 else "failed"
+        if ledger is not None and code == 0 and not part_finished(ledger["home"], ledger["doc_title"], ledger["part"]):
+            if part_progress(ledger["home"], ledger["doc_title"], ledger["part"]) > progress:
+                task["attempts"] -= 1  # made progress (e.g. a batch of tiles) - run it again
+                state = "pending"
+            else:
+                state = "failed"
+        if state == "failed" and task["attempts"] < task["max_attempts"]:
+            state = "pending"
+
+        task["runs"].append({"worker": worker, "host": socket.gethostname(), "started": str(datetime.fromtimestamp(start)),
+                             "minutes": round((time.time() - start) / 60., 2), "exit_code": code, "log": log_path})
+        self.finish(task, state)
+        print(str(datetime.now()) + " " + worker + " " + task["name"] + ": exit code " + str(code) + " -> " + state)
+
+    def work(self, worker, idle_exit=600., poll=5.):  # run tasks until none has been runnable for idle_exit seconds
+        idle_since = time.time()
+        while True:
+            self.expire_leases()
+            task = self.claim()
+            if task is not None:
+                self.run_task(task, worker)
+                idle_since = time.time()
+                continue
+            if not self.ids("pending") and not self.ids("claimed"):
+                return  # queue empty
+            if time.time() - idle_since > idle_exit:
+                print(worker + ": nothing runnable for " + str(idle_exit) + " s - stopping")
+                return
+            time.sleep(poll)
+
+    # ---- summary ----------------------------------------------------------------------------------------------------
+
+    def status(self):
+        rows = []
+        for state in STATES:
+            for task_id in self.ids(state):
+                task = read_json(self.path(state, task_id))
+                if task is None:
+                    continue
+                last = task["runs"][-1] if task["runs"] else {}
+                rows.append([task_id, task["name"], state, task["attempts"], last.get("exit_code", ""),
+                             last.get("worker", ""), last.get("host", ""), last.get("started", ""),
+                             last.get("minutes", ""), " ".join(task["after"])])
+        rows.sort(key=lambda r: r[0])
+        with open(os.path.join(self.root, "queue_summary.csv"), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(SUMMARY_COLUMNS)
+            writer.writerows(rows)
+
+        print("{:<30} {:<8} {:>8} {:>6} {:<24} {:>8}".format("task", "state", "attempts", "exit", "worker", "minutes"))
+        for row in rows:
+            print("{:<30} {:<8} {:>8} {:>6} {:<24} {:>8}".format(row[1][:30], row[2], row[3], str(row[4])[:6],
+                                                               (str(row[5]) + "@" + str(row[6]))[:24] if row[5] else "",
+                                                               row[8]))
+        print(", ".join(state + ": " + str(len(self.ids(state))) for state in STATES))
+
+
+def worker_process(root, lease, idle_exit, poll, n):
+    WorkQueue(root, lease).work(socket.gethostname() + "-" + str(os.getpid()) + "-" + str(n), idle_exit, poll)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="File-backed work queue for the Metashape workflow")
+    parser.add_argument("queue", help="queue directory on a filesystem shared by the nodes")
+    parser.add_argument("--lease", type=float, default=300., help="seconds without a heartbeat before a task is requeued")
+    sub = parser.add_subparsers(dest="action")
+
+    add = sub.add_parser("add", help="add a command as a task")
+    add.add_argument("--name", required=True)
+    add.add_argument("--after", action="append", default=[], help="id of a task that must be done first")
+    add.add_argument("--max-attempts", type=int, default=3)
+    add.add_argument("command", nargs=argparse.REMAINDER)
+
+    project = sub.add_parser("add-project", help="add the parts of a project as chained tasks")
+    project.add_argument("input_file")
+    project.add_argument("--metashape", required=True)
+    project.add_argument("--parts", default="123")
+    project.add_argument("--max-attempts", type=int, default=3)
+
+    work = sub.add_parser("work", help="run tasks")
+    work.add_argument("--workers", type=int, default=1, help="worker processes on this node")
+    work.add_argument("--idle-exit", type=float, default=600., help="stop after this many seconds with nothing to do")
+    work.add_argument("--poll", type=float, default=5.)
+
+    sub.add_parser("status", help="print the tasks and write queue_summary.csv")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue, args.lease)
+    if args.action == "add":
+        command = args.command[1:] if args.command[:1] == ["--"] else args.command
+        print(queue.add(args.name, command, args.after, args.max_attempts))
+    elif args.action == "add-project":
+        for task_id in queue.add_project(args.input_file, args.metashape, args.parts, args.max_attempts):
+            print(task_id)
+    elif args.action == "work":
+        workers = [Process(target=worker_process, args=(args.queue, args.lease, args.idle_exit, args.poll, n))
+                   for n in range(args.workers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    else:
+        queue.status()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: batched reference (camera / marker location) transformation ----------------------
+#######################################################################################################################
+# All reference locations of a set of cameras or markers are gathered into one array and transformed in a single call
+# per CRS pair with pyproj (transformers are cached per pair). pyproj must give the same result as Metashape's own
+# CoordinateSystem.transform, heights included, so the pyproj CRSs are built from Metashape's WKT of each CRS (with its
+# TOWGS84 datum shift, the transformation Metashape uses) and made 3D, so that ellipsoidal heights are carried through
+# the datum shift as Metashape does (a 2D target would leave z unchanged). The pyproj result is then compared with
+# CoordinateSystem.transform on a few of the locations; if they differ, if pyproj is not installed or if a CRS can't be
+# read by pyproj, each location is transformed with CoordinateSystem.transform instead. Either way the entries that
+# could not be transformed are reported and the rest are still updated. The DJI altitude correction (relative
+# altitude + take off altitude) is applied to the transformed array in the same pass.
+
+import numpy as np
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+_transformers = {}  # (source, target) -> pyproj Transformer
+N_CHECK = 3  # locations transformed both ways to check pyproj against Metashape
+TOLERANCE = 1e-3  # largest accepted difference (m; 1e-8 degrees for geographic targets)
+
+
+def epsg_code(crs):  # "EPSG:32114" for a Metashape CoordinateSystem (authority "EPSG::32114"), else None
+    authority = getattr(crs, "authority", None)
+    if not authority or not authority.upper().startswith("EPSG"):
+        return None
+    return "EPSG:" + authority.split(":")[-1].strip()
+
+
+def crs_definition(crs):  # Metashape's WKT of a CoordinateSystem (keeps its datum shift), else its EPSG code
+    return getattr(crs, "wkt", None) or epsg_code(crs)
+
+
+def transformer(source, target):  # pyproj Transformer between two CRS definitions, as 3D CRSs - None if pyproj can't
+    key = (source, target)
+    if key not in _transformers:
+        try:
+            _transformers[key] = pyproj.Transformer.from_crs(pyproj.CRS(source).to_3d(), pyproj.CRS(target).to_3d(),
+                                                             always_xy=True)
+        except pyproj.exceptions.ProjError:  # CRSError is a ProjError
+            _transformers[key] = None
+    return _transformers[key]
+
+
+def check_transformer(tr, geographic, locations, xyz, fallback):
+    # transform a few locations with pyproj and with Metashape (fallback) - (True, "") if they agree, else (False, why)
+    tolerance = np.array([1e-8 if geographic else TOLERANCE] * 2 + [TOLERANCE])
+    sample = sorted(set(np.linspace(0, len(xyz) - 1, min(N_CHECK, len(xyz))).astype(int).tolist()))
+    x, y, z = tr.transform(xyz[sample, 0], xyz[sample, 1], xyz[sample, 2], errcheck=False)
+    ours = np.column_stack((x, y, z))
+    for k, i in enumerate(sample):
+        try:
+            expected = np.array(tuple(fallback(locations[i])), dtype=float)
+        except Exception as e:
+            return False, "Metashape could not transform a check location (" + repr(e) + ")"
+        diff = np.abs(ours[k] - expected)
+        if not (diff <= tolerance).all():
+            return False, "pyproj differs from Metashape by " + ", ".join(str(round(d, 9)) for d in diff) + \
+                " (x, y, z)"
+    return True, ""
+
+
+class TransformReport:
+
+    def __init__(self, what, n_items):
+        self.what = what  # e.g. "camera"
+        self.n_items = n_items
+        self.n_transformed = 0
+        self.n_no_location = 0
+        self.n_altitude = 0
+        self.failed = []  # (label, reason)
+        self.method = None
+
+    def report(self):
+        print(self.what + " references: " + str(self.n_transformed) + "/" + str(self.n_items) + " transformed (" +
+              str(self.method) + "), " + str(self.n_no_location) + " without a location, " + str(len(self.failed)) +
+              " failed" + (", " + str(self.n_altitude) + " altitudes corrected" if self.n_altitude else ""))
+        for label, reason in self.failed:
+            print("  could not transform " + self.what + " " + str(label) + ": " + reason)
+
+
+def transform_references(items, source, target, fallback, what="camera", rel_altitudes=None, altitude_offset=0.):
+    # items          - cameras or markers; their reference.location is replaced by the transformed location
+    # source/target  - Metashape CoordinateSystems (None = keep the coordinates and only apply the altitudes)
+    # fallback       - function(location) -> transformed location, used per entry when pyproj can't be used
+    # rel_altitudes  - optional list, one relative altitude (or None) per item: z = relative altitude + offset
+    report = TransformReport(what, len(items))
+
+    with_location = [i for i, item in enumerate(items) if item.reference.location]
+    report.n_no_location = len(items) - len(with_location)
+    xyz = np.array([tuple(items[i].reference.location) for i in with_location], dtype=float).reshape(-1, 3)
+    ok = np.ones(len(with_location), dtype=bool)
+
+    tr = None
+    if source is None or target is None:
+        report.method = "no transformation"
+    elif pyproj is not None and len(xyz):
+        source_def, target_def = crs_definition(source), crs_definition(target)
+        if source_def is not None and target_def is not None:
+            tr = transformer(source_def, target_def)
+        if tr is None:
+            report.method = "per entry (pyproj can't read the coordinate systems)"
+        else:
+            same, why = check_transformer(tr, pyproj.CRS(target_def).is_geographic, [items[i].reference.location for i in with_location], xyz, fallback)
+            if not same:
+                print("WARNING: " + what + " references: " + why + " - using Metashape's transformation")
+                report.method = "per entry, " + why
+                tr = None
+    else:
+        report.method = "per entry"
+
+    if tr is not None:
+        report.method = "pyproj, checked against Metashape on " + str(min(N_CHECK, len(xyz))) + " locations"
+        x, y, z = tr.transform(xyz[:, 0], xyz[:, 1], xyz[:, 2], errcheck=False)
+        xyz = np.column_stack((x, y, z))
+        ok = np.isfinite(xyz).all(axis=1)
+        for k in np.flatnonzero(~ok):
+            report.failed.append((items[with_location[k]].label, "outside the area of use of the transformation"))
+    elif source is not None and target is not None:
+        for k, i in enumerate(with_location):
+            try:
+                xyz[k] = tuple(fallback(items[i].reference.location))
+            except Exception as e:
+                ok[k] = False
+                report.failed.append((items[i].label, repr(e)))
+
+    if rel_altitudes is not None:  # DJI: replace z with the relative altitude plus the take off altitude
+        rel = np.array([np.nan if rel_altitudes[i] is None else rel_altitudes[i] for i in with_location], dtype=float)
+        has_rel = ~np.isnan(rel)
+        xyz[has_rel, 2] = rel[has_rel] + float(altitude_offset)
+        report.n_altitude = int(np.count_nonzero(has_rel & ok))
+
+    values = xyz.tolist()
+    for k in np.flatnonzero(ok):
+        items[with_location[k]].reference.location = tuple(values[k])
+    report.n_transformed = int(np.count_nonzero(ok)) if source is not None and target is not None else 0
+    return report
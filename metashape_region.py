@@ -0,0 +1,150 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: processing region fitting --------------------------------------------------------
+#######################################################################################################################
+# Fits chunk.region to the area that should be reconstructed instead of inflating the tie point box by 1.5:
+#   AOI       - polygon vertices in the project CRS, from a GeoJSON file or a CSV of x,y[,z] rows
+#   MARKERS   - the extent of the markers (placed positions, or their reference locations)
+#   TIEPOINTS - the tie points, trimmed by a percentile at each end of each box axis
+# The horizontal box is the minimum area rectangle around the AOI / marker vertices (or the principal axes of the
+# tie points), so long or diagonal sites get an aligned box. The vertical extent always comes from the (trimmed) tie
+# points inside that rectangle. Each dimension is then enlarged by the margin fraction.
+#
+# Everything is computed in chunk (internal) coordinates; the script supplies the CRS <-> chunk conversions, which
+# are only needed for a few points (box centre, AOI and marker vertices).
+
+import csv
+import json
+
+import numpy as np
+
+
+# ---- AOI files ------------------------------------------------------------------------------------------------------
+
+def geojson_vertices(data):  # all polygon vertices in a GeoJSON geometry / feature / feature collection
+    kind = data.get("type")
+    if kind == "FeatureCollection":
+        return [v for feature in data["features"] for v in geojson_vertices(feature)]
+    if kind == "Feature":
+        return geojson_vertices(data["geometry"])
+    if kind == "Polygon":
+        return [v for ring in data["coordinates"] for v in ring]
+    if kind == "MultiPolygon":
+        return [v for polygon in data["coordinates"] for ring in polygon for v in ring]
+    raise ValueError("AOI GeoJSON must contain Polygon or MultiPolygon geometries, not " + str(kind))
+
+
+def read_aoi(path):  # (n x 3) AOI vertices in the project CRS (z = 0 where not given)
+    if path.lower().endswith((".geojson", ".json")):
+        with open(path, 'r') as f:
+            vertices = geojson_vertices(json.load(f))
+    else:
+        vertices = []
+        with open(path, 'r') as f:
+            for row in csv.reader(f):
+                try:
+                    vertices.append([float(v) for v in row[:3] if v.strip()])
+                except ValueError:
+                    continue  # header line
+    xyz = np.zeros((len(vertices), 3))
+    for i, v in enumerate(vertices):
+        xyz[i, :len(v[:3])] = v[:3]
+    if len(xyz) < 3:
+        raise ValueError("AOI file " + path + " has fewer than 3 vertices")
+    return xyz
+
+
+# ---- box geometry ---------------------------------------------------------------------------------------------------
+
+def convex_hull(xy):  # monotone chain - hull vertices of 2-d points
+    pts = sorted(set(map(tuple, xy)))
+    if len(pts) < 3:
+        return np.array(pts)
+
+    def half(points):
+        chain = []
+        for p in points:
+            while len(chain) >= 2 and ((chain[-1][0] - chain[-2][0]) * (p[1] - chain[-2][1]) -
+                                       (chain[-1][1] - chain[-2][1]) * (p[0] - chain[-2][0])) <= 0:
+                chain.pop()
+            chain.append(p)
+        return chain
+
+    return np.array(half(pts)[:-1] + half(pts[::-1])[:-1])
+
+
+def min_area_rectangle(xy):  # (angle of the first box axis, lower corner, upper corner) in the rotated frame
+    hull = convex_hull(xy)
+    if len(hull) < 3:
+        return 0., xy.min(axis=0), xy.max(axis=0)
+    edges = np.roll(hull, -1, axis=0) - hull
+    angles = np.unique(np.mod(np.arctan2(edges[:, 1], edges[:, 0]), np.pi / 2))  # one side of the box is on an edge
+    c, s = np.cos(angles), np.sin(angles)
+    u = hull[:, 0][:, None] * c + hull[:, 1][:, None] * s  # hull in each candidate frame
+    v = -hull[:, 0][:, None] * s + hull[:, 1][:, None] * c
+    areas = (u.max(axis=0) - u.min(axis=0)) * (v.max(axis=0) - v.min(axis=0))
+    best = int(np.argmin(areas))
+    rot = rotation_2d(angles[best])
+    local = xy @ rot
+    return float(angles[best]), local.min(axis=0), local.max(axis=0)
+
+
+def rotation_2d(angle):  # columns: the box axes
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, -s], [s, c]])
+
+
+def principal_angle(xy):  # direction of the largest spread of 2-d points
+    centred = xy - xy.mean(axis=0)
+    w, v = np.linalg.eigh(centred.T @ centred)
+    return float(np.arctan2(v[1, -1], v[0, -1]))
+
+
+def horizontal_frame(up):  # 3 x 3 matrix with columns east-ish, north-ish and up (orthonormal)
+    up = up / np.linalg.norm(up)
+    helper = np.array([0., 1., 0.]) if abs(up[1]) < 0.9 else np.array([1., 0., 0.])
+    x = np.cross(helper, up)
+    x /= np.linalg.norm(x)
+    return np.column_stack((x, np.cross(up, x), up))
+
+
+class RegionFit:
+
+    def __init__(self, source, center, rot, size):
+        self.source = source
+        self.center = center  # chunk coordinates
+        self.rot = rot  # 3 x 3, columns are the box axes
+        self.size = size
+
+    def volume(self):
+        return float(np.prod(self.size))
+
+
+def fit_region(coords, up, source, vertices=None, trim=1.0, margin=0.1):
+    # coords   - (n x 3) valid tie point coordinates (chunk coordinates)
+    # up       - vertical direction in chunk coordinates
+    # vertices - (m x 3) AOI polygon or marker positions (chunk coordinates) for the AOI / MARKERS sources
+    # trim     - percentile trimmed from each end of each tie point axis
+    frame = horizontal_frame(np.asarray(up, dtype=float))
+    local = coords @ frame  # horizontal x, y and height
+
+    if vertices is not None:
+        angle, lo, hi = min_area_rectangle((vertices @ frame)[:, :2])
+    else:
+        angle = principal_angle(local[:, :2])
+        lo = hi = None
+    rot2 = rotation_2d(angle)
+    box_xy = local[:, :2] @ rot2
+
+    if lo is None:  # TIEPOINTS: trimmed extent along the principal axes
+        lo = np.percentile(box_xy, trim, axis=0)
+        hi = np.percentile(box_xy, 100 - trim, axis=0)
+    inside = ((box_xy >= lo) & (box_xy <= hi)).all(axis=1)
+    heights = local[inside, 2] if inside.any() else local[:, 2]
+    z_lo, z_hi = np.percentile(heights, trim), np.percentile(heights, 100 - trim)
+
+    size = np.array([hi[0] - lo[0], hi[1] - lo[1], z_hi - z_lo]) * (1 + margin)
+    centre_local = np.array([(lo[0] + hi[0]) / 2., (lo[1] + hi[1]) / 2.])
+    rot = frame.copy()
+    rot[:, :2] = frame[:, :2] @ rot2  # rotate the horizontal axes to the rectangle
+    center = rot[:, :2] @ centre_local + frame[:, 2] * (z_lo + z_hi) / 2.
+    return RegionFit(source, center, rot, size)
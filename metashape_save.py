@@ -0,0 +1,127 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: coalesced project saving ---------------------------------------------------------
+#######################################################################################################################
+# Saving a multi-GB project on a network filesystem can take minutes, so the scripts no longer call doc.save after
+# every step. Instead each step reports a checkpoint to a SaveManager, which saves according to the save_policy set in
+# input_file.csv:
+#   always - save at every checkpoint (previous behaviour)
+#   stages - save only after expensive stages (photo analysis, alignment, depth maps / dense cloud, mesh, ortho, DSM)
+#   time   - save at a checkpoint once save_interval_minutes have passed since the last save
+#   exit   - save only at the end of the script
+# Whatever the policy, unsaved work is saved when the script finishes, and when it fails between stages (a failing
+# checkpoint save, or a SIGTERM from the batch system). When a stage itself fails or is terminated part way, the project
+# may hold half of its changes (e.g. some of the gradual selection passes), so it is not saved: the next run resumes
+# from the last save, and the stage and any stages whose save was deferred run again. Every save is timed and logged
+# to <doc_title>.files/save_log.csv.
+#
+# The SIGTERM handler is Python code, so it only runs between Metashape calls: a SIGTERM during a long call such as
+# matchPhotos or buildDepthMaps is handled when the call returns, which is usually after the batch system's grace
+# period has run out and the job has been killed. Saving at checkpoints (save_policy stages or time) is what limits
+# the work lost to a killed job.
+
+import contextlib
+import csv
+import os
+import signal
+import time
+from datetime import datetime
+
+POLICIES = ("always", "stages", "time", "exit")
+
+
+class SaveManager:
+
+    def __init__(self, doc, home, doc_title, part, policy="stages", interval_minutes=30, backups="TRUE", runner=None,
+                 read_only=False, metrics=None):
+        self.doc = doc
+        self.read_only = read_only  # e.g. --explain runs: never write the project
+        self.path = home + "/" + doc_title + ".psx"
+        self.log_path = home + "/" + doc_title + ".files/save_log.csv"
+        self.part = part
+        if policy not in POLICIES:
+            print("unknown save policy '" + str(policy) + "' - using 'stages'")
+            policy = "stages"
+        self.policy = policy
+        self.interval = float(interval_minutes) * 60
+        self.backups = backups == "TRUE"
+        self.runner = runner  # StageRunner told about every save of the main project
+        self.metrics = metrics  # StageMetrics recording the cost of every save
+        self.last_save = time.time()
+        self.dirty = False
+
+    def record(self, reason, path, seconds):
+        print("saved " + path + " (" + reason + ") in " + str(round(seconds, 1)) + " s")
+        if not os.path.isdir(os.path.dirname(self.log_path)):
+            return
+        new_log = not os.path.isfile(self.log_path)
+        with open(self.log_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_log:
+                writer.writerow(["time", "part", "reason", "path", "seconds"])
+            writer.writerow([str(datetime.now()), self.part, reason, path, round(seconds, 3)])
+
+    def write(self, path, reason, kind, *args):
+        if self.metrics is not None:
+            self.metrics.measure("doc.save (" + reason + ")", kind, self.doc.save, path, *args)
+        else:
+            self.doc.save(path, *args)
+
+    def save(self, reason):  # save the main project now
+        if self.read_only:
+            return
+        start = time.time()
+        self.write(self.path, reason, "save")
+        self.last_save = time.time()
+        self.dirty = False
+        self.record(reason, self.path, self.last_save - start)
+        if self.runner is not None:
+            self.runner.saved()
+
+    def checkpoint(self, reason, expensive=False):  # the project changed - save if the policy asks for it
+        if self.read_only:
+            return
+        self.dirty = True
+        if self.policy == "always" or (self.policy == "stages" and expensive) or \
+                (self.policy == "time" and time.time() - self.last_save >= self.interval):
+            self.save(reason)
+        else:
+            print("save after " + reason + " deferred (save policy: " + self.policy + ")")
+
+    def backup(self, path):  # full copy of the project (e.g. _backup.psx) - optional
+        if not self.backups or self.read_only:
+            print("backup copy not selected: " + path)
+            return
+        start = time.time()
+        self.write(path, "backup copy", "backup", self.doc.chunks)
+        self.record("backup copy", path, time.time() - start)
+
+    def finish(self):  # end of the script: save anything not yet saved
+        if self.dirty and not self.read_only:
+            self.save("end of " + self.part)
+
+    @contextlib.contextmanager
+    def on_failure(self):  # save unsaved work if the block fails between stages (including on a SIGTERM)
+        def terminate(signum, frame):
+            raise SystemExit("terminated by signal " + str(signum))
+
+        try:
+            previous = signal.signal(signal.SIGTERM, terminate)
+        except ValueError:  # not in the main thread
+            previous = None
+
+        try:
+            yield self
+        except BaseException:
+            if self.runner is not None and self.runner.interrupted is not None:
+                print("stage " + self.runner.interrupted + " did not finish - project not saved, the next run resumes "
+                      "from the last save")
+            elif self.dirty:
+                print("stopped between stages - saving unsaved work before exiting")
+                try:
+                    self.save("failure")
+                except Exception as e:
+                    print("could not save project: " + repr(e))
+            raise
+        finally:
+            if previous is not None:
+                signal.signal(signal.SIGTERM, previous)
@@ -0,0 +1,252 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: checkpointed, resumable stage runner ---------------------------------------------
+#######################################################################################################################
+# Every stage of the three workflow scripts is run through a StageRunner, which keeps a durable ledger of what finished
+# in <home>/<doc_title>.files/stage_ledger.json (status, inputs, outputs, timestamps). When a script is run again (e.g.
+# after a batch job was killed) stages that completed - and whose results were saved in the project and whose output
+# files are still on disk - are skipped and processing resumes at the first incomplete stage.
+#
+# Pass --restart to a script to ignore the ledger for that part and run every stage again.
+#
+# Stages can also carry a fingerprint: a content hash of the input_file.csv settings they depend on plus the fingerprints
+# (or state) of their upstream products. Such stages are memoised make-style - they are skipped whenever their
+# fingerprint is unchanged, even if an earlier stage had to run again. Pass --explain to print why each stage will or
+# will not run, without running anything.
+
+import hashlib
+import json
+import os
+import sys
+from datetime import datetime
+
+from metashape_instrument import dir_state, changed_files
+
+LEDGER_NAME = "stage_ledger.json"
+
+
+def ledger_path(home, doc_title):
+    return home + '/' + doc_title + '.files/' + LEDGER_NAME
+
+
+def timestamp():
+    return str(datetime.now())
+
+
+def file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def jsonable(value):  # values that can't be stored in the ledger (e.g. Metashape objects) are stored as None
+    try:
+        json.dumps(value)
+    except (TypeError, ValueError):
+        return None
+    return value
+
+
+def stage_inputs(args, kwargs):  # the plain (str/number/bool) arguments of a stage call
+    plain = (str, int, float, bool, type(None))
+    inputs = [a if isinstance(a, plain) else None for a in args]
+    inputs += [[k, v] for k, v in sorted(kwargs.items()) if isinstance(v, plain)]
+    return inputs
+
+
+def fingerprint(config, keys, upstream=None, state=None):
+    # config   - {variable: value} from input_file.csv
+    # keys     - the input_file.csv variables the stage depends on
+    # upstream - {name: fingerprint} of the products the stage reads
+    # state    - {name: value} describing products made outside this part (e.g. the dense cloud point count)
+    parts = {"config": dict((k, config.get(k)) for k in keys),
+             "upstream": dict((k, v["hash"]) for k, v in (upstream or {}).items()),
+             "state": state or {}}
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+    return {"hash": digest, "parts": parts}
+
+
+def fingerprint_changes(old, new):  # readable list of what differs between two fingerprints
+    changes = []
+    for section in ("config", "upstream", "state"):
+        old_part = old["parts"].get(section, {})
+        new_part = new["parts"].get(section, {})
+        for k in sorted(set(old_part) | set(new_part)):
+            if old_part.get(k) != new_part.get(k):
+                if section == "upstream":
+                    changes.append("upstream " + k + " changed")
+                else:
+                    changes.append(k + " changed (" + str(old_part.get(k)) + " -> " + str(new_part.get(k)) + ")")
+    return changes
+
+
+class StageLedger:
+    # ordered list of stage entries for one project, shared by all three parts
+
+    def __init__(self, path):
+        self.path = path
+        self.read_only = False
+        self.data = {"project_mtime": None, "stages": []}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.data = json.load(f)
+            except ValueError:
+                print("stage ledger is unreadable - starting a new one: " + path)
+
+    def stages(self):
+        return self.data["stages"]
+
+    def entry(self, name, part=None):  # stage names are only unique within a part (e.g. export_settings)
+        for e in self.stages():
+            if e["name"] == name and (part is None or e["part"] == part):
+                return e
+        return None
+
+    def drop_from(self, name, part=None):  # forget a stage and every stage recorded after it
+        e = self.entry(name, part)
+        if e is not None:
+            del self.stages()[self.stages().index(e):]
+
+    def drop_part(self, part, keep_fingerprinted=False):  # forget every stage of this part and of the parts after it
+        self.data["stages"] = [e for e in self.stages()
+                               if e["part"] < part or (keep_fingerprinted and e.get("fingerprint") is not None)]
+
+    def save(self):  # write atomically; nothing is written until Metashape has created the .files folder
+        folder = os.path.dirname(self.path)
+        if self.read_only or not os.path.isdir(folder):
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+class StageRunner:
+
+    def __init__(self, home, doc_title, part, watch_dir=None, restart=None, explain=None, metrics=None):
+        self.project = home + "/" + doc_title + ".psx"
+        self.metrics = metrics  # StageMetrics recording the cost of each stage
+        self.part = part
+        self.watch_dir = watch_dir  # new or changed files in this folder are recorded as stage outputs
+        self.ledger = StageLedger(ledger_path(home, doc_title))
+        self.resuming = True
+        self.interrupted = None  # stage that failed or was terminated part way - the project may be half-changed
+
+        if restart is None:
+            restart = "--restart" in sys.argv
+        if explain is None:
+            explain = "--explain" in sys.argv
+        self.explain = explain  # only report what would run
+        self.ledger.read_only = explain
+
+        recorded_mtime = self.ledger.data["project_mtime"]
+        if restart:
+            print("--restart given: running all " + part + " stages")
+            self.ledger.drop_part(part)
+        elif recorded_mtime is not None and file_mtime(self.project) != recorded_mtime:
+            # the project was saved outside the workflow (e.g. manual cleaning) - this part must be redone, apart
+            # from fingerprinted stages whose fingerprints and checks already cover the products they read
+            print("project changed since the last recorded save: running all " + part + " stages")
+            self.ledger.drop_part(part, keep_fingerprinted=True)
+
+    def completed(self, name):
+        e = self.ledger.entry(name, self.part)
+        return e is not None and e["status"] == "complete" and e["saved"]
+
+    def status(self, entry, inputs, check, fingerprint):  # (can the stage be skipped, why)
+        if fingerprint is None and not self.resuming:
+            return False, "an earlier stage runs again"
+        if entry is None:
+            return False, "no record of a previous run"
+        if entry["status"] != "complete":
+            return False, "previous run " + entry["status"]
+        if not entry["saved"]:
+            return False, "previous result was not saved in the project"
+        if fingerprint is None and entry["inputs"] != inputs:
+            return False, "inputs changed since the last run"
+        if fingerprint is not None:
+            if entry.get("fingerprint") is None:
+                return False, "no fingerprint recorded"
+            if entry["fingerprint"]["hash"] != fingerprint["hash"]:
+                return False, ", ".join(fingerprint_changes(entry["fingerprint"], fingerprint))
+        for path, (size, mtime) in entry["outputs"].items():
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False, "output missing or changed - " + path
+        if check is not None and not check():
+            return False, "result not found in the project"
+        return True, "unchanged since " + entry["finished"]
+
+    def will_run(self, name, *args, check=None, fingerprint=None, **kwargs):  # would run() run this stage now
+        return not self.status(self.ledger.entry(name, self.part), stage_inputs(args, kwargs), check, fingerprint)[0]
+
+    def run(self, name, func, *args, outputs=None, check=None, project_stage=True, fingerprint=None, **kwargs):
+        # outputs       - files the stage writes outside the watch folder (must exist to skip the stage)
+        # check         - callable returning True when the stage result is present in the opened project
+        # project_stage - the stage changes the project, so it only counts as done once the project is saved
+        # fingerprint   - see fingerprint(); memoises the stage independently of the stages before it
+        inputs = stage_inputs(args, kwargs)
+        entry = self.ledger.entry(name, self.part)
+        skip, reason = self.status(entry, inputs, check, fingerprint)
+
+        if self.explain:
+            print(("skip " if skip else "RUN  ") + name + ": " + reason)
+            if not skip:
+                self.resuming = False
+            return entry["result"] if entry is not None else None
+
+        if skip:
+            print("stage " + name + " " + reason + " - skipping")
+            if self.metrics is not None:
+                self.metrics.skipped(name)
+            return entry["result"]
+
+        print("running stage " + name + ": " + reason)
+        self.resuming = False
+
+        new_entry = {"name": name, "part": self.part, "status": "running", "inputs": inputs, "outputs": {},
+                     "result": None, "started": timestamp(), "finished": None, "saved": not project_stage,
+                     "fingerprint": fingerprint}
+        if fingerprint is not None and entry is not None:  # memoised stage - later stages decide for themselves
+            self.ledger.stages()[self.ledger.stages().index(entry)] = new_entry
+        else:
+            self.ledger.drop_from(name, self.part)  # this stage and all later ones are redone
+            self.ledger.stages().append(new_entry)
+        entry = new_entry
+        self.ledger.save()
+
+        before = dir_state(self.watch_dir)
+        project_mtime = file_mtime(self.project)
+        try:
+            if self.metrics is not None:
+                result = self.metrics.measure(name, "stage", func, *args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
+        except BaseException as e:
+            self.interrupted = name
+            entry["status"] = "failed"
+            entry["error"] = repr(e)
+            entry["finished"] = timestamp()
+            self.ledger.save()
+            raise
+
+        after = dir_state(self.watch_dir)
+        written = changed_files(before, after)
+        for path in outputs or []:
+            if os.path.isfile(path):
+                written[path] = [os.path.getsize(path), os.path.getmtime(path)]
+
+        entry.update(status="complete", outputs=written, result=jsonable(result), finished=timestamp())
+        if file_mtime(self.project) != project_mtime:  # the stage saved the project itself
+            self.saved()
+        else:
+            self.ledger.save()
+
+        return result
+
+    def saved(self):  # call after every save of the main project: completed stages are now safe to skip
+        for e in self.ledger.stages():
+            if e["status"] == "complete":
+                e["saved"] = True
+        self.ledger.data["project_mtime"] = file_mtime(self.project)
+        self.ledger.save()
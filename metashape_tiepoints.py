@@ -0,0 +1,256 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: tie point (sparse point cloud) analysis ------------------------------------------
+# ------ Columnar tie point snapshot, vectorised reprojection error engine and region classifier --------------------
+#######################################################################################################################
+# These helpers only use the Metashape objects that are passed in (chunk, points, projections, cameras) so that the
+# numerical parts can be run and benchmarked without a Metashape licence (see benchmarks/).
+
+import math
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+def matrix_to_array(matrix):  # convert a Metashape Matrix into a numpy array
+    n_rows = matrix.size[0]
+    return np.array([list(matrix.row(i)) for i in range(n_rows)], dtype=float)
+
+
+class TiePointSnapshot:
+    # Columnar copy of the sparse point cloud, taken in a single traversal of point_cloud.points:
+    #   track_ids - track id of each point
+    #   coords    - homogeneous chunk coordinates (n x 4)
+    #   valid     - valid flag of each point
+    #   selected  - selected flag of each point
+    # The snapshot must be dropped (invalidate_snapshot) whenever points are removed or the cloud is rebuilt. Selection
+    # changes made through the snapshot (set_selected) keep it in sync; selection changes made by Metashape itself
+    # (e.g. PointCloud.Filter.selectPoints) are picked up with refresh_selected.
+
+    def __init__(self, point_cloud):
+        self.points = point_cloud.points
+        npoints = len(self.points)
+        self.track_ids = np.empty(npoints, dtype=np.int64)
+        self.coords = np.empty((npoints, 4), dtype=float)
+        self.valid = np.empty(npoints, dtype=bool)
+        self.selected = np.empty(npoints, dtype=bool)
+        for i, point in enumerate(self.points):
+            self.track_ids[i] = point.track_id
+            self.coords[i] = tuple(point.coord)
+            self.valid[i] = point.valid
+            self.selected[i] = point.selected
+        self._lookup = None
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def lookup(self):  # track_id -> point index lookup, built on first use
+        if self._lookup is None:
+            self._lookup = track_lookup(self.track_ids)
+        return self._lookup
+
+    def n_selected(self):
+        return int(np.count_nonzero(self.selected))
+
+    def refresh_selected(self):  # re-read only the selected flags after Metashape changed the selection
+        for i, point in enumerate(self.points):
+            self.selected[i] = point.selected
+
+    def set_selected(self, mask):  # select the points flagged in mask, touching only those points
+        for i in np.flatnonzero(mask & ~self.selected):
+            self.points[int(i)].selected = True
+        self.selected |= mask
+
+    def remove_selected(self):  # mirror PointCloud.Filter.removePoints after selectPoints with the same threshold
+        self.valid &= ~self.selected
+        self.selected[:] = False
+
+    def is_stale(self, chunk):  # cheap safety net on top of explicit invalidation
+        return chunk.point_cloud is None or len(chunk.point_cloud.points) != len(self)
+
+
+_snapshots = {}  # chunk key -> TiePointSnapshot
+
+
+def tiepoint_snapshot(chunk):  # return the cached snapshot of the chunk's sparse cloud, taking a new one if needed
+    snapshot = _snapshots.get(chunk.key)
+    if snapshot is None or snapshot.is_stale(chunk):
+        snapshot = TiePointSnapshot(chunk.point_cloud)
+        _snapshots[chunk.key] = snapshot
+    return snapshot
+
+
+def invalidate_snapshot(chunk):  # call after any operation that adds, removes or moves tie points
+    _snapshots.pop(chunk.key, None)
+
+
+def track_lookup(track_ids):  # build the track_id -> point index lookup once for the whole cloud
+    if len(track_ids) == 0:
+        return np.full(1, -1, dtype=np.int64)
+    lookup = np.full(int(track_ids.max()) + 1, -1, dtype=np.int64)
+    lookup[track_ids] = np.arange(len(track_ids), dtype=np.int64)
+    return lookup
+
+
+def lookup_points(lookup, proj_track_ids):  # map projection track ids to point indices (-1 where there is no point)
+    idx = np.full(len(proj_track_ids), -1, dtype=np.int64)
+    in_range = (proj_track_ids >= 0) & (proj_track_ids < len(lookup))
+    idx[in_range] = lookup[proj_track_ids[in_range]]
+    return idx
+
+
+def projection_arrays(projs):  # gather the track ids and image coordinates of one camera's projections
+    nprojs = len(projs)
+    track_ids = np.empty(nprojs, dtype=np.int64)
+    uv = np.empty((nprojs, 2), dtype=float)
+    for i, proj in enumerate(projs):
+        track_ids[i] = proj.track_id
+        uv[i] = (proj.coord.x, proj.coord.y)
+
+    return track_ids, uv
+
+
+def is_frame_camera(camera):  # the vectorised projection only implements the standard frame camera model
+    sensor = camera.sensor
+    if sensor is None or sensor.calibration is None:
+        return False
+    if getattr(sensor, "rolling_shutter", False):
+        return False
+    return sensor.type == sensor.Type.Frame
+
+
+def project_frame(coords, world_to_cam, calib):
+    # project homogeneous chunk coordinates into pixel coordinates with the Metashape frame camera model
+    # (Metashape User Manual, Appendix C: camera models)
+    cam = coords @ world_to_cam.T
+    x = cam[:, 0] / cam[:, 2]
+    y = cam[:, 1] / cam[:, 2]
+
+    r2 = x * x + y * y
+    radial = 1 + r2 * (calib.k1 + r2 * (calib.k2 + r2 * (calib.k3 + r2 * calib.k4)))
+    tangential = 1 + r2 * (calib.p3 + r2 * calib.p4)
+
+    xd = x * radial + (calib.p1 * (r2 + 2 * x * x) + 2 * calib.p2 * x * y) * tangential
+    yd = y * radial + (calib.p2 * (r2 + 2 * y * y) + 2 * calib.p1 * x * y) * tangential
+
+    u = calib.width * 0.5 + calib.cx + xd * calib.f + xd * calib.b1 + yd * calib.b2
+    v = calib.height * 0.5 + calib.cy + yd * calib.f
+
+    return np.column_stack((u, v))
+
+
+class ReprojectionErrors:
+    # Per-camera and per-point reprojection errors for all aligned cameras in a chunk.
+    #   cameras       - aligned cameras, in chunk.cameras order
+    #   camera_rmse   - root mean square error (pix) of each camera (nan if it has no valid projections)
+    #   camera_nproj  - number of valid projections used for each camera
+    #   point_rmse    - root mean square error (pix) of each sparse cloud point (nan if it is not projected)
+    #   point_nproj   - number of projections of each point
+
+    def __init__(self, cameras, camera_rmse, camera_nproj, point_rmse, point_nproj):
+        self.cameras = cameras
+        self.camera_rmse = camera_rmse
+        self.camera_nproj = camera_nproj
+        self.point_rmse = point_rmse
+        self.point_nproj = point_nproj
+
+    def rmse_list(self):  # per-camera rmse values as returned by calc_reprojection_error
+        return [float(e) for e in self.camera_rmse if not math.isnan(e)]
+
+
+def camera_square_errors(camera, points, projs, idx, proj_sel, coords, uv):
+    # squared reprojection error of each selected projection of a camera
+    if is_frame_camera(camera):
+        world_to_cam = np.linalg.inv(matrix_to_array(camera.transform))
+        diff = project_frame(coords[idx], world_to_cam, camera.sensor.calibration) - uv[proj_sel]
+        return (diff * diff).sum(axis=1)
+
+    # other sensor types (fisheye, spherical, rolling shutter...) fall back to Metashape's own projection
+    return np.array([camera.error(points[i].coord, projs[j].coord).norm() ** 2
+                     for i, j in zip(idx, np.flatnonzero(proj_sel))], dtype=float)
+
+
+def reprojection_errors(chunk, snapshot, projections):
+    points, coords, valid = snapshot.points, snapshot.coords, snapshot.valid
+    lookup = snapshot.lookup()
+    npoints = len(snapshot)
+
+    cameras = []
+    camera_rmse = []
+    camera_nproj = []
+    point_sq = np.zeros(npoints, dtype=float)
+    point_nproj = np.zeros(npoints, dtype=np.int64)
+
+    for camera in chunk.cameras:
+        if not camera.transform:
+            continue
+
+        projs = projections[camera]
+        proj_ids, uv = projection_arrays(projs)
+        idx = lookup_points(lookup, proj_ids)
+        proj_sel = idx >= 0
+        proj_sel[proj_sel] = valid[idx[proj_sel]]  # skip projections of invalid points
+        idx = idx[proj_sel]
+
+        sq = camera_square_errors(camera, points, projs, idx, proj_sel, coords, uv)
+
+        point_sq += np.bincount(idx, weights=sq, minlength=npoints)
+        point_nproj += np.bincount(idx, minlength=npoints)
+
+        cameras.append(camera)
+        camera_nproj.append(len(sq))
+        camera_rmse.append(math.sqrt(sq.sum() / len(sq)) if len(sq) else float("nan"))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        point_rmse = np.sqrt(point_sq / point_nproj)
+
+    return ReprojectionErrors(cameras, np.array(camera_rmse, dtype=float), np.array(camera_nproj, dtype=np.int64),
+                              point_rmse, point_nproj)
+
+
+def region_arrays(region):  # centre, rotation and size of a Metashape Region as numpy arrays
+    center = np.array(tuple(region.center), dtype=float)
+    rot = matrix_to_array(region.rot)
+    size = np.array(tuple(region.size), dtype=float)
+    return center, rot, size
+
+
+def outside_box(coords, center, rot, size):
+    # True for points outside the rotated box - same test as R.t() * (v - C) against size / 2 on each axis
+    local = (coords[:, :3] - center) @ rot
+    return (np.abs(local) > np.abs(size) / 2.).any(axis=1)
+
+
+def region_outliers(chunk, snapshot, select=False):
+    # classify all valid tie points against chunk.region at once
+    # returns the mask of valid points outside the region, the number outside and the number inside
+    center, rot, size = region_arrays(chunk.region)
+    outside = snapshot.valid & outside_box(snapshot.coords, center, rot, size)
+    n_outside = int(np.count_nonzero(outside))
+    n_inside = int(np.count_nonzero(snapshot.valid)) - n_outside
+
+    if select:  # only touch the Metashape points when the selection is wanted
+        snapshot.set_selected(outside)
+
+    return outside, n_outside, n_inside
+
+
+def knn_outliers(snapshot, k=8, sigma=3.0):
+    # statistical outlier test: a valid point is an outlier if its mean distance to its k nearest valid neighbours is
+    # more than sigma standard deviations above the mean of that distance over the cloud
+    # returns the mask of outliers and the distance limit (chunk units), or None without scipy
+    if cKDTree is None:
+        return None
+    idx = np.flatnonzero(snapshot.valid)
+    outliers = np.zeros(len(snapshot), dtype=bool)
+    if len(idx) <= k:
+        return outliers, float("nan")
+
+    xyz = snapshot.coords[idx, :3]
+    dist = cKDTree(xyz).query(xyz, k + 1, workers=-1)[0]  # the first neighbour is the point itself
+    mean_dist = dist[:, 1:].mean(axis=1)
+    limit = float(mean_dist.mean() + sigma * mean_dist.std())
+    outliers[idx[mean_dist > limit]] = True
+    return outliers, limit
@@ -0,0 +1,65 @@
+#######################################################################################################################
+# ------ Metashape workflow helpers: spatial tiling for depth maps and dense cloud ------------------------------------
+#######################################################################################################################
+# Large surveys are split into tiles so that depth maps and dense clouds are built for a bounded number of cameras at
+# a time. Tiles are boxes in the horizontal frame of chunk.region, made by splitting the region at the median camera
+# position along its longer side until every tile holds at most the maximum number of cameras (so tiles have similar
+# camera counts even where the flight is uneven). The maximum comes from Tiling_Cameras_Per_Tile and/or a memory
+# budget (Tiling_Memory_GB) divided by a rough depth map memory estimate per camera.
+#
+# Each tile is built from the cameras within the overlap margin of its box, with the region grown by the margin for
+# the depth maps and shrunk back to the tile box for the dense cloud - the dense points of neighbouring tiles don't
+# overlap, so the tiles' clouds can simply be merged.
+
+import math
+
+import numpy as np
+
+BYTES_PER_DEPTH_PIXEL = 64  # rough peak memory per depth map pixel (image, depth, confidence and filtering buffers)
+
+
+def cameras_per_tile(max_cameras, memory_gb, width, height, downscale):  # cameras allowed in one tile (None = all)
+    limits = []
+    if max_cameras not in (None, "NONE", "", 0):
+        limits.append(int(max_cameras))
+    if memory_gb not in (None, "NONE", "", 0):
+        per_camera = width * height / float(downscale * downscale) * BYTES_PER_DEPTH_PIXEL
+        limits.append(max(1, int(float(memory_gb) * 1024 ** 3 / per_camera)))
+    return min(limits) if limits else None
+
+
+def split_tiles(xy, lo, hi, max_per_tile):  # [(lo, hi), ...] boxes covering lo-hi, each with <= max_per_tile points
+    inside = ((xy >= lo) & (xy <= hi)).all(axis=1)
+    if max_per_tile is None or np.count_nonzero(inside) <= max_per_tile:
+        return [(lo, hi)]
+    axis = 0 if hi[0] - lo[0] >= hi[1] - lo[1] else 1
+    cut = float(np.median(xy[inside, axis]))
+    if not lo[axis] < cut < hi[axis]:  # every camera at the same position - can't split further
+        return [(lo, hi)]
+    lo_hi, hi_lo = hi.copy(), lo.copy()
+    lo_hi[axis] = cut
+    hi_lo[axis] = cut
+    return split_tiles(xy, lo, lo_hi, max_per_tile) + split_tiles(xy, hi_lo, hi, max_per_tile)
+
+
+def tile_members(xy, lo, hi, margin):  # indices of the points within margin of a tile box
+    return np.flatnonzero(((xy >= lo - margin) & (xy <= hi + margin)).all(axis=1))
+
+
+def region_frame(center, rot, xyz):  # horizontal (first two region axes) coordinates of chunk points
+    return ((np.asarray(xyz, dtype=float) - center) @ rot)[:, :2]
+
+
+def tile_region(center, rot, size, lo, hi, margin=0.):  # (centre, size) of the region of a tile box (+ margin)
+    mid = np.array([(lo[0] + hi[0]) / 2., (lo[1] + hi[1]) / 2., 0.])
+    tile_size = np.array([hi[0] - lo[0] + 2 * margin, hi[1] - lo[1] + 2 * margin, size[2]])
+    return center + rot @ mid, tile_size
+
+
+def plan_report(tiles, counts, max_per_tile):
+    print("tiling: " + str(len(tiles)) + " tiles of at most " + str(max_per_tile) + " cameras (" +
+          str(min(counts)) + " - " + str(max(counts)) + " cameras per tile with overlap)")
+
+
+def tile_label(chunk_label, i, n):
+    return chunk_label + " tile " + str(i + 1).zfill(int(math.log10(max(n, 1))) + 1)